@@ -0,0 +1,563 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Local Packages
+from card_database import _card_record, open_card_database, \
+        parse_card_lines, write_file_atomically
+
+###############################################################################
+# Class - AccessGroup
+###############################################################################
+
+# An 'Access Group' is a named set of cards, declared in the config file in a
+# [Group <name>] section. Devices grant access to groups with their
+# 'access groups' parameter, rather than (or as well as) having their own
+# ACL file.
+#
+# The cards in a group come from one or more ACL files ('card files',
+# relative to the access control files path, in either text or compiled
+# form), and/or are listed in the config file itself ('cards').
+#
+# A group can be limited to the times in a [Schedule <name>] section (see
+# access_schedule.py) with its 'schedule' parameter. To give one card its
+# own times, put it in a group of its own.
+class AccessGroup:
+    name = 'NOT DEFINED'
+
+    # The AccessSchedule for 'schedule_name' is set by
+    # config.parse_config_options, once all of the sections have been read
+    schedule_name = None
+    schedule = None
+
+    def __init__(self, config, acl_path):
+        """Access Group Constructor"""
+        self.card_databases = []
+        self.inline_cards = frozenset()
+
+        for o, a in config:
+            if o == 'card files':
+                for filename in a.split():
+                    self.card_databases.append(
+                            open_card_database(acl_path, filename))
+            elif o == 'cards':
+                try:
+                    self.inline_cards = frozenset(parse_card_lines(a.split()))
+                except ValueError:
+                    assert False, "Group cards must be hex card IDs, " \
+                        "separated by spaces (is '%s')" % a
+            elif o == 'schedule':
+                self.schedule_name = a
+            else:
+                assert False, "Unsupported parameter '%s' for Group" % o
+
+        if not self.card_databases and not self.inline_cards:
+            assert False, "Neither 'card files' nor 'cards' set for group"
+
+    def __contains__(self, card):
+        if card in self.inline_cards:
+            return True
+        for card_database in self.card_databases:
+            if card_database.contains(card):
+                return True
+        return False
+
+    def __iter__(self):
+        for card in self.inline_cards:
+            yield card
+        for card_database in self.card_databases:
+            for card in card_database:
+                yield card
+
+
+###############################################################################
+# Class - AccessIndex
+###############################################################################
+
+# The 'Access Index' answers "can this card open this device" for every
+# device that uses access groups, with a single lookup.
+#
+# Each such device is given a bit number. At load time, the groups are
+# compiled into one dictionary, mapping each card to a bitmask of the devices
+# it can open. The index is shared by all of the devices, so each card is
+# only held in memory once, however many devices and groups it's in.
+#
+# When any of the groups' ACL files are reloaded (whoever noticed the
+# change - the same file may also be a device's own ACL file), the whole
+# index is rebuilt once (rather than once per device), and swapped in as a
+# whole. When a delta is applied to one of them (see acl_sync.py), only the
+# entries for the cards it changes are replaced, in place.
+#
+# Groups with a schedule can't go into the card -> device dictionary, since
+# whether they open a device depends on the time. Instead, each scheduled
+# group also gets a bit number, and the index holds a second dictionary
+# mapping each card to a bitmask of its scheduled groups. Each device has a
+# bitmask of the scheduled groups it allows, and the index keeps a bitmask
+# of the scheduled groups that are currently open. So checking a card is
+# still a couple of lookups and ANDs, however many cards and schedules
+# there are.
+#
+# The 'currently open' bitmask is only worked out again when the next
+# schedule opens or closes (or at midnight, or at least hourly, so that
+# closed dates and clock changes are picked up).
+class AccessIndex:
+
+    # Longest time to go without re-checking which schedules are open
+    max_schedule_refresh = 3600.0
+
+    def __init__(self, groups_by_name):
+        """Access Index Constructor"""
+        self.groups_by_name = groups_by_name
+
+        # Bitmask of the devices granting access to each unscheduled group
+        self._device_mask_by_group = dict(
+                (group_name, 0) for group_name in groups_by_name)
+        self._device_count = 0
+        self._device_names = []
+
+        # Bit numbers of the scheduled groups, and the bitmask of scheduled
+        # groups allowed by each device (indexed by the device's bit)
+        self._scheduled_group_bits = {}
+        for group_name in sorted(groups_by_name):
+            if groups_by_name[group_name].schedule is not None:
+                self._scheduled_group_bits[group_name] = \
+                        len(self._scheduled_group_bits)
+        self._scheduled_group_mask_by_device = []
+
+        self._device_mask_by_card = {}
+        self._scheduled_group_mask_by_card = {}
+        self._rebuild_lock = threading.Lock()
+
+        # The load_count of each of the groups' card databases when the
+        # index was last built
+        self._load_counts = {}
+
+        # (bitmask of open scheduled groups, time.time() to re-check it at).
+        # Replaced as a whole, so that readers always see a matching pair
+        self._open_groups = (0, 0.0)
+
+        for group in groups_by_name.values():
+            for card_database in group.card_databases:
+                card_database.listeners.append(self.cards_changed)
+
+    # Register a device, and the groups it grants access to. Returns the
+    # device's bit number
+    def add_device(self, device_name, group_names):
+        bit = self._device_count
+        self._device_count += 1
+        self._device_names.append(device_name)
+        scheduled_group_mask = 0
+        for group_name in group_names:
+            if group_name not in self.groups_by_name:
+                assert False, "Device %s - unknown access group '%s'" \
+                        % (device_name, group_name)
+            if group_name in self._scheduled_group_bits:
+                scheduled_group_mask |= \
+                        1 << self._scheduled_group_bits[group_name]
+            else:
+                self._device_mask_by_group[group_name] |= 1 << bit
+        self._scheduled_group_mask_by_device.append(scheduled_group_mask)
+        return bit
+
+    # Can this card open the device with this bit number?
+    def allows(self, card, device_bit):
+        self.reload_if_changed()
+        if self._device_mask_by_card.get(card, 0) & (1 << device_bit):
+            return True
+        group_mask = self._scheduled_group_mask_by_card.get(card, 0) \
+                & self._scheduled_group_mask_by_device[device_bit]
+        return bool(group_mask and group_mask & self.open_group_mask())
+
+    # Bitmask of the scheduled groups that are open right now
+    def open_group_mask(self, now=None):
+        if now is None:
+            now = time.time()
+        mask, refresh_at = self._open_groups
+        if now >= refresh_at:
+            mask = self._refresh_open_groups(now)
+        return mask
+
+    # Work out which scheduled groups are open at 'now', and when that
+    # might next change
+    def _refresh_open_groups(self, now):
+        local_now = time.localtime(now)
+        mask = 0
+        refresh_in = self.max_schedule_refresh
+        for group_name, group_bit in self._scheduled_group_bits.items():
+            schedule = self.groups_by_name[group_name].schedule
+            if schedule.is_open(local_now):
+                mask |= 1 << group_bit
+            refresh_in = min(refresh_in,
+                    schedule.seconds_until_change(local_now))
+
+        if mask != self._open_groups[0]:
+            logging.info("Scheduled groups now open: %s", ' '.join(
+                    sorted(group_name for group_name, group_bit
+                        in self._scheduled_group_bits.items()
+                        if mask & (1 << group_bit))) or '(none)')
+        self._open_groups = (mask, now + max(refresh_in, 1))
+        return mask
+
+    # Rebuild the index if any of the groups' ACL files have been reloaded
+    # since it was built. Only one thread rebuilds it - any others carry on
+    # using the current one
+    def reload_if_changed(self):
+        if not self._rebuild_lock.acquire(blocking=False):
+            return False
+        try:
+            changed = False
+            for group in self.groups_by_name.values():
+                for card_database in group.card_databases:
+                    card_database.reload_if_changed()
+                    if card_database.load_count \
+                            != self._load_counts.get(card_database):
+                        changed = True
+            if changed:
+                self.build()
+            return changed
+        finally:
+            self._rebuild_lock.release()
+
+    # Stop following changes to the groups' ACL files, when this index is
+    # no longer used
+    def close(self):
+        for group in self.groups_by_name.values():
+            for card_database in group.card_databases:
+                if self.cards_changed in card_database.listeners:
+                    card_database.listeners.remove(self.cards_changed)
+
+    # Called when a delta changes some of the groups' cards. Each changed
+    # card's bitmasks are worked out again from the groups it's now in, and
+    # its entries in the current dictionaries are replaced in place (so
+    # lookups see either the old or the new bitmask). 'cards' is None if
+    # everything may have changed
+    def cards_changed(self, cards):
+        with self._rebuild_lock:
+            if cards is None:
+                self.build()
+                return
+            for card in cards:
+                device_mask = 0
+                scheduled_group_mask = 0
+                for group_name, group in self.groups_by_name.items():
+                    if card not in group:
+                        continue
+                    if group_name in self._scheduled_group_bits:
+                        scheduled_group_mask |= \
+                                1 << self._scheduled_group_bits[group_name]
+                    else:
+                        device_mask |= self._device_mask_by_group[group_name]
+                _set_or_remove(self._device_mask_by_card, card, device_mask)
+                _set_or_remove(self._scheduled_group_mask_by_card, card,
+                        scheduled_group_mask)
+
+    # Compile the groups into the card -> device bitmask dictionary. This is
+    # called once all of the devices have been added, and again whenever
+    # the groups' ACL files change
+    def build(self):
+        started = time.monotonic()
+        self._load_counts = dict(
+                (card_database, card_database.load_count)
+                for group in self.groups_by_name.values()
+                for card_database in group.card_databases)
+        device_mask_by_card = {}
+        scheduled_group_mask_by_card = {}
+        used_scheduled_groups = 0
+        for mask in self._scheduled_group_mask_by_device:
+            used_scheduled_groups |= mask
+
+        for group_name, group in self.groups_by_name.items():
+            if group_name in self._scheduled_group_bits:
+                group_mask = 1 << self._scheduled_group_bits[group_name]
+                if not group_mask & used_scheduled_groups:
+                    continue
+                for card in group:
+                    scheduled_group_mask_by_card[card] = \
+                            scheduled_group_mask_by_card.get(card, 0) \
+                            | group_mask
+                continue
+
+            device_mask = self._device_mask_by_group[group_name]
+            if not device_mask:
+                continue
+            for card in group:
+                device_mask_by_card[card] = \
+                        device_mask_by_card.get(card, 0) | device_mask
+
+        self._device_mask_by_card = device_mask_by_card
+        self._scheduled_group_mask_by_card = scheduled_group_mask_by_card
+        logging.info("Built access index: %d cards (%d with scheduled "
+                "access), %d groups (%d scheduled), %d devices in %.3fs",
+                len(device_mask_by_card), len(scheduled_group_mask_by_card),
+                len(self.groups_by_name), len(self._scheduled_group_bits),
+                self._device_count, time.monotonic() - started)
+
+
+    # Write the index to 'filename' as a compiled access index (see
+    # CompiledAccessIndex). Returns the number of cards written
+    def write_compiled(self, filename):
+        with self._rebuild_lock:
+            device_mask_by_card = dict(self._device_mask_by_card)
+            scheduled_group_mask_by_card = \
+                    dict(self._scheduled_group_mask_by_card)
+        return write_compiled_access_index(filename,
+                [(name, bit, self._scheduled_group_mask_by_device[bit])
+                    for bit, name in enumerate(self._device_names)],
+                sorted(self._scheduled_group_bits,
+                    key=self._scheduled_group_bits.get),
+                device_mask_by_card, scheduled_group_mask_by_card)
+
+
+def _set_or_remove(mask_by_card, card, mask):
+    if mask:
+        mask_by_card[card] = mask
+    else:
+        mask_by_card.pop(card, None)
+
+
+###############################################################################
+# Class - CompiledAccessIndex
+###############################################################################
+
+# A compiled access index holds the same information as an AccessIndex, in
+# a file that is memory-mapped rather than loaded into Python objects. With
+# --supervise, the supervisor builds the AccessIndex for every device using
+# groups, and writes it to the shared ACL directory whenever the groups'
+# ACL files change. The workers look cards up in the shared file, so the
+# index is only held in memory once, however many workers there are.
+#
+# The file starts with a header:
+#
+#   magic (4 bytes, 'RPAI'), format version (1 byte), card record width (1
+#   byte), device bitmask width (1 byte), scheduled group bitmask width (1
+#   byte), number of records (4 bytes), length of the names (4 bytes), all
+#   big-endian
+#
+# followed by the names: JSON, listing each device's name, bit number and
+# bitmask of the scheduled groups it allows, and the scheduled groups' names
+# in bit order. Then come the records, sorted by card: the card, as in a
+# compiled card database (see card_database.CompiledCardDatabase), then its
+# device bitmask and its scheduled group bitmask.
+#
+# Devices are looked up by name in the file each time, rather than given a
+# bit number when they are set up, as the bit numbers in the file can change
+# when the supervisor's config is reloaded. A device that isn't in the file
+# (e.g. the supervisor hasn't yet caught up with a config change) opens to
+# no-one. Which scheduled groups are open is still worked out by each
+# worker, from its own [Schedule ...] sections.
+class CompiledAccessIndex(AccessIndex):
+
+    def __init__(self, filename, groups_by_name):
+        """Compiled Access Index Constructor"""
+        self.filename = filename
+        self.groups_by_name = groups_by_name
+        self._scheduled_group_bits = {}
+        self._open_groups = (0, 0.0)
+        self._rebuild_lock = threading.Lock()
+
+        # (records, device (bit, scheduled group mask) by name), replaced as
+        # a whole when the file changes
+        self._index = (None, {})
+        self._file_signature = None
+        self._rejected_signature = None
+        self._closed = False
+        self.reload_if_changed()
+
+    # The device's name is used in place of its bit number
+    def add_device(self, device_name, group_names):
+        for group_name in group_names:
+            if group_name not in self.groups_by_name:
+                assert False, "Device %s - unknown access group '%s'" \
+                        % (device_name, group_name)
+        if device_name not in self._index[1]:
+            logging.error("Device %s isn't in the shared access index %s - "
+                    "its groups can't open it until it is", device_name,
+                    self.filename)
+        return device_name
+
+    def allows(self, card, device_name):
+        self.reload_if_changed()
+        records, devices = self._index
+        if records is None or device_name not in devices:
+            return False
+        device_bit, device_group_mask = devices[device_name]
+        device_mask, scheduled_group_mask = records.lookup(card)
+        if device_mask & (1 << device_bit):
+            return True
+        group_mask = scheduled_group_mask & device_group_mask
+        return bool(group_mask and group_mask & self.open_group_mask())
+
+    # Map the file again if the supervisor has replaced it. If it can't be
+    # read, the last good copy is used
+    def reload_if_changed(self):
+        if not self._rebuild_lock.acquire(blocking=False):
+            return False
+        try:
+            if self._closed:
+                return False
+            try:
+                st = os.stat(self.filename)
+                signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                logging.error("Can't stat shared access index %s (%s) - "
+                        "using last good copy", self.filename, e)
+                return False
+            if signature in (self._file_signature,
+                        self._rejected_signature):
+                return False
+            try:
+                records, devices, group_names = \
+                        read_compiled_access_index(self.filename)
+            except (OSError, ValueError) as e:
+                logging.error("Can't load shared access index %s (%s) - "
+                        "using last good copy", self.filename, e)
+                self._rejected_signature = signature
+                return False
+
+            self._scheduled_group_bits = dict(
+                    (name, bit) for bit, name in enumerate(group_names)
+                    if name in self.groups_by_name
+                        and self.groups_by_name[name].schedule is not None)
+            self._open_groups = (0, 0.0)
+            self._index = (records, devices)
+            self._file_signature = signature
+            logging.info("Mapped shared access index %s: %d cards, %d "
+                    "devices", self.filename, len(records), len(devices))
+            return True
+        finally:
+            self._rebuild_lock.release()
+
+    def build(self):
+        pass
+
+    # Stop mapping the file again when it changes, and drop the current
+    # mapping. It is unmapped once any lookup using it has finished
+    def close(self):
+        with self._rebuild_lock:
+            self._closed = True
+            self._index = (None, {})
+
+
+compiled_access_index_magic = b'RPAI'
+compiled_access_index_version = 1
+_access_index_header = struct.Struct('>4sBBBBII')
+
+# The compiled access index shared by the supervisor in 'index_dir'
+def shared_access_index_filename(index_dir):
+    return os.path.join(index_dir, 'access-index.rpai')
+
+
+# Write a compiled access index. 'devices' is a list of (name, bit number,
+# scheduled group mask), and 'scheduled_group_names' the scheduled groups in
+# bit order
+def write_compiled_access_index(filename, devices, scheduled_group_names,
+            device_mask_by_card, scheduled_group_mask_by_card):
+    cards = set(device_mask_by_card) | set(scheduled_group_mask_by_card)
+    card_width = 1 + max([len(card) for card in cards] + [1])
+    if card_width > 255:
+        raise ValueError("card ID too long to compile")
+    device_mask_width = max(1, (len(devices) + 7) // 8)
+    group_mask_width = max(1, (len(scheduled_group_names) + 7) // 8)
+    if max(device_mask_width, group_mask_width) > 255:
+        raise ValueError("too many devices or scheduled groups to compile")
+
+    names = json.dumps({'devices': devices,
+            'scheduled groups': scheduled_group_names}).encode()
+    records = sorted(_card_record(card, card_width)
+            + device_mask_by_card.get(card, 0).to_bytes(
+                device_mask_width, 'big')
+            + scheduled_group_mask_by_card.get(card, 0).to_bytes(
+                group_mask_width, 'big')
+            for card in cards)
+    write_file_atomically(filename, _access_index_header.pack(
+            compiled_access_index_magic, compiled_access_index_version,
+            card_width, device_mask_width, group_mask_width, len(records),
+            len(names)) + names + b''.join(records))
+    return len(records)
+
+
+# Map a compiled access index. Returns the records, the (bit, scheduled
+# group mask) of each device by name, and the scheduled groups' names
+def read_compiled_access_index(filename):
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("file is empty")
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapping) < _access_index_header.size:
+        raise ValueError("file is too short for a header")
+    magic, version, card_width, device_mask_width, group_mask_width, \
+            count, names_length = _access_index_header.unpack_from(mapping, 0)
+    if magic != compiled_access_index_magic:
+        raise ValueError("not a compiled access index")
+    if version != compiled_access_index_version:
+        raise ValueError("unsupported format version %d" % version)
+    if card_width < 2:
+        raise ValueError("invalid card record width %d" % card_width)
+    offset = _access_index_header.size + names_length
+    width = card_width + device_mask_width + group_mask_width
+    if len(mapping) != offset + count * width:
+        raise ValueError("file size doesn't match the header")
+    names = json.loads(mapping[_access_index_header.size:offset].decode())
+    devices = dict((name, (bit, group_mask))
+            for name, bit, group_mask in names['devices'])
+    return _CompiledAccessRecords(mapping, offset, count, card_width,
+            device_mask_width, group_mask_width), devices, \
+            names['scheduled groups']
+
+
+# Read-only view of the records of a memory-mapped compiled access index.
+# Indexing it gives each record's card, for searching with bisect
+class _CompiledAccessRecords:
+
+    def __init__(self, mapping, offset, count, card_width, device_mask_width,
+                group_mask_width):
+        self.mapping = mapping
+        self.offset = offset
+        self.count = count
+        self.card_width = card_width
+        self.device_mask_width = device_mask_width
+        self.width = card_width + device_mask_width + group_mask_width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.width
+        return self.mapping[start:start + self.card_width]
+
+    # The (device mask, scheduled group mask) of a card, both 0 if it isn't
+    # in the index
+    def lookup(self, card):
+        if len(card) > self.card_width - 1:
+            return 0, 0
+        record = _card_record(card, self.card_width)
+        i = bisect.bisect_left(self, record)
+        if i >= self.count or self[i] != record:
+            return 0, 0
+        start = self.offset + i * self.width + self.card_width
+        middle = start + self.device_mask_width
+        end = self.offset + (i + 1) * self.width
+        return int.from_bytes(self.mapping[start:middle], 'big'), \
+                int.from_bytes(self.mapping[middle:end], 'big')
@@ -0,0 +1,127 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import bisect
+import re
+import time
+
+###############################################################################
+# Class - AccessSchedule
+###############################################################################
+
+# An 'Access Schedule' is a set of times during which a group of cards is
+# allowed access, declared in a [Schedule <name>] section of the config file
+# and used by a group's 'schedule' parameter. For example:
+#
+#   weekly       = Mon-Fri 07:00-19:00, Sat 09:00-13:00
+#   closed dates = 2026-12-25 2026-12-26
+#
+# Times are local time. A window that ends before it starts (e.g.
+# 'Fri 22:00-02:00') runs on into the next day. On a closed date, the
+# schedule is closed all day.
+#
+# The weekly windows are compiled into a table with one entry per minute of
+# the week, plus a sorted list of the minutes at which the schedule opens or
+# closes. So checking whether the schedule is open, and working out when
+# that will next change, is a table lookup and a binary search.
+
+minutes_per_day = 24 * 60
+minutes_per_week = 7 * minutes_per_day
+
+day_numbers = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5,
+            'sun': 6}
+
+
+class AccessSchedule:
+    name = 'NOT DEFINED'
+
+    def __init__(self, config):
+        """Access Schedule Constructor"""
+        self.open_minutes = bytearray(minutes_per_week)
+        self.closed_dates = frozenset()
+
+        for o, a in config:
+            if o == 'weekly':
+                for window in a.split(','):
+                    self._add_window(window.strip())
+            elif o == 'closed dates':
+                dates = a.split()
+                for date in dates:
+                    if not re.match(r'^\d{4}-\d\d-\d\d$', date):
+                        assert False, "Closed dates must be YYYY-MM-DD, " \
+                            "separated by spaces (is '%s')" % a
+                self.closed_dates = frozenset(dates)
+            else:
+                assert False, "Unsupported parameter '%s' for Schedule" % o
+
+        # The minutes of the week at which the schedule opens or closes
+        self.change_minutes = [m for m in range(minutes_per_week)
+                if self.open_minutes[m] != self.open_minutes[m - 1]]
+
+    # Add a window like 'Mon-Fri 07:00-19:00' or 'Sat 09:00-13:00'
+    def _add_window(self, window):
+        m = re.match(r'^(\w{3})(?:-(\w{3}))?\s+(\d\d):(\d\d)-(\d\d):(\d\d)$',
+                window)
+        if not m or m.group(1).lower() not in day_numbers \
+                or (m.group(2) and m.group(2).lower() not in day_numbers):
+            assert False, "Schedule window must be like " \
+                "'Mon-Fri 07:00-19:00' (is '%s')" % window
+
+        first_day = day_numbers[m.group(1).lower()]
+        last_day = day_numbers[(m.group(2) or m.group(1)).lower()]
+        start = int(m.group(3)) * 60 + int(m.group(4))
+        end = int(m.group(5)) * 60 + int(m.group(6))
+        if start >= minutes_per_day or end > minutes_per_day \
+                or int(m.group(4)) >= 60 or int(m.group(6)) >= 60:
+            assert False, "Invalid time in schedule window '%s'" % window
+        if end <= start:
+            end += minutes_per_day
+
+        day = first_day
+        while True:
+            for minute in range(start, end):
+                self.open_minutes[
+                        (day * minutes_per_day + minute) % minutes_per_week] = 1
+            if day == last_day:
+                break
+            day = (day + 1) % 7
+
+    # Is the schedule open at 'now' (a time.localtime() struct)?
+    def is_open(self, now):
+        if time.strftime('%Y-%m-%d', now) in self.closed_dates:
+            return False
+        return bool(self.open_minutes[_minute_of_week(now)])
+
+    # How many seconds from 'now' (a time.localtime() struct) until the
+    # schedule might next open or close. Midnight always counts, since the
+    # next day might be a closed date
+    def seconds_until_change(self, now):
+        minute = _minute_of_week(now)
+        until_midnight = minutes_per_day - minute % minutes_per_day
+        until_change = until_midnight
+        if self.change_minutes:
+            i = bisect.bisect_right(self.change_minutes, minute)
+            if i < len(self.change_minutes):
+                next_change = self.change_minutes[i]
+            else:
+                next_change = self.change_minutes[0] + minutes_per_week
+            until_change = min(until_change, next_change - minute)
+        return until_change * 60 - now.tm_sec
+
+
+def _minute_of_week(now):
+    return now.tm_wday * minutes_per_day + now.tm_hour * 60 + now.tm_min
@@ -0,0 +1,191 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# ACL sync: keeping ACL files up to date from a central source
+###############################################################################
+
+# Rather than copying whole ACL files to every Pi whenever a card is added or
+# revoked, a central source publishes numbered changes ('deltas') for each
+# ACL file, which rpac fetches and applies as they appear (see CardDatabase
+# in card_database.py for how they're applied and journalled).
+#
+# The source is either a directory (which the central system copies files
+# into) or an http(s) URL. For each ACL file (named as in rpac.conf,
+# relative to the access control files path), the source has:
+#
+#   <file>.delta      The recent changes, one per line, numbered from 1 up
+#                     (see parse_delta_lines in card_database.py). Old
+#                     changes can be dropped from the start of the file
+#   <file>            A snapshot of the cards as of ...
+#   <file>.version    ... this change number
+#
+# Normally only the delta file is fetched, and only if it has changed since
+# the last fetch. The snapshot is only fetched when our version can't be
+# brought up to date from the deltas - for example, when we've been offline
+# for longer than the source keeps deltas for.
+
+# System-Wide packages
+import logging
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Local Packages
+from card_database import parse_delta_lines
+
+delta_suffix = '.delta'
+
+
+###############################################################################
+# Class - AclSync
+###############################################################################
+
+# Fetches and applies deltas every 'interval' seconds, and whenever asked to
+# with request_sync() (e.g. from a signal handler, after the central system
+# has pushed new files).
+#
+# 'find_card_databases' is called before each sync, and returns the card
+# databases to sync by name (see card_databases_to_sync), so that the ACL
+# files added or removed by reloading the config are picked up
+class AclSync(threading.Thread):
+
+    # How long to wait for an http source to answer, in seconds
+    http_timeout = 10.0
+
+    def __init__(self, source, find_card_databases, interval=None):
+        """ACL Sync Constructor"""
+        threading.Thread.__init__(self, name="acl-sync", daemon=True)
+        self.source = source
+        self.find_card_databases = find_card_databases
+        self.interval = interval
+        self._wakeup = threading.Event()
+
+        # What the source told us about each delta file when we last
+        # fetched it, so we don't fetch or parse it again until it changes
+        self._delta_validators = {}
+
+    def request_sync(self):
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self.sync_all()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def sync_all(self):
+        card_databases_by_name = self.find_card_databases()
+        for name in list(self._delta_validators):
+            if name not in card_databases_by_name:
+                del self._delta_validators[name]
+        for name in sorted(card_databases_by_name):
+            try:
+                self.sync(name, card_databases_by_name[name])
+            except (OSError, ValueError) as e:
+                logging.error("Can't sync ACL file %s from %s (%s)",
+                        name, self.source, e)
+
+    # Bring one ACL file up to date. Returns the number of changes applied
+    def sync(self, name, card_database):
+        contents, validator = self._fetch(name + delta_suffix,
+                self._delta_validators.get(name))
+        if contents is None:
+            return 0
+        entries = parse_delta_lines(contents.decode().splitlines())
+
+        try:
+            applied = self._apply(card_database, entries)
+        except ValueError as e:
+            logging.warning("ACL file %s is at version %d, which the source's "
+                    "changes don't follow on from (%s) - fetching a snapshot",
+                    name, card_database.version, e)
+            self._install_snapshot(name, card_database)
+            applied = self._apply(card_database, entries)
+
+        self._delta_validators[name] = validator
+        return applied
+
+    # If we're ahead of the source, it must have started again, and our
+    # version no longer means the same as its one
+    def _apply(self, card_database, entries):
+        if entries and entries[-1][0] < card_database.version:
+            raise ValueError("source is at version %d" % entries[-1][0])
+        return card_database.apply_delta(entries)
+
+    def _install_snapshot(self, name, card_database):
+        version_text, validator = self._fetch(
+                name + card_database.version_suffix)
+        contents, validator = self._fetch(name)
+        if version_text is None or contents is None:
+            raise ValueError("source has no snapshot")
+        version = int(version_text.decode().strip())
+        card_database.install_snapshot(contents, version)
+        logging.info("Installed snapshot of ACL file %s at version %d",
+                name, version)
+
+    # Fetch a file from the source. Returns (contents, validator), where the
+    # contents are None if the file doesn't exist or hasn't changed since
+    # the fetch that returned 'validator'
+    def _fetch(self, name, validator=None):
+        if urllib.parse.urlsplit(self.source).scheme in ('http', 'https'):
+            return self._fetch_url(name, validator)
+        return self._fetch_file(name, validator)
+
+    def _fetch_file(self, name, validator):
+        filename = os.path.join(self.source, name)
+        try:
+            with open(filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                new_validator = (st.st_ino, st.st_size, st.st_mtime_ns)
+                if new_validator == validator:
+                    return None, validator
+                return f.read(), new_validator
+        except FileNotFoundError:
+            return None, None
+
+    def _fetch_url(self, name, validator):
+        request = urllib.request.Request(self.source.rstrip('/') + '/'
+                + urllib.parse.quote(name))
+        if validator is not None:
+            etag, last_modified = validator
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+        try:
+            with urllib.request.urlopen(request,
+                        timeout=self.http_timeout) as response:
+                return response.read(), (response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, validator
+            if e.code == 404:
+                return None, None
+            raise
+
+
+# The card databases to sync, by their name relative to the access control
+# files path
+def card_databases_to_sync(acl_path, card_databases):
+    by_name = {}
+    for card_database in card_databases:
+        name = os.path.relpath(card_database.filename, acl_path)
+        by_name[name] = card_database
+    return by_name
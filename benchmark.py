@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# OVERVIEW
+###############################################################################
+#
+# Benchmarks rpac against simulated hardware, so that it can be run on any
+# Linux machine, not just a Pi. The real config parsing, reader, device and
+# event loop code is used - only the GPIO pins and the i2c bus are simulated
+# (see simulated_gpio.py, simulated_i2c.py and simulated_site.py).
+#
+# There are three benchmarks:
+#
+#   latency     - time from a card being presented to the relay being set,
+#                 and from the card being removed to the relay being reset,
+#                 for a single reader
+#
+#   throughput  - swipes per second when N readers are all being used as
+#                 fast as possible, for each dispatch mode
+#
+#   acl         - time to load, and look cards up in, text and compiled ACL
+#                 files of various sizes, and the memory they take up
+#
+# The results are written as JSON, so that they can be compared between
+# versions of the code.
+#
+
+# System-Wide imports
+import getopt
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Local packages
+import hardware
+hardware.use_backend('simulated')
+
+import card_database
+import config
+import latency_trace
+import rpac_logging
+import simulated_site
+
+# Bump this if the results change in a way that makes them incomparable with
+# earlier ones
+benchmark_format_version = 1
+
+
+# Displays help on how to use this program
+def usage(extra_message=None):
+    if extra_message:
+        print("\nERROR: %s" % extra_message)
+    print("""
+Usage: benchmark.py [options] [latency] [throughput] [acl]
+
+Runs all three benchmarks if none are named.
+
+Options:
+    --output=FILE              Write JSON results here (default: stdout)
+    --swipes=N                 Swipes for the latency benchmark (200)
+    --readers=N,N,...          Reader counts for throughput (1,4,8)
+    --duration=SECONDS         Length of each throughput run (5)
+    --dispatch=MODE,MODE,...   Dispatch modes for throughput
+                               (serial,threaded)
+    --acl-sizes=N,N,...        ACL sizes (1000,10000,100000,1000000)
+    --lookups=N                Lookups per ACL size and format (20000)
+    --sl030-response-ms=MS     Simulated SL030 response time (20)
+    --sl030-error-rate=RATE    Proportion of failed i2c transactions (0)
+    --log=FILE                 Log to FILE, as rpac.py does (default: off)
+""")
+    sys.exit(2)
+
+
+def parse_number_list(text, convert=int):
+    try:
+        return [convert(x) for x in text.split(',')]
+    except ValueError:
+        usage("'%s' is not a comma-separated list of numbers" % text)
+
+
+def parse_command_line_arguments():
+    options = {
+        'output': None,
+        'swipes': 200,
+        'readers': [1, 4, 8],
+        'duration': 5.0,
+        'dispatch': ['serial', 'threaded'],
+        'acl sizes': [1000, 10000, 100000, 1000000],
+        'lookups': 20000,
+        'sl030 response ms': 20.0,
+        'sl030 error rate': 0.0,
+        'log': None,
+    }
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "output=",
+                "swipes=", "readers=", "duration=", "dispatch=", "acl-sizes=",
+                "lookups=", "sl030-response-ms=", "sl030-error-rate=",
+                "log="])
+    except getopt.GetoptError as err:
+        usage(str(err))
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o in ("--output", "--log"):
+            options[o[2:]] = a
+        elif o == "--dispatch":
+            options['dispatch'] = a.split(',')
+        elif o in ("--readers", "--acl-sizes"):
+            options[o[2:].replace('-', ' ')] = parse_number_list(a)
+        elif o in ("--swipes", "--lookups"):
+            options[o[2:]] = parse_number_list(a)[0]
+        elif o in ("--duration", "--sl030-response-ms", "--sl030-error-rate"):
+            options[o[2:].replace('-', ' ')] = \
+                    parse_number_list(a, float)[0]
+        else:
+            assert False, "Unhandled option"
+
+    for benchmark in args:
+        if benchmark not in benchmarks:
+            usage("Unknown benchmark '%s'" % benchmark)
+    options['benchmarks'] = args or list(benchmarks)
+    return options
+
+
+def summarise(durations):
+    durations = [d for d in durations if d is not None]
+    histogram = latency_trace.LatencyHistogram(max(1, len(durations)))
+    for duration in durations:
+        histogram.add(duration)
+    (p50, p95, p99), maximum = histogram.percentiles(50, 95, 99)
+    return {'count': len(durations), 'p50': p50, 'p95': p95, 'p99': p99,
+            'max': maximum}
+
+
+def random_cards(count, rng):
+    # Mifare cards have 4 or 7 byte IDs
+    return [bytes(rng.getrandbits(8) for i in range(rng.choice((4, 7))))
+            for n in range(count)]
+
+
+def write_text_acl(filename, cards):
+    with open(filename, 'w') as f:
+        for card in cards:
+            f.write(card.hex().upper() + '\n')
+
+
+# Build a simulated site with reader_count readers, all allowing the cards
+# in 'cards'
+def build_site(work_dir, reader_count, cards, options):
+    write_text_acl(os.path.join(work_dir, 'bench.carddb'), cards)
+    config_filename = os.path.join(work_dir, 'bench-%d.conf' % reader_count)
+    simulated_site.write_site_config(config_filename, work_dir,
+            'bench.carddb', reader_count)
+    acl_path, readers_by_name, devices_by_name = \
+            config.parse_config_options(config_filename)
+    return simulated_site.SimulatedSite(readers_by_name, devices_by_name, {
+        'response_time': options['sl030 response ms'] / 1000.0,
+        'response_jitter': options['sl030 response ms'] / 4000.0,
+        'error_rate': options['sl030 error rate'],
+        'seed': 1,
+    })
+
+
+def benchmark_latency(work_dir, options):
+    rng = random.Random(1)
+    cards = random_cards(1000, rng)
+    site = build_site(work_dir, 1, cards, options)
+    site.start('serial')
+    try:
+        unlock_times = []
+        lock_times = []
+        failures = 0
+        for n in range(options['swipes']):
+            enabled, unlock_time, lock_time = \
+                    site.swipe('reader_0', rng.choice(cards))
+            if not enabled:
+                failures += 1
+            unlock_times.append(unlock_time)
+            lock_times.append(lock_time)
+    finally:
+        site.stop()
+
+    return {
+        'swipes': options['swipes'],
+        'failed swipes': failures,
+        'swipe to unlock': summarise(unlock_times),
+        'removal to lock': summarise(lock_times),
+        'stages': site.readers_by_name['reader_0'].swipe_latency.summary(),
+    }
+
+
+def benchmark_throughput(work_dir, options):
+    results = []
+    for reader_count in options['readers']:
+        for dispatch_mode in options['dispatch']:
+            results.append(_throughput_run(work_dir, reader_count,
+                    dispatch_mode, options))
+    return results
+
+
+def _throughput_run(work_dir, reader_count, dispatch_mode, options):
+    rng = random.Random(1)
+    cards = random_cards(1000, rng)
+    site = build_site(work_dir, reader_count, cards, options)
+    site.start(dispatch_mode)
+
+    # One thread per reader, each swiping cards as fast as it can
+    unlock_times = []
+    counts = {'swipes': 0, 'failed swipes': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + options['duration']
+
+    def swipe_until_deadline(reader_name, seed):
+        thread_rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            enabled, unlock_time, lock_time = \
+                    site.swipe(reader_name, thread_rng.choice(cards))
+            with lock:
+                counts['swipes'] += 1
+                if not enabled:
+                    counts['failed swipes'] += 1
+                unlock_times.append(unlock_time)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=swipe_until_deadline, args=(name, n))
+            for n, name in enumerate(sorted(site.readers_by_name))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    site.stop()
+
+    return {
+        'readers': reader_count,
+        'dispatch': dispatch_mode,
+        'seconds': elapsed,
+        'swipes': counts['swipes'],
+        'failed swipes': counts['failed swipes'],
+        'swipes per second': counts['swipes'] / elapsed,
+        'swipe to unlock': summarise(unlock_times),
+    }
+
+
+def benchmark_acl(work_dir, options):
+    results = []
+    for size in options['acl sizes']:
+        rng = random.Random(size)
+        cards = random_cards(size, rng)
+        text_filename = os.path.join(work_dir, 'acl-%d.carddb' % size)
+        compiled_filename = os.path.join(work_dir, 'acl-%d%s' % (
+                size, card_database.compiled_card_db_suffix))
+        write_text_acl(text_filename, cards)
+        card_database.write_compiled_card_database(cards, compiled_filename)
+
+        hits = [rng.choice(cards) for n in range(options['lookups'])]
+        misses = random_cards(options['lookups'], rng)
+
+        for format_name, filename, db_class in (
+                ('text', text_filename, card_database.CardDatabase),
+                ('compiled', compiled_filename,
+                        card_database.CompiledCardDatabase)):
+            started = time.perf_counter()
+            db = db_class(filename)
+            load_time = time.perf_counter() - started
+            assert len(db) == len(set(cards)), "ACL didn't load"
+
+            results.append({
+                'cards': size,
+                'format': format_name,
+                'file bytes': os.path.getsize(filename),
+                'load seconds': load_time,
+                'memory bytes': _memory_used_loading(db_class, filename),
+                'hit lookup seconds': _time_lookups(db, hits),
+                'miss lookup seconds': _time_lookups(db, misses),
+            })
+            del db
+        os.unlink(text_filename)
+        os.unlink(compiled_filename)
+    return results
+
+
+# Average time to look up each card, including the check for the file
+# having changed, as on a real card presentation
+def _time_lookups(db, cards):
+    started = time.perf_counter()
+    for card in cards:
+        card in db
+    return (time.perf_counter() - started) / len(cards)
+
+
+def _memory_used_loading(db_class, filename):
+    tracemalloc.start()
+    try:
+        db = db_class(filename)
+        used, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return used
+
+
+benchmarks = {
+    'latency': benchmark_latency,
+    'throughput': benchmark_throughput,
+    'acl': benchmark_acl,
+}
+
+
+def main():
+    options = parse_command_line_arguments()
+
+    results = {
+        'format version': benchmark_format_version,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'options': dict((k, v) for k, v in options.items()
+                if k not in ('output', 'log')),
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix='rpac-benchmark-') as work_dir:
+        if options['log']:
+            rpac_logging.configure_logging(options['log'],
+                    options['log'] + '.audit')
+        for name in options['benchmarks']:
+            print("Running %s benchmark" % name, file=sys.stderr)
+            results['results'][name] = benchmarks[name](work_dir, options)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import time
+
+# Local Packages
+import metrics
+
+###############################################################################
+# Class - CardDatabase
+###############################################################################
+
+# A 'Card Database' is the in-memory copy of one access control file. The
+# file contains one card ID (as hex) per line. Card IDs are held as the raw
+# bytes read from the card, so that the reader doesn't have to format them
+# before looking them up.
+#
+# Card presentations are on the door-open path, so we don't want to re-read
+# the file every time a card is presented. Instead we keep the cards in a
+# hashed set and only re-read the file when it has actually changed (the
+# inode, size or modification time differ from when we last loaded it).
+#
+# If the new file can't be read, or looks like it is still being written,
+# we keep using the last good set of cards and try again on the next
+# presentation.
+#
+# The file can also be kept up to date with deltas - numbered 'add card' and
+# 'remove card' changes (see acl_sync.py). The file is a snapshot of the
+# cards as of a version number, held in '<file>.version', and the deltas
+# applied since are appended to '<file>.journal'. Loading the file replays
+# the journal on top of it. In memory, the deltas are a small dictionary of
+# card -> added (True) or removed (False) looked at before the snapshot's
+# cards, so applying one doesn't mean re-reading or copying the snapshot.
+# Once the journal gets long, it is folded into a new snapshot.
+class CardDatabase:
+
+    # A file whose last line is unterminated (or which is empty) is treated
+    # as being part-way through being written, unless it hasn't been touched
+    # for this many seconds
+    settle_time = 2.0
+
+    # Write a new snapshot once this many cards have changed since the last
+    compact_after = 1000
+
+    version_suffix = '.version'
+    journal_suffix = '.journal'
+
+    def __init__(self, filename):
+        """Card Database Constructor"""
+        self.filename = filename
+
+        # The set is only ever replaced as a whole, never modified in
+        # place, so anyone holding a reference to it sees a consistent view.
+        # The same goes for the deltas applied on top of it
+        self.authorised_cards = frozenset()
+        self._delta = {}
+
+        # The version of the snapshot file, and of the last delta applied
+        self.snapshot_version = 0
+        self.version = 0
+
+        # How many times a set of cards has been loaded from the file. Only
+        # the first caller of reload_if_changed after a change is told about
+        # it, so anything else that depends on the cards (see AccessIndex)
+        # compares this instead
+        self.load_count = 0
+
+        # Called with the set of cards whose access has changed whenever a
+        # delta is applied, or with None when a new snapshot is installed
+        # (but not when someone else changes the file)
+        self.listeners = []
+
+        # (inode, size, mtime) of the file the current set was loaded from,
+        # and of the last version of the file that we rejected
+        self._file_signature = None
+        self._rejected_signature = None
+
+        self.reload_if_changed()
+
+    def __contains__(self, card):
+        self.reload_if_changed()
+        return self.contains(card)
+
+    # Look a card up without checking whether the file has changed
+    def contains(self, card):
+        added = self._delta.get(card)
+        if added is None:
+            return card in self.authorised_cards
+        return added
+
+    def __len__(self):
+        count = len(self.authorised_cards)
+        for card, added in self._delta.items():
+            if added != (card in self.authorised_cards):
+                count += 1 if added else -1
+        return count
+
+    def __iter__(self):
+        authorised_cards, delta = self.authorised_cards, self._delta
+        for card in authorised_cards:
+            if delta.get(card, True):
+                yield card
+        for card, added in delta.items():
+            if added and card not in authorised_cards:
+                yield card
+
+    # Check whether the file has changed since we last loaded it, and if
+    # so re-read it. Returns True if a new set of cards was loaded
+    def reload_if_changed(self):
+        started = time.monotonic()
+        try:
+            signature = self._stat_signature()
+        except OSError as e:
+            logging.error("Can't stat ACL file %s (%s) - using last good copy",
+                    self.filename, e)
+            return False
+
+        if signature in (self._file_signature, self._rejected_signature):
+            return False
+
+        try:
+            cards = self._read_cards()
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            logging.error("Can't load ACL file %s (%s) - using last good copy",
+                    self.filename, e)
+            metrics.acl_reloads.inc(os.path.basename(self.filename), 'error')
+            self._rejected_signature = signature
+            return False
+
+        if cards is None:
+            logging.info("ACL file %s appears to be mid-write - "
+                    "using last good copy", self.filename)
+            return False
+
+        # If the file changed while we were reading it, we may have a
+        # mix of old and new contents. Leave the signature alone so that
+        # we try again next time
+        try:
+            if self._stat_signature() != signature:
+                logging.info("ACL file %s changed while being read - "
+                        "using last good copy", self.filename)
+                return False
+        except OSError:
+            return False
+
+        try:
+            snapshot_version = self._read_version()
+            delta, version = self._read_journal(snapshot_version)
+        except (OSError, ValueError) as e:
+            logging.error("Can't load version or journal for ACL file %s "
+                    "(%s) - using last good copy", self.filename, e)
+            metrics.acl_reloads.inc(os.path.basename(self.filename), 'error')
+            return False
+
+        self.authorised_cards = cards
+        self._delta = delta
+        self.snapshot_version = snapshot_version
+        self.version = version
+        self._file_signature = signature
+        self.load_count += 1
+        logging.info("Loaded %d cards from ACL file %s (version %d, "
+                "%d changes from journal)", len(cards), self.filename,
+                version, len(delta))
+
+        basename = os.path.basename(self.filename)
+        metrics.acl_reloads.inc(basename, 'ok')
+        metrics.acl_reload_duration.set(time.monotonic() - started, basename)
+        metrics.acl_cards.set(len(cards), basename)
+        return True
+
+    def _stat_signature(self):
+        st = os.stat(self.filename)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    # Read and validate the file. Returns None if the file looks like it
+    # is still being written, and raises ValueError if it contains
+    # something that isn't a card ID
+    def _read_cards(self):
+        with open(self.filename, 'r') as f:
+            contents = f.read()
+
+        if not contents.endswith('\n'):
+            age = time.time() - os.stat(self.filename).st_mtime
+            if age < self.settle_time:
+                return None
+
+        return frozenset(parse_card_lines(contents.splitlines()))
+
+    # The snapshot's version is 0 if it has never been synced
+    def _read_version(self):
+        try:
+            with open(self.filename + self.version_suffix, 'r') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    # Replay the journal entries newer than the snapshot. Returns the
+    # card -> added dictionary, and the version of the last entry
+    def _read_journal(self, snapshot_version):
+        delta = {}
+        version = snapshot_version
+        try:
+            with open(self.filename + self.journal_suffix, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return delta, version
+
+        # A crash part-way through appending can leave the last line
+        # unterminated - it was never acknowledged, so drop it
+        if lines and not lines[-1].endswith('\n'):
+            lines.pop()
+        for seq, added, card in parse_delta_lines(lines):
+            if seq > version:
+                delta[card] = added
+                version = seq
+        return delta, version
+
+    # Apply a list of (sequence number, added, card) entries, in order.
+    # Entries that are already applied are skipped. Raises ValueError if the
+    # entries don't carry on from our version, since then we can't know
+    # what we've missed and need a new snapshot
+    def apply_delta(self, entries):
+        entries = [entry for entry in entries if entry[0] > self.version]
+        if not entries:
+            return 0
+        expected = self.version + 1
+        for seq, added, card in entries:
+            if seq != expected:
+                raise ValueError("delta has version %d, expected %d"
+                        % (seq, expected))
+            expected += 1
+
+        # Journal first, so that a change is never acted on but then
+        # forgotten on restart
+        with open(self.filename + self.journal_suffix, 'a') as f:
+            f.write(''.join(format_delta_line(*entry) for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+        delta = dict(self._delta)
+        for seq, added, card in entries:
+            delta[card] = added
+        self._delta = delta
+        self.version = entries[-1][0]
+        logging.info("Applied %d changes to ACL file %s (now version %d)",
+                len(entries), self.filename, self.version)
+
+        changed_cards = set(entry[2] for entry in entries)
+        for listener in self.listeners:
+            listener(changed_cards)
+
+        if len(delta) >= self.compact_after:
+            self.write_snapshot(list(self), self.version)
+        return len(entries)
+
+    # Replace the file with the supplied cards, as of 'version', and clear
+    # the journal. The journal is emptied first: if we stop part-way
+    # through, we're left with an older version that the next sync brings
+    # up to date, or a newer snapshot that replaying the journal again
+    # brings to the same result
+    def write_snapshot(self, cards, version):
+        self._write_file(cards)
+        self._install_version(version)
+
+    # As write_snapshot, but for a file that has already been fetched
+    def install_snapshot(self, contents, version):
+        self._truncate_journal()
+        write_file_atomically(self.filename, contents)
+        self._install_version(version)
+        for listener in self.listeners:
+            listener(None)
+
+    def _write_file(self, cards):
+        self._truncate_journal()
+        write_card_database(cards, self.filename)
+
+    def _install_version(self, version):
+        write_file_atomically(self.filename + self.version_suffix,
+                b'%d\n' % version)
+        self.reload_if_changed()
+
+    def _truncate_journal(self):
+        with open(self.filename + self.journal_suffix, 'w') as f:
+            os.fsync(f.fileno())
+
+
+###############################################################################
+# Class - CompiledCardDatabase
+###############################################################################
+
+# A compiled card database holds the same information as a text ACL file,
+# but in a form that can be looked up without loading it into Python objects
+# (see compile_carddb.py, which creates them from text ACL files).
+#
+# The file starts with a header:
+#
+#   magic (4 bytes, 'RPAC'), format version (1 byte), record width (1 byte),
+#   reserved (2 bytes), number of records (4 bytes, big-endian)
+#
+# followed by the records, sorted by their bytes. Each record is the length
+# of the card ID (1 byte), followed by the card ID, padded with zeros to the
+# record width.
+#
+# The file is memory-mapped and looked up with a binary search, so memory
+# use stays flat no matter how many cards are in the file. Since compiled
+# files are replaced by renaming a new file over the old one, the mapping of
+# the old file remains valid until we switch to the new one.
+class CompiledCardDatabase(CardDatabase):
+
+    def _write_file(self, cards):
+        self._truncate_journal()
+        write_compiled_card_database(cards, self.filename)
+
+    def _read_cards(self):
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError("file is empty")
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return _CompiledCardIndex(mapping)
+
+
+compiled_card_db_magic = b'RPAC'
+compiled_card_db_version = 1
+_compiled_header = struct.Struct('>4sBBxxI')
+
+# Read-only view of a memory-mapped compiled card database
+class _CompiledCardIndex:
+
+    def __init__(self, mapping):
+        if len(mapping) < _compiled_header.size:
+            raise ValueError("file is too short for a header")
+        magic, version, width, count = \
+                _compiled_header.unpack_from(mapping, 0)
+        if magic != compiled_card_db_magic:
+            raise ValueError("not a compiled card database")
+        if version != compiled_card_db_version:
+            raise ValueError("unsupported format version %d" % version)
+        if width < 2:
+            raise ValueError("invalid record width %d" % width)
+        if len(mapping) != _compiled_header.size + count * width:
+            raise ValueError("file size doesn't match the header")
+
+        self.mapping = mapping
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offset = _compiled_header.size + i * self.width
+        return self.mapping[offset:offset + self.width]
+
+    def __iter__(self):
+        for i in range(self.count):
+            record = self[i]
+            yield record[1:1 + record[0]]
+
+    def __contains__(self, card):
+        if len(card) > self.width - 1:
+            return False
+        record = _card_record(card, self.width)
+        i = bisect.bisect_left(self, record)
+        return i < self.count and self[i] == record
+
+
+def _card_record(card, width):
+    return bytes((len(card),)) + card + bytes(width - 1 - len(card))
+
+
+# Write a compiled card database containing the supplied cards (as bytes)
+def write_compiled_card_database(cards, filename):
+    width = 1 + max([len(card) for card in cards] + [1])
+    if width > 255:
+        raise ValueError("card ID too long to compile")
+    records = sorted(set(_card_record(card, width) for card in cards))
+    write_file_atomically(filename, _compiled_header.pack(
+            compiled_card_db_magic, compiled_card_db_version, width,
+            len(records)) + b''.join(records))
+    return len(records)
+
+
+# Write a text ACL file containing the supplied cards (as bytes)
+def write_card_database(cards, filename):
+    write_file_atomically(filename, ''.join(
+            card.hex().upper() + '\n' for card in sorted(cards)).encode())
+    return len(cards)
+
+
+# Write 'contents' (bytes) alongside the destination and rename it over it,
+# so that anyone reading the old file never sees a partly-written one
+def write_file_atomically(filename, contents):
+    fd, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)),
+            prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+
+
+# Convert the lines of a text ACL file to a set of card IDs (as bytes).
+# Raises ValueError if a line isn't a hex card ID
+def parse_card_lines(lines):
+    cards = set()
+    for line_number, line in enumerate(lines, 1):
+        card = line.strip()
+        if not card:
+            continue
+        if not re.match(r'^([0-9A-Fa-f]{2})+$', card):
+            raise ValueError("line %d is not a hex card ID" % line_number)
+        cards.add(bytes.fromhex(card))
+    return cards
+
+
+# Deltas and journals have one change per line:
+#
+#   <sequence number> + <card as hex>       (the card has been added)
+#   <sequence number> - <card as hex>       (the card has been removed)
+#
+# Blank lines and lines starting with '#' are ignored. Returns a list of
+# (sequence number, added, card) tuples, and raises ValueError if a line
+# isn't a change
+def parse_delta_lines(lines):
+    entries = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        m = re.match(r'^(\d+)\s+([+-])\s*(([0-9A-Fa-f]{2})+)$', line)
+        if not m:
+            raise ValueError("line %d is not a card change" % line_number)
+        entries.append((int(m.group(1)), m.group(2) == '+',
+                bytes.fromhex(m.group(3))))
+    return entries
+
+
+def format_delta_line(seq, added, card):
+    return "%d %s %s\n" % (seq, '+' if added else '-', card.hex().upper())
+
+
+# Files ending in this are compiled card databases, rather than text
+compiled_card_db_suffix = '.carddbc'
+
+# Several devices can share the same ACL file. Keep one CardDatabase per
+# file, so that it is only loaded (and held in memory) once
+_card_databases_by_filename = {}
+
+# In a worker process (see supervisor.py), text ACL files are replaced by
+# compiled copies kept up to date by the supervisor in this directory, which
+# all of the workers share (as they are memory-mapped)
+shared_index_dir = None
+
+# The compiled copy is named after the ACL file's path relative to the
+# access control files path, with '%' and '/' escaped, so that files with
+# the same name in different directories don't share a copy
+def shared_index_filename(acl_path, filename, index_dir):
+    name = os.path.relpath(os.path.join(acl_path, filename), acl_path)
+    name = name.replace('%', '%25').replace(os.sep, '%2F')
+    return os.path.join(index_dir, name + compiled_card_db_suffix)
+
+# Open an ACL file, given its name relative to the access control files path
+def open_card_database(acl_path, filename):
+    if shared_index_dir is not None \
+            and not filename.endswith(compiled_card_db_suffix):
+        filename = shared_index_filename(acl_path, filename,
+                shared_index_dir)
+    else:
+        filename = os.path.normpath(acl_path + '/' + filename)
+    if filename not in _card_databases_by_filename:
+        if filename.endswith(compiled_card_db_suffix):
+            db = CompiledCardDatabase(filename)
+        else:
+            db = CardDatabase(filename)
+        _card_databases_by_filename[filename] = db
+    return _card_databases_by_filename[filename]
@@ -0,0 +1,94 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Class - CircuitBreaker
+###############################################################################
+
+# A card reader that has stopped answering (it has hung, or come loose from
+# the bus) makes every card read on it wait for the full response timeout.
+# With the serial dispatcher, that holds up every other reader too, and on a
+# shared bus its failed transactions use up bus time the others need.
+#
+# So each reader has a CircuitBreaker. Once 'failure threshold' reads in a
+# row have failed, the reader is marked 'degraded', and the reader stops
+# trying to read cards. Instead, the breaker 'probes' the reader from a
+# background thread: every 'probe interval' seconds (growing by
+# 'probe backoff' each time, up to 'max probe interval', with some random
+# jitter so that readers on a failed bus don't all probe at once) it calls
+# probe(), and as soon as that returns True the reader is back in service.
+
+# System-Wide packages
+import random
+import threading
+
+
+class CircuitBreaker:
+
+    failure_threshold = 5
+    probe_interval = 5.0
+    probe_backoff = 2.0
+    max_probe_interval = 60.0
+
+    def __init__(self, probe, failure_threshold=None, probe_interval=None):
+        """Circuit Breaker Constructor"""
+        self.probe = probe
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if probe_interval is not None:
+            self.probe_interval = probe_interval
+        self.degraded = False
+        self.consecutive_failures = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._prober = None
+
+    # Returns True if this success brought the reader back into service
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            recovered = self.degraded
+            self.degraded = False
+        return recovered
+
+    # Returns True if this failure has just marked the reader degraded
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.degraded \
+                    or self.consecutive_failures < self.failure_threshold:
+                return False
+            self.degraded = True
+            if self._prober is None or not self._prober.is_alive():
+                self._prober = threading.Thread(name="circuit-breaker-probe",
+                        target=self._probe_until_recovered, daemon=True)
+                self._prober.start()
+        return True
+
+    # Stop probing, e.g. when the reader has been removed from the config
+    def stop(self):
+        self._stop.set()
+
+    def _probe_until_recovered(self):
+        interval = self.probe_interval
+        while not self._stop.wait(random.uniform(0.5, 1.0) * interval):
+            if not self.degraded:
+                return
+            if self.probe():
+                self.record_success()
+                return
+            interval = min(interval * self.probe_backoff,
+                    self.max_probe_interval)
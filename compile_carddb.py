@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# OVERVIEW
+###############################################################################
+#
+# Converts text ACL files (one hex card ID per line) into compiled card
+# databases, which rpac.py can look cards up in without loading the whole
+# file into memory. See CompiledCardDatabase in card_database.py for the
+# file format.
+#
+# By default, 'front_door.carddb' is compiled to 'front_door.carddbc'. To use
+# the compiled file, change the 'acl filename' of the device in rpac.conf.
+#
+
+# System-Wide imports
+import getopt
+import sys
+
+# Local packages
+import card_database
+
+
+# Displays help on how to use this program
+def usage(extra_message=None):
+    if extra_message:
+        print("\nERROR: %s" % extra_message)
+    print("""
+Usage: compile_carddb.py [--output=/path/to/file.carddbc] file.carddb ...
+
+Options:
+    --output=FILE   Where to write the compiled file (only valid when
+                    compiling a single file). Defaults to the input
+                    filename, with the extension changed to '%s'
+""" % card_database.compiled_card_db_suffix)
+    sys.exit(2)
+
+
+def compiled_filename_for(text_filename):
+    if text_filename.endswith('.carddb'):
+        text_filename = text_filename[:-len('.carddb')]
+    return text_filename + card_database.compiled_card_db_suffix
+
+
+def compile_card_file(text_filename, compiled_filename):
+    with open(text_filename, 'r') as f:
+        try:
+            cards = card_database.parse_card_lines(f)
+        except ValueError as e:
+            raise ValueError("%s: %s" % (text_filename, e))
+    count = card_database.write_compiled_card_database(
+            cards, compiled_filename)
+    print("%s: compiled %d cards to %s" % (
+            text_filename, count, compiled_filename))
+
+
+def main():
+    output_filename = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "output="])
+    except getopt.GetoptError as err:
+        usage(str(err))
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o in ("-o", "--output"):
+            output_filename = a
+        else:
+            assert False, "Unhandled option"
+
+    if not args:
+        usage("No ACL files supplied")
+    if output_filename and len(args) > 1:
+        usage("--output can only be used with a single ACL file")
+
+    for text_filename in args:
+        try:
+            compile_card_file(text_filename,
+                    output_filename or compiled_filename_for(text_filename))
+        except (OSError, ValueError) as e:
+            print("ERROR: %s" % e, file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
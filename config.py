@@ -19,19 +19,66 @@ import configparser
 import logging
 import os.path
 import re
+import threading
+import time
 
 # Local Packages
+import acl_sync
+import card_database
+from access_index import AccessGroup, AccessIndex, CompiledAccessIndex, \
+        shared_access_index_filename
+from access_schedule import AccessSchedule
 from controlled_device import ControlledDevice
+from i2c_bus import I2CBus
+from pin_plan import OutputPinBank
 from strong_link_sl030_reader import StrongLinkSl030Reader
 
-def parse_config_options(config_filename):
+# The config file's sections, as a list of (section name, list of
+# (parameter, value)), sorted by section name
+def read_config_sections(config_filename):
     if not os.path.exists(config_filename):
         assert False, "Configuration file %s does not exist" % config_filename
     config = configparser.ConfigParser()
     config.read(config_filename)
-    
+    return [(o, config.items(o)) for o in sorted(config.sections())]
+
+
+# Held by reload_config_options while it swaps the new readers and devices
+# into readers_by_name and devices_by_name, so that other threads can take a
+# consistent copy of them
+reload_lock = threading.Lock()
+
+
+# The sections each config file had when it was last read, for working out
+# what has changed when it is reloaded
+_sections_by_config_filename = {}
+
+
+# The readers' I2CBus objects and the devices' OutputPinBank are normally
+# created here, but can be supplied (e.g. when reloading the config file), so
+# that buses and pins that are already open are used as they are
+#
+# In a worker process (see supervisor.py), 'worker' is the worker's name, and
+# only the readers assigned to it (and their devices) are set up
+#
+# Each poll of a reader with 'poll for cards' waits for the reader's answer
+# (up to its 'response timeout'), so polled readers are only allowed when
+# the polls are run in threads of their own (--dispatch=threaded), where
+# they can't hold up the readers with trigger pins
+def parse_config_options(config_filename, output_pins=None,
+            i2c_buses_by_number=None, worker=None, allow_polled_readers=True):
+    sections = read_config_sections(config_filename)
+    items_by_section = dict(sections)
+
+    worker_sections = None
+    if worker is not None:
+        worker_sections = assign_workers(sections).get(worker, set())
+
     # Read 'plain' config parameters first:
-    acl_path = config.get('Paths', 'access control files')
+    paths = dict(items_by_section.get('Paths', []))
+    if 'access control files' not in paths:
+        assert False, "'access control files' not set in [Paths]"
+    acl_path = paths['access control files']
 
 
     # Now loop through the readers and devices specified in the config
@@ -40,18 +87,35 @@ def parse_config_options(config_filename):
     readers_by_name = {}
     devices_by_name = {}
 
+    # Readers on the same i2c bus share a single I2CBus object, which
+    # keeps the bus open and stops them from colliding with each other
+    if i2c_buses_by_number is None:
+        i2c_buses_by_number = {}
+
+    # Likewise, devices share their output pins through an OutputPinBank,
+    # which opens each pin once
+    if output_pins is None:
+        output_pins = OutputPinBank()
+
+    # The [Bus ...] settings are checked as they are read, but only applied
+    # once the whole file has been read, since the buses may be in use
+    bus_settings_by_number = {}
+
     # So as to avoid copy-and-paste coding, we use a regex match to split
     # the parsing between the two types of parameters.
     # This also has the advantage of catching typos, where if someone 
     # incorrectly types 'Rreader' in a section name or similar, the error
     # will be raised instead of just ignored
-    for o in sorted(config.sections()):
+    for o, items in sections:
         if o == 'Paths':
             continue
         
-        m = re.search(r'^(Reader|Device) (.*)', o)
+        m = re.search(r'^(Reader|Device|Group|Schedule|Bus) (.*)', o)
         if not m:
             assert False, "Unsupported config section '%s'" % o
+        elif m.group(1) in ('Reader', 'Device') \
+                and worker_sections is not None and o not in worker_sections:
+            continue
         elif m.group(1) == 'Reader':
             # Readers are "card readers", and the hardware underlying each
             # reader can be of varying types. Based on the 'reader type'
@@ -60,12 +124,12 @@ def parse_config_options(config_filename):
             # I've decided to hard-code the list of supported object types
             # for sanity checking here, rather than 'eval'ing the supplied
             # name
-            if config.get(o, 'reader type') == 'StrongLinkSl030Reader':
-                r = StrongLinkSl030Reader(config.items(o))
+            reader_type = dict(items).get('reader type')
+            if reader_type == 'StrongLinkSl030Reader':
+                r = StrongLinkSl030Reader(items)
             else:
                 assert False, \
-                        "Unsupported Reader type - '%s'" \
-                                % self.reader_type
+                        "Unsupported Reader type - '%s'" % reader_type
 
             # Store the reader object we've created into the 'readers_by_name'
             # dictionary, with the key being the name stored in the config
@@ -73,19 +137,333 @@ def parse_config_options(config_filename):
             r.name = m.group(2)
             readers_by_name[ m.group(2) ] = r
 
+            if r.poll_for_cards and not allow_polled_readers:
+                assert False, "Reader %s - 'poll for cards' needs " \
+                        "--dispatch=threaded" % r.name
+
+            if r.i2c_bus_number not in i2c_buses_by_number:
+                i2c_buses_by_number[r.i2c_bus_number] = \
+                        I2CBus(r.i2c_bus_number)
+            r.i2c_bus = i2c_buses_by_number[r.i2c_bus_number]
+
+        elif m.group(1) == 'Bus':
+            # Settings for an i2c bus
+            if not re.match(r'^\d+$', m.group(2)):
+                assert False, "Bus section must be [Bus <number>] " \
+                        "(is '%s')" % o
+            bus_number = int(m.group(2))
+            bus_settings_by_number[bus_number] = \
+                    i2c_bus_settings(bus_number, items)
+
         elif m.group(1) == 'Device':
             # Devices are the 'things' we control (doors, machinery, etc).
             
             # Build a new Device from the parameters we've been supplied
             # and store it in the 'devices_by_name' has
-            d = ControlledDevice(config.items(o), acl_path)
+            d = ControlledDevice(items, acl_path, output_pins)
             d.name = m.group(2)
             devices_by_name[ m.group(2) ] = d
+
+        elif m.group(1) in ('Group', 'Schedule'):
+            # Read by read_access_groups, below
+            continue
         else:
             assert False, \
                     "Section not understood in config file: '%s'" % m.group(1)
 
+    groups_by_name = read_access_groups(sections, acl_path)
+
+    # Devices that grant access to groups share one AccessIndex, which
+    # answers for all of them with a single lookup. In a worker process,
+    # that is the supervisor's copy, shared through the shared ACL directory
+    group_devices = [d for d in devices_by_name.values() if d.access_groups]
+    if group_devices:
+        if card_database.shared_index_dir is not None:
+            access_index = CompiledAccessIndex(
+                    shared_access_index_filename(
+                        card_database.shared_index_dir),
+                    groups_by_name)
+        else:
+            access_index = AccessIndex(groups_by_name)
+        for d in sorted(group_devices, key=lambda d: d.name):
+            d.access_index = access_index
+            d.access_bit = access_index.add_device(d.name, d.access_groups)
+        access_index.build()
+
+    # Each reader needs a trigger pin of its own
+    trigger_pins = [r.trigger_pin for r in readers_by_name.values()
+            if r.trigger_pin is not None]
+    if len(set(trigger_pins)) != len(trigger_pins):
+        assert False, "The same trigger pin is used by more than one reader"
+
+    # The devices' output pins are opened all at once, in parallel
+    output_pins.open_all()
+
+    for bus_number, settings in bus_settings_by_number.items():
+        if bus_number not in i2c_buses_by_number:
+            i2c_buses_by_number[bus_number] = I2CBus(bus_number)
+        for attribute, value in settings.items():
+            setattr(i2c_buses_by_number[bus_number], attribute, value)
+
+    _sections_by_config_filename[config_filename] = sections
+
     logging.info("Config read successfully")
 
     return(acl_path, readers_by_name, devices_by_name)
 
+
+# The [Group ...] sections, with the [Schedule ...] sections they refer to.
+# Returns the AccessGroups, by name
+def read_access_groups(sections, acl_path):
+    groups_by_name = {}
+    schedules_by_name = {}
+    for o, items in sections:
+        m = re.search(r'^(Group|Schedule) (.*)', o)
+        if not m:
+            continue
+        elif m.group(1) == 'Group':
+            # Groups are named sets of cards, which devices can grant
+            # access to with their 'access groups' parameter
+            g = AccessGroup(items, acl_path)
+            g.name = m.group(2)
+            groups_by_name[ m.group(2) ] = g
+        else:
+            # Schedules are the times at which groups with a 'schedule'
+            # parameter allow access
+            s = AccessSchedule(items)
+            s.name = m.group(2)
+            schedules_by_name[ m.group(2) ] = s
+
+    for g in groups_by_name.values():
+        if g.schedule_name is not None:
+            if g.schedule_name not in schedules_by_name:
+                assert False, "Group %s - unknown schedule '%s'" \
+                        % (g.name, g.schedule_name)
+            g.schedule = schedules_by_name[g.schedule_name]
+    return groups_by_name
+
+
+# The AccessIndex for every device in the config file that grants access to
+# groups, built from the sections alone (without setting up the devices),
+# or None if there are none. The supervisor builds this, and shares it with
+# the workers (see supervisor.py)
+def build_access_index(sections, acl_path):
+    group_devices = []
+    for o, items in sections:
+        items = dict(items)
+        if o.startswith('Device ') and 'access groups' in items:
+            group_devices.append((o[len('Device '):],
+                    items['access groups'].split()))
+    if not group_devices:
+        return None
+    access_index = AccessIndex(read_access_groups(sections, acl_path))
+    for device_name, group_names in sorted(group_devices):
+        access_index.add_device(device_name, group_names)
+    access_index.build()
+    return access_index
+
+
+# The card databases used by these devices, directly or through their
+# groups, by their name relative to the access control files path (see
+# acl_sync.card_databases_to_sync). Safe to call from other threads while
+# the config is being reloaded
+def card_databases_in_use(devices_by_name):
+    with reload_lock:
+        devices = list(devices_by_name.values())
+    card_databases = []
+    for d in devices:
+        if d.card_database is not None:
+            card_databases.append(d.card_database)
+        if d.access_index is not None:
+            for group in d.access_index.groups_by_name.values():
+                card_databases.extend(group.card_databases)
+    if not devices:
+        return {}
+    return acl_sync.card_databases_to_sync(devices[0].acl_path,
+            card_databases)
+
+
+# Which worker process (see supervisor.py) each reader and device is run in.
+# Readers are grouped by their 'worker' parameter if they have one, and
+# otherwise by i2c bus. Each device is run alongside its readers (so they
+# must all be in the same worker), or in the first worker if it has none.
+#
+# Returns the names of the sections for each worker, by worker name
+def assign_workers(sections):
+    sections_by_worker = {}
+    worker_by_device = {}
+    trigger_pins = set()
+    for section, items in sections:
+        if not section.startswith('Reader '):
+            continue
+        items = dict(items)
+        worker = items.get('worker') \
+                or 'bus-%s' % items.get('i2c bus', 'default')
+        sections_by_worker.setdefault(worker, set()).add(section)
+
+        device = items.get('associated device')
+        if worker_by_device.setdefault(device, worker) != worker:
+            assert False, "Device %s has readers in more than one worker " \
+                    "(%s and %s) - give them the same 'worker'" \
+                    % (device, worker_by_device[device], worker)
+        if 'trigger pin' in items:
+            if items['trigger pin'] in trigger_pins:
+                assert False, "The same trigger pin is used by more than " \
+                        "one reader"
+            trigger_pins.add(items['trigger pin'])
+
+    if not sections_by_worker:
+        assert False, "No readers in the config file"
+    first_worker = sorted(sections_by_worker)[0]
+    for section, items in sections:
+        if section.startswith('Device '):
+            worker = worker_by_device.get(section[len('Device '):],
+                    first_worker)
+            sections_by_worker[worker].add(section)
+    return sections_by_worker
+
+
+# Check the parameters of a [Bus ...] section, and return them as the
+# I2CBus attributes to set
+def i2c_bus_settings(bus_number, items):
+    settings = {}
+    for o, a in items:
+        if o == 'poll budget':
+            budget = float(a)
+            if not 0 < budget <= 1:
+                assert False, "Bus %d - poll budget must be more than 0, " \
+                        "and no more than 1 (is '%s')" % (bus_number, a)
+            settings['poll_budget'] = budget
+        elif o == 'transaction timeout':
+            timeout = float(a)
+            if timeout <= 0:
+                assert False, "Bus %d - transaction timeout must be more " \
+                        "than 0 (is '%s')" % (bus_number, a)
+            settings['transaction_timeout'] = timeout
+        else:
+            assert False, "Unsupported parameter '%s' for Bus" % o
+    return settings
+
+
+# Re-read a config file while rpac is running, and update readers_by_name
+# and devices_by_name (as returned by parse_config_options) in place.
+#
+# Readers and devices whose sections haven't changed are left exactly as
+# they are, so that their pins and i2c buses stay open and a device that is
+# enabled stays enabled. The rest are replaced with new objects, and the
+# devices they replace disabled. Devices are also replaced if anything they
+# depend on has changed: the [Paths], [Group ...] or [Schedule ...] sections,
+# or (for devices using groups, which share one AccessIndex) any other
+# device using groups.
+#
+# Nothing is changed unless the whole file is read successfully. Watching
+# the readers' trigger pins is up to the caller.
+def reload_config_options(config_filename, readers_by_name, devices_by_name,
+            worker=None, allow_polled_readers=True):
+    started = time.monotonic()
+    old_sections = dict(_sections_by_config_filename.get(config_filename, []))
+    output_pins = None
+    for d in devices_by_name.values():
+        output_pins = d.output_pins
+    i2c_buses_by_number = dict((r.i2c_bus_number, r.i2c_bus)
+            for r in readers_by_name.values())
+
+    acl_path, new_readers_by_name, new_devices_by_name = \
+            parse_config_options(config_filename, output_pins,
+                    i2c_buses_by_number, worker, allow_polled_readers)
+    new_sections = dict(_sections_by_config_filename[config_filename])
+
+    def unchanged(section):
+        return old_sections.get(section) == new_sections.get(section)
+
+    shared_sections_unchanged = all(unchanged(section) for section
+            in set(old_sections) | set(new_sections)
+            if section.split(' ', 1)[0] not in ('Reader', 'Device', 'Bus'))
+    group_device_names = \
+            [name for name, d in devices_by_name.items() if d.access_groups] + \
+            [name for name, d in new_devices_by_name.items() if d.access_groups]
+    group_devices_unchanged = shared_sections_unchanged and all(
+            unchanged('Device ' + name) for name in group_device_names)
+
+    # Work out which of the old and new objects to use
+    devices = {}
+    for name, d in new_devices_by_name.items():
+        if name in devices_by_name and unchanged('Device ' + name) \
+                and shared_sections_unchanged \
+                and (not d.access_groups or group_devices_unchanged):
+            devices[name] = devices_by_name[name]
+        else:
+            devices[name] = d
+    readers = {}
+    for name, r in new_readers_by_name.items():
+        if name in readers_by_name and unchanged('Reader ' + name):
+            readers[name] = readers_by_name[name]
+        else:
+            readers[name] = r
+
+    changes = "readers: %s; devices: %s" % (
+            _describe_changes(readers_by_name, readers),
+            _describe_changes(devices_by_name, devices))
+
+    old_devices = list(devices_by_name.values())
+
+    # Disable the devices that are going, and then the ones replacing them
+    for name, d in devices_by_name.items():
+        if devices.get(name) is not d:
+            d.disable()
+    for name, d in devices.items():
+        if devices_by_name.get(name) is not d:
+            d.disable()
+
+    # Close the readers that have been replaced, and the new ones that were
+    # built for sections that haven't changed (so aren't used)
+    for name, r in list(readers_by_name.items()) + \
+                list(new_readers_by_name.items()):
+        if readers.get(name) is not r:
+            r.close()
+
+    with reload_lock:
+        _replace_contents(devices_by_name, devices)
+        _replace_contents(readers_by_name, readers)
+
+    # Likewise the AccessIndexes - whether replaced, or built for devices
+    # that haven't changed - so that they stop following changes to the
+    # groups' ACL files, and let go of any shared index they have mapped
+    used_access_indexes = set(d.access_index for d in devices.values())
+    unused_access_indexes = set(d.access_index for d in
+            list(old_devices) + list(new_devices_by_name.values()))
+    for access_index in unused_access_indexes - used_access_indexes:
+        if access_index is not None:
+            access_index.close()
+
+    # Close the pins and buses that are no longer used
+    if output_pins is not None:
+        used_pins = set()
+        for d in devices.values():
+            used_pins.update(d.enable_plan.pin_numbers)
+            used_pins.update(d.disable_plan.pin_numbers)
+        output_pins.close_unused(used_pins)
+    used_buses = set(r.i2c_bus for r in readers.values())
+    for bus in set(i2c_buses_by_number.values()) - used_buses:
+        bus.close()
+
+    logging.info("Config reloaded in %.3fs - %s",
+            time.monotonic() - started, changes)
+
+
+def _describe_changes(old_objects_by_name, new_objects_by_name):
+    added = sorted(set(new_objects_by_name) - set(old_objects_by_name))
+    removed = sorted(set(old_objects_by_name) - set(new_objects_by_name))
+    changed = sorted(name for name in new_objects_by_name
+            if name in old_objects_by_name
+            and new_objects_by_name[name] is not old_objects_by_name[name])
+    return ", ".join("%s %s" % (what, " ".join(names)) for what, names
+            in (('added', added), ('changed', changed), ('removed', removed))
+            if names) or "unchanged"
+
+
+def _replace_contents(objects_by_name, new_objects_by_name):
+    for name in list(objects_by_name):
+        if name not in new_objects_by_name:
+            del objects_by_name[name]
+    objects_by_name.update(new_objects_by_name)
@@ -15,13 +15,19 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # System-Wide packages
-import fileinput
-import logging
 import logging
 import re
+import threading
+import time
 
-# Associated Packages
-from quick2wire import gpio
+# Local Packages
+import metrics
+import timer_queue
+import traffic_trace
+from card_database import open_card_database
+from latency_trace import LatencyStats
+from pin_plan import OutputPinBank, PinWritePlan
+from rpac_logging import HexCardId, audit
 
 ###############################################################################
 # Class - ControlledDevice
@@ -37,28 +43,67 @@ class ControlledDevice:
     #
     # Similarly, on a device being 'disabled', the same is true.
     #
-    pin_objects = {}                # Objects that are used for interfacing with HW
-    enable_set_pins_low = []
-    enable_set_pins_high = []
-    disable_set_pins_low = []
-    disable_set_pins_high = []
+    # These lists of pin numbers are compiled into an 'enable' and a
+    # 'disable' PinWritePlan (see pin_plan.py), which do the actual setting
+    enable_set_pins_low = None
+    enable_set_pins_high = None
+    disable_set_pins_low = None
+    disable_set_pins_high = None
+    enable_plan = None
+    disable_plan = None
+    output_pins = None
+
+    # Optionally, the pins can be read back after being set, to check that
+    # they took the new values, and the time taken to set them recorded
+    verify_pins = False
+    transition_latency = None
+    verify_failures = 0
+
+    # Optionally, a device can be relocked 'max unlock time' seconds after
+    # being enabled, even if the card hasn't been removed (in case the
+    # removal was missed), and kept enabled for at least 'min unlock time'
+    # seconds after being enabled, even if the card is removed sooner. Both
+    # are done with a timer in the event loop's TimerQueue
+    max_unlock_time = None
+    min_unlock_time = 0.0
+    timers = None
+    enabled_at = None
+    _relock_timer = None
 
     # Access to a controlled device is based on the card presented,
     # with a list of 'allowed cards' stored in a configuration file. The exact
     # filename used is supplied in the config file
     acl_filename = None
 
-    # The 'authorised cards' are read into this in-memory array. Since the
-    # use-case for the rpac system is less than 1000 cards, we read this
-    # into memory
-    authorised_cards = []
+    # The 'authorised cards' are held in a CardDatabase, which is shared
+    # with any other device using the same ACL file and only re-reads the
+    # file when it changes
+    card_database = None
+
+    # Instead of (or as well as) its own ACL file, a device can grant access
+    # to groups of cards ([Group ...] sections in the config file). Access
+    # to groups is checked with a shared AccessIndex, in which this device
+    # has its own bit (both are set by config.parse_config_options)
+    access_groups = []
+    access_index = None
+    access_bit = None
 
     # This device is instantiated and configured based on a config file. The
     # object is passed a 'configparser' fragment, and needs to set the
     # appropriate parameters
-    def  __init__(self, config, acl_path):
+    #
+    # The output pins are shared with any other devices in the same config
+    # file through 'output_pins' (an OutputPinBank)
+    def  __init__(self, config, acl_path, output_pins=None):
         """Device Constructor"""
         self.acl_path = acl_path
+        self.enable_set_pins_low = []
+        self.enable_set_pins_high = []
+        self.disable_set_pins_low = []
+        self.disable_set_pins_high = []
+        if output_pins is None:
+            output_pins = OutputPinBank()
+        self.output_pins = output_pins
 
         # Process configuration file fragment
         for o, a in config:
@@ -72,6 +117,17 @@ class ControlledDevice:
                 self.disable_set_pins_high = self.parse_pin_parameters(a)
             elif o == 'acl filename':
                 self.acl_filename = a
+            elif o == 'access groups':
+                self.access_groups = a.split()
+            elif o == 'verify pins':
+                self.verify_pins = self.parse_yes_no(o, a)
+            elif o == 'time pin writes':
+                if self.parse_yes_no(o, a):
+                    self.transition_latency = LatencyStats()
+            elif o == 'max unlock time':
+                self.max_unlock_time = float(a)
+            elif o == 'min unlock time':
+                self.min_unlock_time = float(a)
             else:
                 assert False, "Unsupported parameter '%s' for Device" % o
 
@@ -90,8 +146,33 @@ class ControlledDevice:
                 "disable_set_pins_low, " \
                 "disable_set_pins_high " % self.name
             
-        if not self.acl_filename:
-            assert False, "ACL filename not set"
+        if not self.acl_filename and not self.access_groups:
+            assert False, "Neither ACL filename nor access groups set"
+
+        if self.max_unlock_time is not None and self.max_unlock_time <= 0:
+            assert False, "max unlock time must be positive"
+        if self.min_unlock_time < 0 or (self.max_unlock_time is not None
+                and self.min_unlock_time > self.max_unlock_time):
+            assert False, "min unlock time must be between 0 and max " \
+                "unlock time"
+        self.timers = timer_queue.shared_timers
+
+        if self.acl_filename:
+            self.card_database = open_card_database(self.acl_path,
+                    self.acl_filename)
+
+        self.enable_plan = PinWritePlan(
+                [(pin, 0) for pin in self.enable_set_pins_low] +
+                [(pin, 1) for pin in self.enable_set_pins_high], output_pins)
+        self.disable_plan = PinWritePlan(
+                [(pin, 0) for pin in self.disable_set_pins_low] +
+                [(pin, 1) for pin in self.disable_set_pins_high], output_pins)
+
+        # More than one reader can control the same device, and with the
+        # threaded dispatcher they can do so at the same time. Make sure
+        # that the pins for one state change are all set together
+        self._state_lock = threading.Lock()
+        self._timer_lock = threading.Lock()
 
 
     # The pins originally specified in the config file are text, and need
@@ -103,52 +184,120 @@ class ControlledDevice:
                 + " separated by spaces (is '%s')" % pins_as_text
         pins = []
         for pin_number_as_text in pins_as_text.split():
-            pin_number = int(pin_number_as_text)
-            pins.append(pin_number)
-
-            # Create a communication object
-            if pin_number not in self.pin_objects:
-                pin = gpio.pins.pin(pin_number)
-                pin.open()
-                pin.direction = gpio.Out
-                self.pin_objects[pin_number] = pin
-
+            pins.append(int(pin_number_as_text))
         return pins
 
+    def parse_yes_no(self, option, value):
+        if value.lower() not in ('yes', 'no'):
+            assert False, "'%s' must be 'yes' or 'no' (is '%s')" \
+                % (option, value)
+        return value.lower() == 'yes'
 
-    def check_for_card_in_db(self, card):
-        logging.info("Card presented to device %s" % self.name)
-        logging.info("Card id %s" % card)
-        self._load_card_db()
 
-        if card in self.authorised_cards:
-            logging.info("Card IS authorised");
-            return self.enable()
+    # Note that the pins are set before anything is logged, so that the
+    # decision never waits on logging.
+    #
+    # If supplied, the trace (see latency_trace.py) is marked after the
+    # lookup and after the pins have been set
+    def check_for_card_in_db(self, card, trace=None):
+        authorised = self.is_authorised(card)
+        if trace is not None:
+            trace.mark('acl lookup')
+
+        if authorised:
+            result = self.enable(trace)
+            decision = 'granted'
         else:
-            logging.info("Card is NOT authorised");
-            return self.disable()
+            result = self.disable(trace)
+            decision = 'denied'
+        audit(self.name, card, decision)
+        metrics.access_decisions.inc(self.name, decision)
+        traffic_trace.record_decision(self.name, card, decision)
+
+        logging.info("Card %s presented to device %s - %s", HexCardId(card),
+                self.name, "IS authorised" if result else "NOT authorised")
+        return result
+
+
+    def is_authorised(self, card):
+        if card is None:
+            return False
+        if self.card_database is not None and card in self.card_database:
+            return True
+        if self.access_index is not None \
+                and self.access_index.allows(card, self.access_bit):
+            return True
+        return False
 
 
     # STATE CHANGES: enable or disable this device
-    def enable(self):
-        self._set_pins(0, self.enable_set_pins_low)
-        self._set_pins(1, self.enable_set_pins_high)
+    def enable(self, trace=None):
+        self._apply_plan('enable', self.enable_plan)
+        if trace is not None:
+            trace.mark('pins set')
+        with self._timer_lock:
+            self.enabled_at = time.monotonic()
+            self._cancel_relock()
+            if self.max_unlock_time is not None:
+                self._relock_timer = self.timers.call_at(
+                        self.enabled_at + self.max_unlock_time,
+                        self._relock, 'max unlock time')
         return True
 
-    def disable(self):
-        self._set_pins(0, self.disable_set_pins_low)
-        self._set_pins(1, self.disable_set_pins_high)
+    def disable(self, trace=None):
+        with self._timer_lock:
+            self.enabled_at = None
+            self._cancel_relock()
+        self._apply_plan('disable', self.disable_plan)
+        if trace is not None:
+            trace.mark('pins set')
         return False
 
-    # Set associated pins low or high
-    def _set_pins(self, state, pin_list):
-        for pin_number in pin_list:
-            self.pin_objects[pin_number].value = state
-
-    # Read the card database, and build a list of authorised cards
-    def _load_card_db(self):
-        acl_full_path = self.acl_path + '/' + self.acl_filename
-        self.authorised_cards = []
-        for line in fileinput.input(acl_full_path):
-            self.authorised_cards.append(line.rstrip())
+    # The card that enabled the device has been removed. The device is
+    # disabled, unless it hasn't yet been enabled for 'min unlock time', in
+    # which case it is disabled once it has. Returns True if the device
+    # was disabled straight away
+    def card_removed(self, trace=None):
+        with self._timer_lock:
+            if self.enabled_at is not None and self.min_unlock_time:
+                relock_at = self.enabled_at + self.min_unlock_time
+                if relock_at > time.monotonic():
+                    self._cancel_relock()
+                    self._relock_timer = self.timers.call_at(relock_at,
+                            self._relock, 'min unlock time')
+                    return False
+        self.disable(trace)
+        return True
+
+    def _cancel_relock(self):
+        if self._relock_timer is not None:
+            self.timers.cancel(self._relock_timer)
+            self._relock_timer = None
+
+    # Run by the event loop when a relock timer is due. The device may have
+    # been enabled again since the timer was set, which replaces the timer
+    def _relock(self, reason):
+        with self._timer_lock:
+            if self._relock_timer is None \
+                    or self._relock_timer.when > time.monotonic():
+                return
+            self._relock_timer = None
+            self.enabled_at = None
+        self._apply_plan('disable', self.disable_plan)
+        audit(self.name, None, 'relocked')
+        metrics.access_decisions.inc(self.name, 'relocked')
+        traffic_trace.record_decision(self.name, None, 'relocked')
+        logging.info("Device %s relocked (%s)", self.name, reason)
+
+    def _apply_plan(self, transition, plan):
+        with self._state_lock:
+            started = time.monotonic()
+            verified = plan.apply(self.verify_pins)
+            if self.transition_latency is not None:
+                self.transition_latency.record_duration(transition,
+                        time.monotonic() - started)
+        if not verified:
+            self.verify_failures += 1
+            logging.error("Device %s - pins didn't all read back as set "
+                    "after %s", self.name, transition)
 
@@ -0,0 +1,157 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import collections
+import logging
+import threading
+
+# Local Packages
+import metrics
+
+###############################################################################
+# Dispatchers
+###############################################################################
+
+# When a reader's trigger pin changes state, the event loop (event_loop.py)
+# reads the new pin value and hands it (along with the SwipeTrace that times
+# the handling of the change) to a 'Dispatcher', which arranges for the
+# reader's trigger_pin_state_change to be called.
+#
+# Handling a state change can take a while (reading the card over i2c means
+# waiting for the card reader to answer), so the dispatcher decides whether
+# that happens in the event loop itself, or elsewhere.
+#
+# Readers without trigger pins are polled for cards instead (see
+# poll_scheduler.py). Polls are dispatched in the same way, with a pin_value
+# of None.
+
+
+def _handle(reader, pin_value, devices_by_name, trace):
+    if pin_value is None:
+        metrics.reader_events.inc(reader.name, 'poll')
+        reader.poll(devices_by_name, trace)
+    else:
+        metrics.reader_events.inc(reader.name,
+                'removed' if pin_value else 'presented')
+        reader.trigger_pin_state_change(pin_value, devices_by_name, trace)
+
+
+# Handles each state change in the event loop itself, one at a time. Simple,
+# but a slow or stuck reader holds up every other reader.
+class SerialDispatcher:
+
+    def __init__(self, devices_by_name):
+        """Serial Dispatcher Constructor"""
+        self.devices_by_name = devices_by_name
+
+    def dispatch(self, reader, pin_value, trace=None):
+        _handle(reader, pin_value, self.devices_by_name, trace)
+
+    def forget_reader(self, reader_name):
+        pass
+
+    def stop(self):
+        pass
+
+
+# Gives each reader its own worker thread, so that reads on different
+# readers overlap, and a slow reader only holds up itself. State changes
+# for any one reader are still handled in the order they happened.
+class ThreadedDispatcher:
+
+    def __init__(self, devices_by_name):
+        """Threaded Dispatcher Constructor"""
+        self.devices_by_name = devices_by_name
+        self._workers_by_reader_name = {}
+
+    def dispatch(self, reader, pin_value, trace=None):
+        if reader.name not in self._workers_by_reader_name:
+            worker = _ReaderWorker(reader, self.devices_by_name)
+            worker.start()
+            self._workers_by_reader_name[reader.name] = worker
+        self._workers_by_reader_name[reader.name].submit(pin_value, trace)
+
+    # Stop the worker for a reader that has been removed or replaced (e.g.
+    # when the config file is reloaded). It finishes what it's doing, but
+    # drops anything still queued
+    def forget_reader(self, reader_name):
+        worker = self._workers_by_reader_name.pop(reader_name, None)
+        if worker is not None:
+            worker.stop()
+
+    def stop(self):
+        for worker in self._workers_by_reader_name.values():
+            worker.stop()
+        for worker in self._workers_by_reader_name.values():
+            worker.join()
+        self._workers_by_reader_name = {}
+
+
+# The worker thread behind ThreadedDispatcher, for a single reader
+class _ReaderWorker(threading.Thread):
+
+    def __init__(self, reader, devices_by_name):
+        threading.Thread.__init__(self,
+                name="reader-%s" % reader.name, daemon=True)
+        self.reader = reader
+        self.devices_by_name = devices_by_name
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    # Queue a new pin value for the reader.
+    #
+    # The pin going high means the card has been removed. Once that has
+    # happened, any card reads still waiting in the queue are pointless, so
+    # we drop them and let the device be disabled as soon as the reader has
+    # finished whatever it is doing right now
+    def submit(self, pin_value, trace=None):
+        with self._condition:
+            if pin_value:
+                dropped = len(self._pending)
+                self._pending.clear()
+                if dropped:
+                    logging.debug("Reader %s - dropped %d stale events",
+                            self.reader.name, dropped)
+            self._pending.append((pin_value, trace))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                pin_value, trace = self._pending.popleft()
+
+            try:
+                _handle(self.reader, pin_value, self.devices_by_name, trace)
+            except Exception:
+                logging.exception("Error handling state change on reader %s",
+                        self.reader.name)
+
+
+dispatchers_by_mode = {
+    'serial':   SerialDispatcher,
+    'threaded': ThreadedDispatcher,
+}
@@ -0,0 +1,97 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Class - EdgeDebouncer
+###############################################################################
+
+# A card held badly at the edge of a reader's range can make its trigger pin
+# flap between 'present' and 'removed' many times a second. Each of those
+# would otherwise mean an i2c read and an ACL check, and the relay switching
+# on and off.
+#
+# The event loop passes each pin's new value through an EdgeDebouncer,
+# which turns the raw edges into 'logical' transitions:
+#
+#   - a value that is the same as the last one passed on (e.g. 'present'
+#     twice, with no 'removed' in between) is dropped, so the same card isn't
+#     read again while it's still there
+#
+#   - the first change is passed on straight away, so debouncing adds no
+#     delay to a clean swipe. The pin is then left alone for the reader's
+#     'debounce time', and any edges during that time are ignored. At the
+#     end of it, the pin is read again, and if it has settled on a different
+#     value, that is passed on (and a new debounce period starts)
+class EdgeDebouncer:
+
+    def __init__(self):
+        """Edge Debouncer Constructor"""
+        self._debounce_time_by_pin = {}
+
+        # The last value passed on for each pin
+        self._logical_value_by_pin = {}
+
+        # When each pin that is being debounced will next be checked
+        self._deadline_by_pin = {}
+
+    def add_pin(self, pin_number, debounce_time):
+        self._debounce_time_by_pin[pin_number] = debounce_time
+        self._logical_value_by_pin[pin_number] = None
+
+    # Change a pin's debounce time, without forgetting its current value
+    def set_debounce_time(self, pin_number, debounce_time):
+        self._debounce_time_by_pin[pin_number] = debounce_time
+
+    def remove_pin(self, pin_number):
+        del self._debounce_time_by_pin[pin_number]
+        del self._logical_value_by_pin[pin_number]
+        self._deadline_by_pin.pop(pin_number, None)
+
+    # Called for each raw edge. Returns the value to act on, or None if
+    # the edge should be ignored
+    def edge(self, pin_number, value, now):
+        if pin_number in self._deadline_by_pin:
+            return None
+        return self._transition(pin_number, value, now)
+
+    # The earliest time a pin needs to be checked again, or None
+    def next_deadline(self):
+        if not self._deadline_by_pin:
+            return None
+        return min(self._deadline_by_pin.values())
+
+    # Check the pins whose debounce periods have ended, using read_value
+    # (a function taking a pin number) to read their current values.
+    # Returns a list of (pin number, value) to act on
+    def due(self, now, read_value):
+        results = []
+        for pin_number, deadline in list(self._deadline_by_pin.items()):
+            if deadline > now:
+                continue
+            del self._deadline_by_pin[pin_number]
+            value = self._transition(pin_number, read_value(pin_number), now)
+            if value is not None:
+                results.append((pin_number, value))
+        return results
+
+    def _transition(self, pin_number, value, now):
+        if value == self._logical_value_by_pin[pin_number]:
+            return None
+        self._logical_value_by_pin[pin_number] = value
+        if self._debounce_time_by_pin[pin_number] > 0:
+            self._deadline_by_pin[pin_number] = \
+                    now + self._debounce_time_by_pin[pin_number]
+        return value
@@ -0,0 +1,297 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import logging
+import os
+import select
+import signal
+import time
+
+# Local Packages
+import edge_debouncer
+import hardware
+import latency_trace
+import metrics
+import pin_plan
+import poll_scheduler
+import timer_queue
+import traffic_trace
+
+###############################################################################
+# Event loop
+###############################################################################
+
+# The loop that watches the readers' trigger pins and hands their changes to
+# the readers, run by rpac.py (and by simulated_site.py, against simulated
+# hardware). It's kept apart from rpac.py so that it can be imported without
+# importing the main script a second time.
+
+# This code builds a set of 'Pin' objects relating to
+# the hardware pins in the config file. These Pin objects
+# are then map to the underlying card Readers, so that
+# a change in state on the hardware Pin can trigger the
+# configured underlying Object
+def build_hardware_pin_map(readers_by_name):
+    pin_objects_to_watch = {}
+    for reader in readers_by_name:
+        trigger_pin = readers_by_name[reader].trigger_pin
+        # Readers without a trigger pin are polled instead
+        if trigger_pin is None:
+            continue
+        assert trigger_pin not in pin_objects_to_watch, \
+            "Pin %s is set as the 'trigger pin' for more " \
+            " than one reader or button" % trigger_pin
+        # In the pins-to-watch code, we set a reference to the reader
+        # object itself
+        pin_objects_to_watch[trigger_pin] = {}
+        pin_objects_to_watch[trigger_pin]['handler_object'] = \
+                    readers_by_name[reader]
+
+        # Create an 'input' pin object from quick2wire.gpio
+        pin_objects_to_watch[trigger_pin]['gpio_pin'] = \
+                    hardware.gpio.pins.pin(trigger_pin)
+
+    # Open the pins, watching both rising and falling edge transitions -
+    # for the cards arriving and leaving. This is done for all of the pins
+    # at once, as opening each one can be slow
+    pin_plan.open_pins([pin_objects_to_watch[pin_num]['gpio_pin']
+                for pin_num in pin_objects_to_watch],
+            hardware.gpio.In, hardware.gpio.Both)
+
+    return pin_objects_to_watch
+
+
+# LOOPS FOREVER
+#
+# This code sits and waits for state changes on the configured hardware pins.
+# The new pin value is read here, passed through the debouncer (which drops
+# bounces and repeats of the same value), and then handed to the dispatcher,
+# which calls the reader's handler (either straight away, or in another
+# thread)
+#
+# If a stop_event (threading.Event) is supplied, the loop checks it every
+# so often, and returns once it is set. This is used when running rpac
+# against simulated hardware.
+#
+# Readers without trigger pins are polled for cards, as and when the
+# PollScheduler says, with the polls handed to the dispatcher too.
+#
+# Timers in timer_queue.shared_timers (e.g. for relocking devices) are run
+# here too, when they are due.
+#
+# If supplied, ready_callback is called once the pins are being watched.
+#
+# If reload_config is supplied, it is called when rpac receives SIGHUP, to
+# re-read the config file and update readers_by_name and devices_by_name
+# (see config.reload_config_options). The loop then starts and stops
+# watching trigger pins to match, leaving the pins of unchanged readers (and
+# any edges waiting on them) alone.
+#
+def wait_for_pin_state_changes(readers_by_name, devices_by_name,
+            event_dispatcher, stop_event=None, ready_callback=None,
+            reload_config=None):
+    fds_to_pins = {}
+
+    # Fetch a list of pins to watch, each of which maps to
+    # a card reader
+    pin_objects_to_watch = build_hardware_pin_map(readers_by_name)
+
+
+    # Configure the select handler, setting it to watch the
+    # filedescriptors that underly the hardware pins.
+    # To do this, we grab the filedescriptors that underly the
+    # pins, and build a map between filedescriptors and objects
+    epoll_handler = select.epoll()
+    for pin_num in pin_objects_to_watch:
+        handler_object = pin_objects_to_watch[pin_num]['handler_object']
+        gpio_pin = pin_objects_to_watch[pin_num]['gpio_pin']
+
+        epoll_handler.register(gpio_pin, hardware.edge_event_mask)
+        fds_to_pins[gpio_pin.fileno()] = pin_num
+
+    debouncer = edge_debouncer.EdgeDebouncer()
+    for pin_num in pin_objects_to_watch:
+        debouncer.add_pin(pin_num,
+                pin_objects_to_watch[pin_num]['handler_object'].debounce_time)
+
+    scheduler = poll_scheduler.PollScheduler(readers_by_name.values())
+
+    timers = timer_queue.shared_timers
+    epoll_handler.register(timers.fileno(), select.EPOLLIN)
+
+    def read_pin_value(pin_num):
+        return pin_objects_to_watch[pin_num]['gpio_pin'].value
+
+    # Signals interrupt epoll, but Python retries the wait rather than
+    # returning. So that a SIGHUP is acted on straight away, signals are
+    # also written to a pipe that epoll watches
+    reload_requested = []
+    signal_fd = None
+    if reload_config is not None:
+        signal_fd, signal_write_fd = os.pipe()
+        os.set_blocking(signal_fd, False)
+        os.set_blocking(signal_write_fd, False)
+        signal.set_wakeup_fd(signal_write_fd)
+        epoll_handler.register(signal_fd, select.EPOLLIN)
+        signal.signal(signal.SIGHUP,
+                lambda signum, frame: reload_requested.append(signum))
+
+    # Bring the watched pins into line with readers_by_name, after the
+    # config has been reloaded
+    def update_watched_pins():
+        readers_by_pin = dict((reader.trigger_pin, reader)
+                for reader in readers_by_name.values()
+                if reader.trigger_pin is not None)
+        for reader in scheduler.readers:
+            if readers_by_name.get(reader.name) is not reader:
+                event_dispatcher.forget_reader(reader.name)
+        scheduler.set_readers(readers_by_name.values())
+        for pin_num in list(pin_objects_to_watch):
+            handler_object = pin_objects_to_watch[pin_num]['handler_object']
+            if readers_by_pin.get(pin_num) is not handler_object:
+                event_dispatcher.forget_reader(handler_object.name)
+            if pin_num not in readers_by_pin:
+                gpio_pin = pin_objects_to_watch.pop(pin_num)['gpio_pin']
+                epoll_handler.unregister(gpio_pin)
+                del fds_to_pins[gpio_pin.fileno()]
+                debouncer.remove_pin(pin_num)
+                gpio_pin.close()
+                logging.info("Stopped watching pin %s", pin_num)
+
+        new_pins = []
+        for pin_num, reader in readers_by_pin.items():
+            if pin_num in pin_objects_to_watch:
+                pin_objects_to_watch[pin_num]['handler_object'] = reader
+                debouncer.set_debounce_time(pin_num, reader.debounce_time)
+            else:
+                pin_objects_to_watch[pin_num] = {
+                    'handler_object': reader,
+                    'gpio_pin': hardware.gpio.pins.pin(pin_num),
+                }
+                new_pins.append(pin_num)
+
+        pin_plan.open_pins([pin_objects_to_watch[pin_num]['gpio_pin']
+                    for pin_num in new_pins],
+                hardware.gpio.In, hardware.gpio.Both)
+        for pin_num in new_pins:
+            gpio_pin = pin_objects_to_watch[pin_num]['gpio_pin']
+            epoll_handler.register(gpio_pin, hardware.edge_event_mask)
+            fds_to_pins[gpio_pin.fileno()] = pin_num
+            debouncer.add_pin(pin_num,
+                    pin_objects_to_watch[pin_num]['handler_object']
+                        .debounce_time)
+            logging.info("Started watching pin %s", pin_num)
+
+    if ready_callback is not None:
+        ready_callback()
+
+    # Loop forever, waiting for pin state changes, and triggering the
+    # pins based on their values
+    while stop_event is None or not stop_event.is_set():
+        # Wake up in time for the debouncer to check any pins it is
+        # waiting to settle, and for the next reader poll
+        now = time.monotonic()
+        deadlines = [deadline for deadline in (debouncer.next_deadline(),
+                    scheduler.next_deadline(now), timers.next_deadline())
+                if deadline is not None]
+        next_deadline = min(deadlines) if deadlines else None
+        poll_timeout = -1 if stop_event is None else 0.05
+        if next_deadline is not None:
+            wait = max(0, next_deadline - now)
+            poll_timeout = wait if poll_timeout < 0 \
+                    else min(poll_timeout, wait)
+
+        logging.debug("Waiting for event on reader pins")
+        events = epoll_handler.poll(poll_timeout)
+        edge_time = time.monotonic()
+        if next_deadline is not None and edge_time >= next_deadline:
+            metrics.loop_lag.observe(edge_time - next_deadline)
+        for filedescriptor, event in events:
+            if filedescriptor == signal_fd:
+                try:
+                    os.read(signal_fd, 4096)
+                except BlockingIOError:
+                    pass
+                continue
+            if filedescriptor == timers.fileno():
+                timers.clear_wakeup()
+                continue
+
+            # Each state change carries a trace, which times each step of
+            # handling it (see latency_trace.py)
+            trace = latency_trace.SwipeTrace(edge_time)
+            pin_no = fds_to_pins[filedescriptor]
+            logging.debug("Got event on pin number %s", pin_no)
+            pin_value = read_pin_value(pin_no)
+            trace.mark('gpio read')
+            traffic_trace.record_edge(edge_time, pin_no, pin_value)
+
+            pin_value = debouncer.edge(pin_no, pin_value, edge_time)
+            if pin_value is None:
+                logging.debug("Ignoring bounce or repeat on pin %s", pin_no)
+                continue
+            event_dispatcher.dispatch(
+                        pin_objects_to_watch[pin_no]['handler_object'],
+                        pin_value, trace)
+
+        # Pins that have settled on a new value after bouncing
+        for pin_no, pin_value in debouncer.due(time.monotonic(),
+                    read_pin_value):
+            trace = latency_trace.SwipeTrace()
+            trace.mark('gpio read')
+            logging.debug("Pin %s settled at %s", pin_no, pin_value)
+            event_dispatcher.dispatch(
+                        pin_objects_to_watch[pin_no]['handler_object'],
+                        pin_value, trace)
+
+        # Readers that are due to be polled for cards
+        for reader in scheduler.due(time.monotonic()):
+            event_dispatcher.dispatch(reader, None,
+                    latency_trace.SwipeTrace())
+
+        timers.run_due(time.monotonic())
+
+        # Reload the config once any pin changes that arrived with the
+        # SIGHUP have been handled
+        if reload_requested:
+            del reload_requested[:]
+            logging.info("Reloading config")
+            reload_started = time.monotonic()
+            # Whatever goes wrong with the new file, the doors must keep
+            # working with the current one
+            try:
+                reload_config()
+            except Exception as e:
+                logging.exception("Can't reload config (%s) - carrying on "
+                        "with the current one", e)
+                metrics.config_reloads.inc('error')
+            else:
+                update_watched_pins()
+                metrics.config_reloads.inc('ok')
+                metrics.config_reload_duration.set(
+                        time.monotonic() - reload_started)
+
+        # How long this took is how late we could be to see the next edge
+        metrics.loop_busy.observe(time.monotonic() - edge_time)
+
+    if signal_fd is not None:
+        signal.set_wakeup_fd(-1)
+        os.close(signal_fd)
+        os.close(signal_write_fd)
+    epoll_handler.close()
+    for pin_num in pin_objects_to_watch:
+        pin_objects_to_watch[pin_num]['gpio_pin'].close()
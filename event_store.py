@@ -0,0 +1,239 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Event store: an indexed history of access decisions
+###############################################################################
+
+# Every access decision that goes to the audit log (see rpac_logging.py) is
+# also written to a SQLite database, so that questions like "who opened
+# front_door last Tuesday" can be answered quickly (see query_events.py),
+# rather than by searching through rotated log files.
+#
+# Each event is a row in the 'events' table:
+#
+#   time        seconds since the epoch (UTC)
+#   device      the device name
+#   card        the card ID (bytes), or NULL if there wasn't one (e.g. the
+#               card was removed, or couldn't be read)
+#   decision    'granted', 'denied', 'removed' or 'relocked' (the device
+#               was locked by its 'max unlock time' - see
+#               controlled_device.py)
+#
+# with indexes on time, and on device and card (each followed by time).
+#
+# Events are queued and written by a background thread. Once an event
+# arrives, the thread waits up to 'flush delay' seconds for more before
+# writing them all in one transaction, so the SD card sees about one write
+# a second at most, however busy the doors are. Events older than the
+# retention period are deleted every so often, and the space they used
+# handed back to the filesystem.
+
+# System-Wide packages
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+# The decisions recorded in the 'decision' column
+decisions = ('granted', 'denied', 'removed', 'relocked')
+
+_schema = """
+    CREATE TABLE IF NOT EXISTS events (
+        id          INTEGER PRIMARY KEY,
+        time        REAL NOT NULL,
+        device      TEXT NOT NULL,
+        card        BLOB,
+        decision    TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS events_time ON events (time);
+    CREATE INDEX IF NOT EXISTS events_device_time ON events (device, time);
+    CREATE INDEX IF NOT EXISTS events_card_time ON events (card, time);
+"""
+
+
+# With --supervise, each worker process writes to the same database, so a
+# write may have to wait for another process's to finish. How long to wait,
+# in seconds, before giving up with 'database is locked'
+busy_timeout = 10.0
+
+
+# Open (creating if needed) an event store database
+def open_event_store(filename):
+    connection = sqlite3.connect(filename, timeout=busy_timeout)
+    # Must be set before the first table is created to have any effect
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.executescript(_schema)
+    return connection
+
+
+# Find events, newest first. Times are seconds since the epoch, and
+# 'since' is inclusive while 'until' isn't
+def query_events(connection, device=None, card=None, decision=None,
+            since=None, until=None, limit=None):
+    conditions = []
+    parameters = []
+    for column, operator, value in (('device', '=', device),
+                ('card', '=', card), ('decision', '=', decision),
+                ('time', '>=', since), ('time', '<', until)):
+        if value is not None:
+            conditions.append("%s %s ?" % (column, operator))
+            parameters.append(value)
+    sql = "SELECT time, device, card, decision FROM events"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY time DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        parameters.append(limit)
+    return connection.execute(sql, parameters).fetchall()
+
+
+###############################################################################
+# Class - EventStore
+###############################################################################
+
+class EventStore(threading.Thread):
+
+    # Most events to write in one transaction, and how long to wait after
+    # the first event for others to write with it, in seconds
+    batch_size = 500
+    flush_delay = 1.0
+
+    # Events that couldn't be written are kept, and tried again (with any
+    # that have arrived since) after 'retry delay' seconds. When stopping,
+    # they are tried 'stop attempts' times before giving up on them
+    retry_delay = 1.0
+    stop_attempts = 3
+
+    # How often to delete events older than the retention period, and how
+    # many pages of free space to hand back each time
+    expire_interval = 60 * 60
+    vacuum_pages = 1000
+
+    def __init__(self, filename, retention_days=None):
+        """Event Store Constructor"""
+        threading.Thread.__init__(self, name="event-store", daemon=True)
+        self.filename = filename
+        self.retention_days = retention_days
+        self._queue = queue.SimpleQueue()
+        self._next_expiry = 0
+
+        # Open the database here, so that any problem with it shows up at
+        # startup. SQLite connections belong to the thread that opened them,
+        # so the background thread opens its own
+        open_event_store(filename).close()
+        self._connection = None
+
+    def add(self, when, device_name, card, decision):
+        self._queue.put((when, device_name, card, decision))
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        self._connection = open_event_store(self.filename)
+        batch = []
+        stopping = False
+        while not stopping:
+            stopping = self._collect(batch)
+            if batch and self._write(batch):
+                batch = []
+
+        for attempt in range(self.stop_attempts):
+            if not batch:
+                break
+            if attempt:
+                time.sleep(self.retry_delay)
+            if self._write(batch):
+                batch = []
+        if batch:
+            logging.error("Gave up writing %d events to %s", len(batch),
+                    self.filename)
+        self._connection.close()
+
+    # Wait for events, adding them to batch. Returns True once stop() has
+    # been called
+    def _collect(self, batch):
+        deadline = None
+        if batch:
+            # Writing these failed last time - give whatever was in the way
+            # time to finish before trying again
+            deadline = time.monotonic() + self.retry_delay
+        limit = len(batch) + self.batch_size
+        while len(batch) < limit:
+            try:
+                if deadline is None:
+                    event = self._queue.get()
+                    deadline = time.monotonic() + self.flush_delay
+                else:
+                    event = self._queue.get(
+                            timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if event is None:
+                return True
+            batch.append(event)
+        return False
+
+    # Write the events in one transaction. Returns whether they were written
+    def _write(self, batch):
+        try:
+            with self._connection:
+                self._connection.executemany("INSERT INTO events "
+                        "(time, device, card, decision) "
+                        "VALUES (?, ?, ?, ?)", batch)
+        except sqlite3.Error as e:
+            logging.error("Can't write %d events to %s (%s) - will try again",
+                    len(batch), self.filename, e)
+            return False
+        try:
+            self._expire_if_due()
+        except sqlite3.Error as e:
+            logging.error("Can't delete old events from %s (%s)",
+                    self.filename, e)
+        return True
+
+    def _expire_if_due(self):
+        now = time.time()
+        if not self.retention_days or now < self._next_expiry:
+            return
+        self._next_expiry = now + self.expire_interval
+        with self._connection:
+            deleted = self._connection.execute(
+                    "DELETE FROM events WHERE time < ?",
+                    (now - self.retention_days * 24 * 60 * 60,)).rowcount
+        if deleted:
+            self._connection.execute("PRAGMA incremental_vacuum(%d)"
+                    % self.vacuum_pages)
+            logging.info("Deleted %d events older than %d days from %s",
+                    deleted, self.retention_days, self.filename)
+
+
+# Passes audit log records (see rpac_logging.audit) to an EventStore
+class EventStoreHandler(logging.Handler):
+
+    def __init__(self, event_store):
+        logging.Handler.__init__(self)
+        self.event_store = event_store
+
+    def emit(self, record):
+        self.event_store.add(record.created, record.device, record.card,
+                record.msg)
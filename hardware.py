@@ -0,0 +1,67 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Hardware backends
+###############################################################################
+
+# The rest of the code talks to the GPIO pins and the i2c bus through
+# 'hardware.gpio' and 'hardware.i2c', rather than importing quick2wire
+# directly. These are normally the quick2wire modules, but can be switched to
+# simulated versions (see simulated_gpio.py and simulated_i2c.py), so that
+# the code can be run and measured on a machine that isn't a Pi.
+#
+# The backend is chosen with use_backend() before any hardware is used. If
+# that isn't called, the RPAC_HARDWARE environment variable is used, and if
+# that isn't set either, quick2wire.
+
+# System-Wide packages
+import importlib
+import os
+import select
+
+# For each backend: the gpio module, the i2c module, and the epoll event mask
+# that signals a change on an input pin.
+#
+# The kernel signals GPIO edges as 'exceptional conditions' (POLLPRI/POLLERR),
+# which epoll always reports, whereas the simulated pins are pipes, which
+# become readable.
+backends = {
+    'quick2wire': ('quick2wire.gpio', 'quick2wire.i2c', select.EPOLLET),
+    'simulated':  ('simulated_gpio', 'simulated_i2c',
+                        select.EPOLLIN | select.EPOLLET),
+}
+
+backend_name = None
+
+
+def use_backend(name):
+    global backend_name, edge_event_mask, gpio, i2c
+    if name not in backends:
+        raise ValueError("Unknown hardware backend '%s'" % name)
+    gpio_module, i2c_module, edge_event_mask = backends[name]
+    gpio = importlib.import_module(gpio_module)
+    i2c = importlib.import_module(i2c_module)
+    backend_name = name
+
+
+# 'gpio', 'i2c' and 'edge_event_mask' only exist once a backend has been
+# chosen. If they're used before then, load the default backend
+def __getattr__(name):
+    if name in ('gpio', 'i2c', 'edge_event_mask') and backend_name is None:
+        use_backend(os.environ.get('RPAC_HARDWARE', 'quick2wire'))
+        return globals()[name]
+    raise AttributeError("module 'hardware' has no attribute '%s'" % name)
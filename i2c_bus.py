@@ -0,0 +1,187 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import contextlib
+import errno
+import fcntl
+import logging
+import threading
+import time
+
+# Local Packages
+import hardware
+
+###############################################################################
+# Class - I2CBus
+###############################################################################
+
+# An 'I2C Bus' manages access to one of the Pi's i2c buses (through the
+# quick2wire I2CMaster, or a simulated one - see hardware.py). All of the readers
+# attached to the bus share the one I2CBus object (see
+# config.parse_config_options), which:
+#
+#   - keeps the underlying device handle open, rather than opening and
+#     closing it for each card read
+#
+#   - only lets one transaction use the bus at a time, so that readers on
+#     the same bus don't collide with each other
+#
+#   - closes and reopens the handle if it stops working
+#
+#   - bounds how long a transaction can take. The kernel is asked to give
+#     up on a transaction after 'transaction timeout' seconds, and a
+#     transaction that can't get the bus within that time (because another
+#     one is stuck) fails rather than waiting
+#
+# Only individual transactions are serialised: a reader that is waiting for
+# its card reader to answer doesn't stop other readers using the bus.
+#
+# Readers without a trigger pin are polled for cards (see poll_scheduler.py).
+# So that polling can't crowd out the readers that have been triggered, the
+# bus keeps track of:
+#
+#   - how many triggered card reads are under way. Polling waits until
+#     there are none
+#
+#   - how much of the bus's time polling has used. Polling is allowed to
+#     use 'poll budget' (a proportion, e.g. 0.5 for half) of the bus's time,
+#     as a 'credit' of bus time that builds up as time passes (up to
+#     'poll burst' seconds' worth) and is used up by polling transactions
+class I2CBus:
+
+    poll_budget = 0.5
+    poll_burst = 0.05
+    transaction_timeout = 0.1
+
+    # The i2c-dev ioctl that sets the adapter's timeout, in units of 10ms
+    i2c_timeout_ioctl = 0x0702
+
+    # Errors that mean the handle itself is broken, rather than that the
+    # device we were talking to didn't answer (which is routine - the SL030
+    # doesn't acknowledge reads until it is ready)
+    handle_errors = (errno.EBADF, errno.ENODEV, errno.ENOENT, errno.ESHUTDOWN)
+
+    def __init__(self, bus_number=None):
+        """I2C Bus Constructor"""
+        # None means quick2wire's default bus for this revision of the Pi
+        self.bus_number = bus_number
+        self._master = None
+        self._lock = threading.Lock()
+
+        self.card_reads_in_progress = 0
+        self._poll_credit = self.poll_burst
+        self._poll_credit_time = time.monotonic()
+        self._poll_lock = threading.Lock()
+        self._polling_threads = threading.local()
+
+    def __str__(self):
+        if self.bus_number is None:
+            return "default i2c bus"
+        return "i2c bus %d" % self.bus_number
+
+    # Run a set of quick2wire i2c messages (i2c.writing_bytes, i2c.reading,
+    # etc) as one transaction, and return the results
+    def transaction(self, *messages):
+        if not self._lock.acquire(timeout=self.transaction_timeout):
+            raise OSError(errno.ETIMEDOUT, "%s busy for more than %.3fs"
+                    % (self, self.transaction_timeout))
+        try:
+            if self._master is None:
+                self._open()
+            started = time.monotonic()
+            try:
+                return self._master.transaction(*messages)
+            except OSError as e:
+                if e.errno in self.handle_errors:
+                    logging.error("Error on %s (%s) - reopening", self, e)
+                    self._close()
+                raise
+            finally:
+                if getattr(self._polling_threads, 'polling', False):
+                    with self._poll_lock:
+                        self._poll_credit -= time.monotonic() - started
+        finally:
+            self._lock.release()
+
+    # Transactions made inside 'with bus.reading_card()' are a triggered
+    # card read, and inside 'with bus.polling()' a poll
+    @contextlib.contextmanager
+    def reading_card(self):
+        with self._poll_lock:
+            self.card_reads_in_progress += 1
+        try:
+            yield
+        finally:
+            with self._poll_lock:
+                self.card_reads_in_progress -= 1
+
+    @contextlib.contextmanager
+    def polling(self):
+        self._polling_threads.polling = True
+        try:
+            yield
+        finally:
+            self._polling_threads.polling = False
+
+    # The earliest time (no earlier than 'now') at which polling has some
+    # bus time left to use
+    def poll_allowed_at(self, now):
+        with self._poll_lock:
+            self._poll_credit = min(self.poll_burst, self._poll_credit
+                    + (now - self._poll_credit_time) * self.poll_budget)
+            self._poll_credit_time = now
+            if self._poll_credit > 0:
+                return now
+            return now - self._poll_credit / self.poll_budget
+
+    # Open the handle now, rather than on the first transaction. Errors
+    # are logged, and opening is tried again on the next transaction
+    def open(self):
+        with self._lock:
+            if self._master is None:
+                try:
+                    self._open()
+                except OSError as e:
+                    logging.error("Can't open %s (%s)", self, e)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _open(self):
+        if self.bus_number is None:
+            self._master = hardware.i2c.I2CMaster()
+        else:
+            self._master = hardware.i2c.I2CMaster(self.bus_number)
+        logging.info("Opened %s", self)
+
+        # Not every backend has a file descriptor to set the timeout on
+        fd = getattr(self._master, 'fd', None)
+        if fd is not None:
+            try:
+                fcntl.ioctl(fd, self.i2c_timeout_ioctl,
+                        max(1, int(round(self.transaction_timeout * 100))))
+            except OSError as e:
+                logging.warning("Can't set the timeout on %s (%s)", self, e)
+
+    def _close(self):
+        if self._master is not None:
+            try:
+                self._master.close()
+            except OSError:
+                pass
+            self._master = None
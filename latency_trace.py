@@ -0,0 +1,221 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import collections
+import logging
+import math
+import os
+import threading
+import time
+
+###############################################################################
+# Latency tracing
+###############################################################################
+
+# To see where the time goes between a card being presented and the door
+# opening, each state change on a trigger pin carries a 'SwipeTrace' with
+# it. As the state change is handled, each step marks the trace with the
+# (monotonic) time it finished:
+#
+#   edge        - the event loop saw the pin change
+#   gpio read   - the new value of the pin has been read
+#   i2c write   - the 'select card' command has been sent to the reader
+#   i2c read    - the reader has answered with the card ID
+#   acl lookup  - the card has been looked up in the ACL
+#   pins set    - the device's pins have been set
+#
+# When the state change has been handled, the trace is added to the reader's
+# LatencyStats, which keep the last few thousand timings of each step.
+
+stages = ('edge', 'gpio read', 'i2c write', 'i2c read', 'acl lookup',
+            'pins set')
+
+
+class SwipeTrace:
+    __slots__ = ('times',)
+
+    def __init__(self, edge_time=None):
+        """Swipe Trace Constructor"""
+        if edge_time is None:
+            edge_time = time.monotonic()
+        self.times = {'edge': edge_time}
+
+    def mark(self, stage):
+        self.times[stage] = time.monotonic()
+
+    # How long each step took (from the end of the step before it that was
+    # marked), followed by the total time from edge to last step
+    def durations(self):
+        result = []
+        previous = self.times['edge']
+        for stage in stages[1:]:
+            if stage in self.times:
+                result.append((stage, self.times[stage] - previous))
+                previous = self.times[stage]
+        result.append(('total', previous - self.times['edge']))
+        return result
+
+
+# Rolling window of the most recent timings of one step
+class LatencyHistogram:
+
+    def __init__(self, window):
+        """Latency Histogram Constructor"""
+        self._samples = collections.deque(maxlen=window)
+        self.count = 0
+
+    def add(self, duration):
+        self._samples.append(duration)
+        self.count += 1
+
+    # Returns the requested percentiles (e.g. 50, 95, 99) of the timings
+    # currently in the window, and the maximum
+    def percentiles(self, *percents):
+        samples = sorted(self._samples)
+        if not samples:
+            return [None] * len(percents), None
+        results = []
+        for percent in percents:
+            rank = max(1, int(math.ceil(percent / 100.0 * len(samples))))
+            results.append(samples[rank - 1])
+        return results, samples[-1]
+
+
+# The timings of one kind of event (e.g. card presented) on one reader
+class LatencyStats:
+
+    def __init__(self, window=5000):
+        """Latency Stats Constructor"""
+        self.window = window
+        self._histograms_by_stage = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        with self._lock:
+            for stage, duration in trace.durations():
+                self._add(stage, duration)
+
+    # Record a single timing, for events that aren't traced step by step
+    def record_duration(self, stage, duration):
+        with self._lock:
+            self._add(stage, duration)
+
+    def _add(self, stage, duration):
+        if stage not in self._histograms_by_stage:
+            self._histograms_by_stage[stage] = LatencyHistogram(self.window)
+        self._histograms_by_stage[stage].add(duration)
+
+    # For each stage: the number of timings recorded, and the p50, p95, p99
+    # and maximum of those in the window, in seconds
+    def summary(self):
+        result = collections.OrderedDict()
+        with self._lock:
+            for stage, histogram in self._histograms_by_stage.items():
+                (p50, p95, p99), maximum = \
+                        histogram.percentiles(50, 95, 99)
+                result[stage] = {'count': histogram.count, 'p50': p50,
+                        'p95': p95, 'p99': p99, 'max': maximum}
+        return result
+
+    def report_lines(self):
+        lines = ["  %-12s %8s %9s %9s %9s %9s" % (
+                'stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for stage, s in self.summary().items():
+            lines.append("  %-12s %8d %9.2f %9.2f %9.2f %9.2f" % (
+                    stage, s['count'], s['p50'] * 1000, s['p95'] * 1000,
+                    s['p99'] * 1000, s['max'] * 1000))
+        return lines
+
+
+# Build a report of the timings for every reader, and for setting the pins
+# of every device that has 'time pin writes' set
+def latency_report(readers_by_name, devices_by_name={}):
+    lines = ["# rpac latency report, %s" % time.strftime('%Y-%m-%d %H:%M:%S')]
+    for reader_name in sorted(readers_by_name):
+        reader = readers_by_name[reader_name]
+        for kind, stats in (('card presented', reader.swipe_latency),
+                            ('card removed', reader.removal_latency)):
+            lines.append("")
+            lines.append("reader %s - %s" % (reader_name, kind))
+            lines.extend(stats.report_lines())
+    for device_name in sorted(devices_by_name):
+        device = devices_by_name[device_name]
+        if device.transition_latency is None:
+            continue
+        lines.append("")
+        lines.append("device %s - setting pins (%d verify failures)" % (
+                device_name, device.verify_failures))
+        lines.extend(device.transition_latency.report_lines())
+    return "\n".join(lines) + "\n"
+
+
+###############################################################################
+# Class - LatencyReporter
+###############################################################################
+
+# Writes the latency report to a file, every 'interval' seconds (if set) and
+# whenever asked to with request_report(), e.g. from a signal handler.
+#
+# The report is written from a background thread. That way a signal handler
+# only has to set a flag, and never waits on a lock held by the code it
+# interrupted.
+#
+# readers_by_name and devices_by_name can be changed by a config reload
+# while the report is being written, so the report is made from copies of
+# them, taken while holding 'lock' (see config.reload_lock).
+class LatencyReporter(threading.Thread):
+
+    def __init__(self, readers_by_name, report_filename, interval=None,
+                devices_by_name={}, lock=None):
+        """Latency Reporter Constructor"""
+        threading.Thread.__init__(self, name="latency-reporter", daemon=True)
+        self.readers_by_name = readers_by_name
+        self.devices_by_name = devices_by_name
+        if lock is None:
+            lock = threading.Lock()
+        self.lock = lock
+        self.report_filename = report_filename
+        self.interval = interval
+        self._wakeup = threading.Event()
+
+    def request_report(self):
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.write_report()
+            except OSError as e:
+                logging.error("Can't write latency report to %s (%s)",
+                        self.report_filename, e)
+            except Exception:
+                logging.exception("Error writing latency report to %s",
+                        self.report_filename)
+
+    # Write to a temporary file and rename it into place, so anything
+    # watching the report never sees half of one
+    def write_report(self):
+        with self.lock:
+            readers_by_name = dict(self.readers_by_name)
+            devices_by_name = dict(self.devices_by_name)
+        temp_filename = self.report_filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(latency_report(readers_by_name, devices_by_name))
+        os.replace(temp_filename, self.report_filename)
+        logging.info("Latency report written to %s", self.report_filename)
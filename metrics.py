@@ -0,0 +1,241 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Metrics
+###############################################################################
+
+# Counters and gauges describing what rpac is doing, for monitoring a fleet
+# of Pis (e.g. alerting on a reader that has started timing out). When
+# rpac.py is run with --metrics-port, they are served over HTTP on
+# localhost, in the Prometheus text format:
+#
+#   curl http://127.0.0.1:9464/metrics
+#
+# Updating a metric only takes a lock and adds to a number, so it is cheap
+# enough to do in the event loop. The metrics are only formatted when they
+# are asked for, by the server's own thread.
+
+# System-Wide packages
+import http.server
+import logging
+import threading
+
+# Every metric, in the order they were defined
+_metrics = []
+
+
+# The values of one metric, for each combination of label values (e.g. one
+# count per reader). Label values are supplied to inc()/set()/observe() in
+# the same order as the label names
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, label_names=()):
+        """Metric Constructor"""
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _labels(self, label_values):
+        if not label_values:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(str(value)))
+                for name, value in zip(self.label_names, label_values))
+
+    def lines(self):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                "# TYPE %s %s" % (self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._sample_lines(label_values, value))
+        return lines
+
+    def _sample_lines(self, label_values, value):
+        return ["%s%s %s" % (self.name, self._labels(label_values),
+                _format_value(value))]
+
+
+# A count of things that have happened, which only ever goes up
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = \
+                    self._values.get(label_values, 0) + amount
+
+
+# A value that can go up and down, e.g. how long the last ACL reload took
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+# The number and total of a set of timings, from which the average over any
+# period can be worked out (Prometheus' rate(x_sum) / rate(x_count)). The
+# largest since the metrics were last served is also kept, so that one slow
+# read isn't lost in the average
+class Summary(_Metric):
+    kind = 'summary'
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            count, total, maximum = \
+                    self._values.get(label_values, (0, 0.0, 0.0))
+            self._values[label_values] = \
+                    (count + 1, total + value, max(maximum, value))
+
+    # The maximum is served as a gauge of its own, '<name>_max'
+    def lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+            for label_values, (count, total, maximum) in values:
+                self._values[label_values] = (count, total, 0.0)
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                "# TYPE %s summary" % self.name]
+        for label_values, (count, total, maximum) in values:
+            labels = self._labels(label_values)
+            lines.append("%s_count%s %d" % (self.name, labels, count))
+            lines.append("%s_sum%s %s" % (self.name, labels,
+                    _format_value(total)))
+        lines.append("# HELP %s_max Largest of %s since last served"
+                % (self.name, self.name))
+        lines.append("# TYPE %s_max gauge" % self.name)
+        for label_values, (count, total, maximum) in values:
+            lines.append("%s_max%s %s" % (self.name,
+                    self._labels(label_values), _format_value(maximum)))
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# All of the metrics, in the Prometheus text format
+def exposition():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.lines())
+    return "\n".join(lines) + "\n"
+
+
+###############################################################################
+# The metrics themselves
+###############################################################################
+
+# Handled by the readers (see dispatcher.py): 'presented' and 'removed' for
+# trigger pin changes, and 'poll' for polls of readers without one
+reader_events = Counter('rpac_reader_events_total',
+        "Trigger pin changes and polls handled, by reader",
+        ('reader', 'event'))
+
+# Answers to the SL030's 'select card' command: 'card', 'no_tag', or the
+# errors 'write_error' (the command couldn't be sent) and 'timeout' (no
+# valid answer within the response timeout)
+card_reads = Counter('rpac_card_reads_total',
+        "Card reads, by reader and result", ('reader', 'result'))
+reader_degraded = Gauge('rpac_reader_degraded',
+        "1 while a reader is out of service after failing repeatedly",
+        ('reader',))
+card_reader_response = Summary('rpac_card_reader_response_seconds',
+        "Time taken for the card reader to answer", ('reader',))
+
+# 'granted', 'denied', 'removed' or 'relocked', as in the audit log
+access_decisions = Counter('rpac_access_decisions_total',
+        "Access decisions, by device", ('device', 'decision'))
+
+acl_reloads = Counter('rpac_acl_reloads_total',
+        "ACL files loaded after changing, by result ('ok' or 'error')",
+        ('file', 'result'))
+acl_reload_duration = Gauge('rpac_acl_reload_seconds',
+        "Time taken by the last successful load of each ACL file", ('file',))
+acl_cards = Gauge('rpac_acl_cards',
+        "Cards in each ACL file when it was last loaded", ('file',))
+
+config_reloads = Counter('rpac_config_reloads_total',
+        "Config file reloads (on SIGHUP), by result ('ok' or 'error')",
+        ('result',))
+config_reload_duration = Gauge('rpac_config_reload_seconds',
+        "Time taken by the last successful config file reload")
+
+# How late the event loop woke up for a debounce or poll deadline, and how
+# long it spent handling what it woke up for - which is how late it can be
+# to see the next pin change
+loop_lag = Summary('rpac_loop_lag_seconds',
+        "How late the event loop woke up for a timed deadline")
+loop_busy = Summary('rpac_loop_busy_seconds',
+        "Time spent by the event loop handling each wake-up")
+
+
+###############################################################################
+# Class - MetricsServer
+###############################################################################
+
+# Serves the metrics at http://127.0.0.1:<port>/metrics, from a thread of
+# its own. Only localhost is listened on: the metrics are meant to be
+# collected by an agent on the Pi, or through an ssh tunnel
+class MetricsServer(threading.Thread):
+
+    def __init__(self, port, address='127.0.0.1'):
+        """Metrics Server Constructor"""
+        threading.Thread.__init__(self, name="metrics-server", daemon=True)
+        self._server = http.server.HTTPServer((address, port),
+                _MetricsRequestHandler)
+        self.port = self._server.server_address[1]
+
+    def run(self):
+        logging.info("Serving metrics on port %d", self.port)
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # Don't let a client that stops reading tie up the server
+    timeout = 10
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request from %s - %s",
+                self.address_string(), format % args)
@@ -0,0 +1,158 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Pin-write plans
+###############################################################################
+
+# Each state change of a ControlledDevice (enable or disable) sets a fixed
+# list of output pins to fixed values. Rather than working that out on every
+# change, it is compiled once, when the config file is read, into a
+# PinWritePlan: the pin objects to set, in order, and the values to set them
+# to.
+#
+# If the GPIO backend can set several pins at once (it has a write_pins()
+# function, taking a list of (pin, value) pairs), the plan is handed to it as
+# a single batch. Otherwise the pins are set one at a time.
+
+# System-Wide packages
+import concurrent.futures
+import logging
+
+# Local Packages
+import hardware
+
+
+###############################################################################
+# Class - OutputPinBank
+###############################################################################
+
+# The output pins used by the devices in one config file. Each pin is opened
+# once, and shared by every device (and plan) that sets it.
+#
+# Opening a pin can be slow (quick2wire exports it with the gpio-admin
+# command), so pins aren't opened as the config file is read, but all
+# together by open_all() once it has been.
+class OutputPinBank:
+
+    def __init__(self):
+        """Output Pin Bank Constructor"""
+        self._pins_by_number = {}
+        self._unopened_pins = []
+
+    def pin(self, pin_number):
+        if pin_number not in self._pins_by_number:
+            pin = hardware.gpio.pins.pin(pin_number)
+            self._pins_by_number[pin_number] = pin
+            self._unopened_pins.append(pin)
+        return self._pins_by_number[pin_number]
+
+    def open_all(self):
+        open_pins(self._unopened_pins, hardware.gpio.Out)
+        self._unopened_pins = []
+
+    # Close (or forget, if they were never opened) the pins that aren't in
+    # 'used_pin_numbers', e.g. after the config file has been reloaded
+    def close_unused(self, used_pin_numbers):
+        for pin_number in list(self._pins_by_number):
+            if pin_number in used_pin_numbers:
+                continue
+            pin = self._pins_by_number.pop(pin_number)
+            if pin in self._unopened_pins:
+                self._unopened_pins.remove(pin)
+            else:
+                pin.close()
+
+    def close(self):
+        for pin in self._pins_by_number.values():
+            pin.close()
+        self._pins_by_number = {}
+
+
+# Open a list of pins, and set their direction (and interrupt, for inputs),
+# several at a time
+def open_pins(pins, direction, interrupt=None, max_workers=8):
+    def open_pin(pin):
+        pin.open()
+        pin.direction = direction
+        if interrupt is not None:
+            pin.interrupt = interrupt
+
+    if len(pins) < 2:
+        for pin in pins:
+            open_pin(pin)
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(max_workers, len(pins))) as executor:
+        # list() so that any exception is raised here
+        list(executor.map(open_pin, pins))
+
+
+###############################################################################
+# Class - PinWritePlan
+###############################################################################
+
+class PinWritePlan:
+
+    # 'writes' is a list of (pin number, value), applied in order. If a pin
+    # is listed more than once, it is only set once, to its last value
+    def __init__(self, writes, output_pins):
+        """Pin Write Plan Constructor"""
+        values_by_pin_number = {}
+        for pin_number, value in writes:
+            values_by_pin_number.pop(pin_number, None)
+            values_by_pin_number[pin_number] = value
+
+        self.pin_numbers = tuple(values_by_pin_number)
+        self.writes = tuple((output_pins.pin(pin_number), value)
+                for pin_number, value in values_by_pin_number.items())
+        self._write_pins = getattr(hardware.gpio, 'write_pins', None)
+
+    def __len__(self):
+        return len(self.writes)
+
+    # Set the pins. If 'verify' is set, read them back afterwards, and
+    # return False (having logged which) if any didn't take the new value
+    def apply(self, verify=False):
+        if self._write_pins is not None:
+            self._write_pins(self.writes)
+        else:
+            for pin, value in self.writes:
+                pin.value = value
+
+        if not verify:
+            return True
+        verified = True
+        for pin_number, (pin, value) in zip(self.pin_numbers, self.writes):
+            read_back = pin.value
+            if read_back != value:
+                logging.error("Pin %d was set to %d, but reads back as %d",
+                        pin_number, value, read_back)
+                verified = False
+        return verified
+
+
+# Apply several plans as one batch, e.g. to disable every device at startup
+def apply_all(plans):
+    writes = []
+    for plan in plans:
+        writes.extend(plan.writes)
+    write_pins = getattr(hardware.gpio, 'write_pins', None)
+    if write_pins is not None:
+        write_pins(writes)
+    else:
+        for pin, value in writes:
+            pin.value = value
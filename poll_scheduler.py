@@ -0,0 +1,104 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Class - PollScheduler
+###############################################################################
+
+# Readers without a trigger pin ('poll for cards = yes') have to be asked
+# every so often whether a card is there. The PollScheduler decides when,
+# from the event loop, alongside the readers with trigger pins:
+#
+#   - each polled reader is polled at its own pace, which speeds up when it
+#     has seen a card and slows down while it sees nothing (see
+#     StrongLinkSl030Reader.poll)
+#
+#   - only one reader on each i2c bus is polled at a time, taking turns
+#     (round-robin) when several are due at once
+#
+#   - polling waits while any triggered card read is under way on the same
+#     bus, and keeps within the bus's poll budget (see I2CBus), so that
+#     polling never holds up readers that have actually been triggered
+#
+# The polls themselves are handed to the dispatcher, like pin changes. Each
+# poll waits for the reader's answer, so rpac only allows polled readers
+# with --dispatch=threaded, where that wait is in the reader's own thread
+# rather than in the event loop (see config.parse_config_options). The
+# poll budget limits how much of the bus the polls use, not how long they
+# take.
+class PollScheduler:
+
+    # How soon to check back on a reader whose poll is under way, or
+    # which is waiting for a triggered read on its bus to finish
+    recheck_interval = 0.01
+
+    def __init__(self, readers=()):
+        """Poll Scheduler Constructor"""
+        self.readers = []
+        self._next_index = 0
+        self.set_readers(readers)
+
+    # Poll the readers (out of 'readers') that are set to poll for cards
+    def set_readers(self, readers):
+        self.readers = sorted((reader for reader in readers
+                if reader.poll_for_cards), key=lambda reader: reader.name)
+        self._next_index = 0
+
+    # The earliest time (time.monotonic()) a reader might need polling, or
+    # None if there are no polled readers
+    def next_deadline(self, now):
+        deadline = None
+        for reader in self.readers:
+            if reader.polling:
+                reader_deadline = now + self.recheck_interval
+            else:
+                reader_deadline = reader.next_poll_time
+            if deadline is None or reader_deadline < deadline:
+                deadline = reader_deadline
+        return deadline
+
+    # The readers to poll now. They are marked as being polled, until
+    # their poll finishes
+    def due(self, now):
+        if not self.readers:
+            return []
+        busy_buses = set(reader.i2c_bus for reader in self.readers
+                if reader.polling)
+
+        to_poll = []
+        count = len(self.readers)
+        for i in range(count):
+            reader = self.readers[(self._next_index + i) % count]
+            bus = reader.i2c_bus
+            if reader.polling or reader.next_poll_time > now \
+                    or bus in busy_buses:
+                continue
+            if bus.card_reads_in_progress:
+                reader.next_poll_time = now + self.recheck_interval
+                continue
+            allowed_at = bus.poll_allowed_at(now)
+            if allowed_at > now:
+                reader.next_poll_time = allowed_at
+                continue
+
+            reader.polling = True
+            busy_buses.add(bus)
+            to_poll.append(reader)
+
+        # Start from the next reader next time, so that readers sharing a
+        # bus take turns
+        self._next_index = (self._next_index + 1) % count
+        return to_poll
@@ -0,0 +1,281 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# On-demand profiling
+###############################################################################
+
+# When a site reports slow unlocks, rpac can be profiled while it runs.
+# With --control-socket, rpac listens on a Unix socket for one-line
+# commands, e.g.
+#
+#   echo 'profile 30' | nc -U /run/rpac.sock
+#
+#   profile [SECONDS]   Profile the event loop with cProfile for SECONDS
+#                       (default 30). With --dispatch=serial, this covers
+#                       handling the cards as well. The report is written
+#                       as text, and as a .pstats file for other tools
+#
+#   sample [SECONDS]    Sample the stacks of every thread (including the
+#                       readers' worker threads with --dispatch=threaded)
+#                       every few milliseconds for SECONDS (default 30).
+#                       Besides the report, the stacks are written in the
+#                       '.folded' format used by flamegraph.pl
+#
+#   memory [SECONDS]    Trace memory allocations with tracemalloc for
+#                       SECONDS (default 60), and report the biggest
+#                       allocators. If Python was started with
+#                       PYTHONTRACEMALLOC set, the report is immediate
+#
+# Each command replies with the name of the report it will write (in the
+# --profile-dir directory), or why it can't. Only one profile runs at a
+# time.
+#
+# Nothing is profiled or traced until asked for, so when no profile is
+# running there is no overhead beyond a thread waiting on the socket.
+
+# System-Wide packages
+import collections
+import cProfile
+import errno
+import io
+import logging
+import os
+import pstats
+import socket
+import stat
+import sys
+import threading
+import time
+import tracemalloc
+
+# Local Packages
+import timer_queue
+
+
+###############################################################################
+# Class - ProfilingControl
+###############################################################################
+
+class ProfilingControl(threading.Thread):
+
+    default_seconds = {'profile': 30, 'sample': 30, 'memory': 60}
+    max_seconds = 3600
+
+    # How often the stacks are sampled, in seconds
+    sample_interval = 0.005
+
+    # How many lines of each report to write
+    report_lines = 40
+
+    def __init__(self, socket_path, report_dir, timers=None):
+        """Profiling Control Constructor"""
+        threading.Thread.__init__(self, name="profiling-control",
+                daemon=True)
+        self.socket_path = socket_path
+        self.report_dir = report_dir
+        if timers is None:
+            timers = timer_queue.shared_timers
+        self.timers = timers
+        self._busy = threading.Lock()
+
+        # A socket left behind by an earlier run is replaced, but nothing
+        # else is
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise OSError(errno.EEXIST, "%s exists, and isn't a socket"
+                        % socket_path)
+            os.unlink(socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        self._socket.listen(1)
+
+    def run(self):
+        logging.info("Listening for profiling commands on %s",
+                self.socket_path)
+        while True:
+            connection, address = self._socket.accept()
+            with connection:
+                connection.settimeout(5)
+                try:
+                    line = connection.makefile('r').readline()
+                    reply = self.command(line)
+                    connection.sendall((reply + "\n").encode('utf-8'))
+                except OSError as e:
+                    logging.error("Error on profiling control socket (%s)", e)
+
+    # Run one command, returning the reply
+    def command(self, line):
+        words = line.split()
+        if not words or words[0] not in self.default_seconds \
+                or len(words) > 2:
+            return "usage: profile|sample|memory [SECONDS]"
+        kind = words[0]
+        seconds = self.default_seconds[kind]
+        if len(words) == 2:
+            try:
+                seconds = float(words[1])
+            except ValueError:
+                seconds = -1
+            if not 0 < seconds <= self.max_seconds:
+                return "SECONDS must be more than 0, and no more than %d" \
+                        % self.max_seconds
+
+        if not self._busy.acquire(blocking=False):
+            return "busy - a profile is already running"
+        filename = os.path.join(self.report_dir, "rpac-%s-%s.txt"
+                % (kind, time.strftime('%Y%m%d-%H%M%S')))
+        logging.info("Starting %s for %gs, writing to %s", kind, seconds,
+                filename)
+        if kind == 'profile':
+            self._start_profile(seconds, filename)
+        else:
+            target = self._sample if kind == 'sample' else self._trace_memory
+            threading.Thread(name="profiling-%s" % kind, daemon=True,
+                    target=self._run_and_release,
+                    args=(target, seconds, filename)).start()
+        return filename
+
+    def _run_and_release(self, target, *args):
+        try:
+            target(*args)
+        except Exception:
+            logging.exception("Error while profiling")
+        finally:
+            self._busy.release()
+
+    # cProfile only profiles the thread that enables it, so the profiler is
+    # started and stopped by timers run in the event loop. The report is
+    # written from another thread, so as not to hold the loop up
+    def _start_profile(self, seconds, filename):
+        profiler = cProfile.Profile()
+
+        def start():
+            profiler.enable()
+            self.timers.call_later(seconds, stop)
+
+        def stop():
+            profiler.disable()
+            threading.Thread(name="profiling-profile", daemon=True,
+                    target=self._run_and_release,
+                    args=(self._write_profile, profiler, seconds,
+                        filename)).start()
+
+        self.timers.call_later(0, start)
+
+    def _write_profile(self, profiler, seconds, filename):
+        profiler.dump_stats(filename[:-len('.txt')] + '.pstats')
+        report = io.StringIO()
+        report.write("# rpac event loop profile, %gs to %s\n\n"
+                % (seconds, time.strftime('%Y-%m-%d %H:%M:%S')))
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats('cumulative').print_stats(self.report_lines)
+        stats.sort_stats('tottime').print_stats(self.report_lines)
+        self._write_report(filename, report.getvalue())
+
+    # Samples the stack of every other thread. Counted for each function
+    # are the samples in which it was running ('self'), and those in which
+    # it was anywhere on the stack ('total')
+    def _sample(self, seconds, filename):
+        own_thread = threading.get_ident()
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        stacks = collections.Counter()
+        samples = 0
+
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread_names = dict((thread.ident, thread.name)
+                    for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append("%s:%s" % (
+                            os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                functions.reverse()
+                self_counts[functions[-1]] += 1
+                total_counts.update(set(functions))
+                stacks[';'.join([thread_names.get(thread_id, 'unknown')]
+                        + functions)] += 1
+            samples += 1
+            time.sleep(self.sample_interval)
+
+        with open(filename[:-len('.txt')] + '.folded', 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+        lines = ["# rpac stack samples, %gs to %s (%d samples of every "
+                "thread)" % (seconds, time.strftime('%Y-%m-%d %H:%M:%S'),
+                    samples)]
+        for title, counts in (('self', self_counts),
+                    ('total', total_counts)):
+            lines.append("")
+            lines.append("%8s  function (by %s)" % ('samples', title))
+            for function, count in counts.most_common(self.report_lines):
+                lines.append("%8d  %s" % (count, function))
+        self._write_report(filename, "\n".join(lines) + "\n")
+
+    def _trace_memory(self, seconds, filename):
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(10)
+            time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+        if started_here:
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),))
+
+        by_line = snapshot.statistics('lineno')
+        lines = ["# rpac memory allocations, %s (traced for %s)" % (
+                time.strftime('%Y-%m-%d %H:%M:%S'),
+                "%gs" % seconds if started_here else "whole run"),
+                "",
+                "%d KiB in %d blocks still allocated" % (
+                    sum(entry.size for entry in by_line) // 1024,
+                    sum(entry.count for entry in by_line)),
+                "",
+                "Top allocators by line:"]
+        lines.extend("  %s" % entry for entry in by_line[:self.report_lines])
+        lines.append("")
+        lines.append("Top allocators with tracebacks:")
+        for entry in snapshot.statistics('traceback')[:10]:
+            lines.append("")
+            lines.append("  %d KiB in %d blocks" % (entry.size // 1024,
+                    entry.count))
+            lines.extend("    %s" % line for line in entry.traceback.format())
+        self._write_report(filename, "\n".join(lines) + "\n")
+
+    def _write_report(self, filename, contents):
+        with open(filename, 'w') as f:
+            f.write(contents)
+        logging.info("Profile written to %s", filename)
+
+    def close(self):
+        self._socket.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+###############################################################################
+# OVERVIEW
+###############################################################################
+#
+# Looks up access decisions in the event store written by rpac.py (see
+# event_store.py). For example, to see who opened front_door on a given day:
+#
+#   query_events.py --device=front_door --decision=granted \
+#       --since=2026-10-13 --until=2026-10-14
+#
+# or everything a card has done in the last week:
+#
+#   query_events.py --card=DEADBEEF --since=7d
+#
+# Results are printed newest first, in the same tab-separated format as the
+# audit log.
+#
+
+# System-Wide imports
+import getopt
+import os.path
+import re
+import sqlite3
+import sys
+import time
+
+# Local packages
+import event_store
+from rpac_logging import HexCardId
+
+
+# Displays help on how to use this program
+def usage(extra_message=None):
+    if extra_message:
+        print("\nERROR: %s" % extra_message)
+    print("""
+Usage: query_events.py [options]
+
+Options:
+    --db=FILE           The event store (default rpac-events.db)
+    --device=NAME       Only events for this device
+    --card=HEX          Only events for this card ID
+    --decision=WHAT     Only 'granted', 'denied', 'removed' or 'relocked'
+                        events
+    --since=TIME        Only events at or after TIME
+    --until=TIME        Only events before TIME
+    --limit=N           At most N events (default 100, 0 for all)
+
+TIME is a local date and time ('2026-10-13' or '2026-10-13 17:30'), or a
+time ago in seconds, minutes, hours or days ('90s', '15m', '2h', '7d').
+""")
+    sys.exit(2)
+
+
+# Convert a --since/--until value to seconds since the epoch
+def parse_time(value):
+    m = re.match(r'^(\d+)([smhd])$', value)
+    if m:
+        seconds = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+        return time.time() - int(m.group(1)) * seconds[m.group(2)]
+    for time_format in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise ValueError("can't understand time '%s'" % value)
+
+
+def main():
+    db_filename = 'rpac-events.db'
+    criteria = {}
+    limit = 100
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "db=",
+                "device=", "card=", "decision=", "since=", "until=",
+                "limit="])
+    except getopt.GetoptError as err:
+        usage(str(err))
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o == "--db":
+            db_filename = a
+        elif o == "--device":
+            criteria['device'] = a
+        elif o == "--decision":
+            if a not in event_store.decisions:
+                usage("--decision must be one of %s"
+                        % ", ".join(event_store.decisions))
+            criteria['decision'] = a
+        elif o == "--card":
+            if not re.match(r'^([0-9A-Fa-f]{2})+$', a):
+                usage("--card must be a hex card ID")
+            criteria['card'] = bytes.fromhex(a)
+        elif o in ("--since", "--until"):
+            try:
+                criteria[o[2:]] = parse_time(a)
+            except ValueError as e:
+                usage(str(e))
+        elif o == "--limit":
+            if not a.isdigit():
+                usage("--limit must be a whole number")
+            limit = int(a)
+        else:
+            assert False, "Unhandled option"
+    if args:
+        usage("Unexpected arguments: %s" % " ".join(args))
+
+    if not os.path.exists(db_filename):
+        print("ERROR: %s does not exist" % db_filename, file=sys.stderr)
+        sys.exit(1)
+    try:
+        connection = event_store.open_event_store(db_filename)
+        events = event_store.query_events(connection, limit=limit or None,
+                **criteria)
+    except sqlite3.Error as e:
+        print("ERROR: %s: %s" % (db_filename, e), file=sys.stderr)
+        sys.exit(1)
+
+    for when, device_name, card, decision in events:
+        print("%s.%03dZ\t%s\t%s\t%s" % (
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when)),
+                int(when * 1000) % 1000, device_name, HexCardId(card),
+                decision))
+
+if __name__ == "__main__":
+    main()
@@ -71,48 +71,163 @@
 # file and building a series of in-memory objects that represent the desired
 # config.
 #
-# This code then creates 'Pin' objects to match the configuration objects,
-# and then uses 'epoll(7)' to watch for state changes on the Pins. When the
-# pins change state, this code calls methods on the Objects, which then read
-# the card and enable/disable the attached hardware Devices.
+# The event loop (event_loop.py) then creates 'Pin' objects to match the
+# configuration objects, and then uses 'epoll(7)' to watch for state changes
+# on the Pins. When the pins change state, it calls methods on the Objects,
+# which then read the card and enable/disable the attached hardware Devices.
 #
 
 # System-Wide imports
+import atexit
 import getopt
+import json
 import logging
+import os
 import pprint
-import select
+import signal
 import socket
 import sys
+import threading
 import time
 
-# Associated Packages
-import quick2wire.gpio as gpio
-
 # Local packages
+import acl_sync
+import card_database
 import config
-
-# Local packages and globals
-logging.basicConfig(filename='rpac.log', \
-            level=logging.DEBUG)
+import dispatcher
+import event_loop
+import hardware
+import latency_trace
+import metrics
+import pin_plan
+import profiling
+import rpac_logging
+import supervisor
+import traffic_replay
+import traffic_trace
+
+# When rpac started, for reporting how long it takes to be ready
+process_started = time.monotonic()
 
 
 # Displays help on how to use this program
-def usage(extra_message):
+def usage(extra_message=None):
     if extra_message:
         print("\nERROR: %s" % extra_message)
     print("""
 Options:
     --config=/path/to/rpac.conf
+    --dispatch=serial|threaded
+    --log=/path/to/rpac.log
+    --audit-log=/path/to/rpac-audit.log
+    --log-max-bytes=BYTES
+    --log-rotate-hours=HOURS
+    --log-backups=COUNT
+    --event-store=/path/to/rpac-events.db|none
+    --event-retention-days=DAYS
+    --latency-report=/path/to/rpac-latency.txt
+    --latency-report-interval=SECONDS
+    --metrics-port=PORT
+    --control-socket=/path/to/rpac.sock
+    --profile-dir=/path/to/reports
+    --record=/path/to/trace[.gz]
+    --replay=/path/to/trace[.gz]
+    --replay-speed=FACTOR
+    --sync=DIRECTORY|URL
+    --sync-interval=SECONDS
+    --supervise
+    --shared-acl-dir=DIRECTORY
     
 Config option defaults to /usr/local/etc/rpac.conf)
+
+The time taken to be ready to read cards is logged at startup.
+
+Sending rpac SIGHUP makes it re-read the config file. Only the readers and
+devices whose settings have changed are set up again - the rest carry on
+as they are.
+
+Dispatch option defaults to 'serial', where card reads are handled one at a
+time. With 'threaded', each reader gets its own worker thread, so that a slow
+reader doesn't hold up the others. Readers set to 'poll for cards' need
+'threaded'.
+
+Logs default to rpac.log and rpac-audit.log in the current directory. The
+audit log has one line per access decision. Both are rotated when they reach
+10MB or are 24 hours old (whichever comes first), keeping 7 old copies.
+
+Access decisions are also stored in rpac-events.db (or --event-store), for
+looking up with query_events.py. Events older than --event-retention-days
+(default 365, 0 to keep them forever) are deleted.
+
+The time taken by each step of handling a card (pin edge, GPIO read, i2c
+write, i2c read, ACL lookup, setting the pins) is recorded for each reader.
+A report of these (p50/p95/p99) is written to rpac-latency.txt when rpac
+receives SIGUSR1, and every --latency-report-interval seconds if that is set.
+It also includes the time taken to set the pins of any device with 'time pin
+writes' set in the config file.
+
+With --metrics-port, counts of reader events, card reads (and reader errors),
+access decisions and ACL and config reloads, and how late the event loop is
+running, are served at http://127.0.0.1:PORT/metrics in the Prometheus text
+format. See metrics.py for the full list.
+
+With --control-socket, rpac can be profiled while it runs, by sending one of
+'profile [SECONDS]', 'sample [SECONDS]' or 'memory [SECONDS]' to the socket
+(e.g. echo 'profile 30' | nc -U /path/to/rpac.sock). The reports are written
+to --profile-dir (default: the current directory). See profiling.py.
+
+With --record, pin changes, card reader answers and decisions are written to
+a trace file. With --replay, a trace is played back through the event loop,
+readers and devices against simulated hardware (using the readers and devices
+in the config file, which should match those the trace was recorded with),
+sped up by --replay-speed (e.g. 10 or 100), and a JSON summary of throughput
+and latency is printed.
+
+With --sync, ACL files are kept up to date with changes ('deltas') fetched
+from a directory or http(s) URL every --sync-interval seconds (default 60),
+and whenever rpac receives SIGUSR2. See acl_sync.py for the files the source
+needs to provide.
+
+With --supervise, the readers are run in several worker processes, one for
+each i2c bus (or as set by the readers' 'worker' parameter), with their
+devices. The workers share the ACL files, and the index of which cards can
+open which devices through access groups, through compiled copies written to
+--shared-acl-dir (default /dev/shm/rpac-acls), and are restarted if they
+exit. Each worker has its own log, audit log, latency report, control socket
+and trace file, named after the worker (e.g. rpac-bus-1.log), and serves its
+metrics on --metrics-port plus its number (counting from 0). Access
+decisions from all of the workers go in the one event store. See
+supervisor.py.
 """)
     sys.exit(2)
 
 
 # Parses command-line options
 def parse_command_line_arguments():
-    config_filename = '/usr/local/etc/rpac.conf'
+    options = {
+        'config': '/usr/local/etc/rpac.conf',
+        'dispatch': 'serial',
+        'log': 'rpac.log',
+        'audit log': 'rpac-audit.log',
+        'log max bytes': 10 * 1024 * 1024,
+        'log rotate hours': 24,
+        'log backups': 7,
+        'event store': 'rpac-events.db',
+        'event retention days': 365,
+        'latency report': 'rpac-latency.txt',
+        'latency report interval': 0,
+        'metrics port': 0,
+        'control socket': None,
+        'profile dir': '.',
+        'record': None,
+        'replay': None,
+        'replay speed': 1.0,
+        'sync': None,
+        'sync interval': 60,
+        'supervise': False,
+        'worker': None,
+        'shared acl dir': '/dev/shm/rpac-acls',
+    }
     
     # Portions of the code for parsing command-line parameters are from
     # the example at
@@ -120,7 +235,15 @@ def parse_command_line_arguments():
     # © Copyright 1990-2013, Python Software Foundation. 
     try:
         opts, args = getopt.getopt(
-            sys.argv[1:], "hdn:c:", ["help", "config="])
+            sys.argv[1:], "hdn:c:", ["help", "config=", "dispatch=",
+                "log=", "audit-log=", "log-max-bytes=", "log-rotate-hours=",
+                "log-backups=", "event-store=", "event-retention-days=",
+                "latency-report=",
+                "latency-report-interval=", "metrics-port=",
+                "control-socket=", "profile-dir=", "record=",
+                "replay=",
+                "replay-speed=", "sync=", "sync-interval=", "supervise",
+                "worker=", "shared-acl-dir="])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -128,97 +251,236 @@ def parse_command_line_arguments():
         if o in ("-h", "--help"):
             usage()
         elif o in ("-c", "--config"):
-            config_filename = a
+            options['config'] = a
+        elif o == "--dispatch":
+            if a not in dispatcher.dispatchers_by_mode:
+                usage("Unknown dispatch mode '%s'" % a)
+            options['dispatch'] = a
+        elif o == "--log":
+            options['log'] = a
+        elif o == "--audit-log":
+            options['audit log'] = a
+        elif o == "--event-store":
+            options['event store'] = None if a == 'none' else a
+        elif o == "--latency-report":
+            options['latency report'] = a
+        elif o in ("--control-socket", "--profile-dir", "--worker",
+                    "--shared-acl-dir"):
+            options[o[2:].replace('-', ' ')] = a
+        elif o == "--supervise":
+            options['supervise'] = True
+        elif o in ("--record", "--replay", "--sync"):
+            options[o[2:]] = a
+        elif o == "--replay-speed":
+            try:
+                options['replay speed'] = float(a)
+            except ValueError:
+                usage("--replay-speed must be a number")
+            if options['replay speed'] <= 0:
+                usage("--replay-speed must be more than 0")
+        elif o in ("--log-max-bytes", "--log-rotate-hours", "--log-backups",
+                    "--latency-report-interval", "--sync-interval",
+                    "--event-retention-days", "--metrics-port"):
+            if not a.isdigit():
+                usage("%s must be a whole number" % o)
+            options[o[2:].replace('-', ' ')] = int(a)
         else:
             assert False, "Unhandled option"
     # End of example code
 
-    return(config_filename)
-
-
-# This code builds a set of 'Pin' objects relating to
-# the hardware pins in the config file. These Pin objects
-# are then map to the underlying card Readers, so that
-# a change in state on the hardware Pin can trigger the
-# configured underlying Object
-def build_hardware_pin_map(readers_by_name):
-    pin_objects_to_watch = {}
-    for reader in readers_by_name:
-        trigger_pin = readers_by_name[reader].trigger_pin
-        assert trigger_pin not in pin_objects_to_watch, \
-            "Pin %s is set as the 'trigger pin' for more " \
-            " than one reader or button" % trigger_pin
-        # In the pins-to-watch code, we set a reference to the reader
-        # object itself
-        pin_objects_to_watch[trigger_pin] = {}
-        pin_objects_to_watch[trigger_pin]['handler_object'] = \
-                    readers_by_name[reader]
-
-        # Create an 'input' pin object from quick2wire.gpio, watching
-        # both rising and falling edge transitions - for the cards arriving \
-        # and leaving
-        pin = gpio.pins.pin(trigger_pin)
-        pin.open()
-
-        pin.direction = gpio.In
-        pin.interrupt = gpio.Both
-
-        pin_objects_to_watch[trigger_pin]['gpio_pin'] = pin
-
-    return pin_objects_to_watch
-
-
-# LOOPS FOREVER
-#
-# This code sits and waits for state changes on the configured hardware pins
-#
-def wait_for_pin_state_changes(readers_by_name, devices_by_name):
-    fds_to_pins = {}
-
-    # Fetch a list of pins to watch, each of which maps to
-    # a card reader
-    pin_objects_to_watch = build_hardware_pin_map(readers_by_name)
-
-
-    # Configure the select handler, setting it to watch the
-    # filedescriptors that underly the hardware pins.
-    # To do this, we grab the filedescriptors that underly the
-    # pins, and build a map between filedescriptors and objects
-    epoll_handler = select.epoll()
-    for pin_num in pin_objects_to_watch:
-        handler_object = pin_objects_to_watch[pin_num]['handler_object']
-        gpio_pin = pin_objects_to_watch[pin_num]['gpio_pin']
-
-        epoll_handler.register(gpio_pin, select.EPOLLET)
-        fds_to_pins[gpio_pin.fileno()] = pin_num
-
-    # Loop forever, waiting for pin state changes, and triggering the
-    # pins based on their values
-    while True:
-        logging.debug("Waiting for event on reader pins")
-        events = epoll_handler.poll()
-        for filedescriptor, event in events:
-            pin_no = fds_to_pins[filedescriptor]
-            logging.debug("Got event on pin number %s" % pin_no)
-            pin_value = pin_objects_to_watch[pin_no]['gpio_pin'].value
-            pin_objects_to_watch[pin_no]['handler_object'].trigger_pin_state_change(
-                        pin_value, devices_by_name)
+    if options['supervise'] and (options['replay'] or options['worker']):
+        usage("--supervise can't be used with --replay or --worker")
+
+    return(options)
+
+
+# The command line for worker number 'number' (see supervisor.py), which is
+# named 'worker'. The worker gets the same options as the supervisor, other
+# than the files that can't be shared, which are named after the worker
+def worker_arguments(options, worker, number):
+    def for_worker(filename):
+        base, extension = os.path.splitext(filename)
+        return "%s-%s%s" % (base, worker, extension)
+
+    argv = [sys.executable, os.path.abspath(__file__),
+            "--worker=%s" % worker,
+            "--config=%s" % options['config'],
+            "--dispatch=%s" % options['dispatch'],
+            "--log=%s" % for_worker(options['log']),
+            "--audit-log=%s" % for_worker(options['audit log']),
+            "--log-max-bytes=%d" % options['log max bytes'],
+            "--log-rotate-hours=%d" % options['log rotate hours'],
+            "--log-backups=%d" % options['log backups'],
+            "--event-store=%s" % (options['event store'] or 'none'),
+            "--event-retention-days=%d" % options['event retention days'],
+            "--latency-report=%s" % for_worker(options['latency report']),
+            "--latency-report-interval=%d"
+                % options['latency report interval'],
+            "--profile-dir=%s" % options['profile dir'],
+            "--shared-acl-dir=%s" % options['shared acl dir']]
+    if options['metrics port']:
+        argv.append("--metrics-port=%d" % (options['metrics port'] + number))
+    if options['control socket']:
+        argv.append("--control-socket=%s"
+                % for_worker(options['control socket']))
+    if options['record']:
+        argv.append("--record=%s" % for_worker(options['record']))
+    return argv
+
+
+# With --supervise, the readers are run by worker processes, and all this
+# process does is look after them (see supervisor.py)
+def supervise(options):
+    rpac_logging.configure_logging(options['log'], options['audit log'],
+            max_bytes=options['log max bytes'],
+            rotate_seconds=options['log rotate hours'] * 60 * 60,
+            backup_count=options['log backups'])
+
+    workers = supervisor.Supervisor(options['config'],
+            options['shared acl dir'],
+            lambda worker, number: worker_arguments(options, worker, number))
+    worker_names = workers.read_config()
+
+    # Only the supervisor syncs the ACLs, and the workers see the changes
+    # through the shared copies
+    if options['sync']:
+        syncer = acl_sync.AclSync(options['sync'],
+                lambda: acl_sync.card_databases_to_sync(workers.acl_path,
+                    workers.shared_acls.card_databases),
+                options['sync interval'] or None)
+        syncer.start()
+        signal.signal(signal.SIGUSR2,
+                lambda signum, frame: syncer.request_sync())
+
+    workers.run(worker_names)
+    rpac_logging.stop_logging()
 
 
 def main():
     # Get the config file, and from it, get the readers, devices,
     # and button objects
-    config_filename = parse_command_line_arguments()
+    options = parse_command_line_arguments()
+
+    if options['supervise']:
+        supervise(options)
+        return
+
+    # Replayed traffic isn't real access history
+    if options['replay']:
+        options['event store'] = None
+
+    rpac_logging.configure_logging(options['log'], options['audit log'],
+            max_bytes=options['log max bytes'],
+            rotate_seconds=options['log rotate hours'] * 60 * 60,
+            backup_count=options['log backups'],
+            event_store_filename=options['event store'],
+            event_retention_days=options['event retention days'])
+
+    # Replays run against simulated hardware, rather than the real thing
+    if options['replay']:
+        hardware.use_backend('simulated')
+
+    # Workers use the supervisor's shared copies of the ACL files
+    if options['worker']:
+        card_database.shared_index_dir = options['shared acl dir']
     acl_path, readers_by_name, devices_by_name = \
-                config.parse_config_options(config_filename)
+                config.parse_config_options(options['config'],
+                    worker=options['worker'],
+                    allow_polled_readers=options['dispatch'] == 'threaded')
+    config_read = time.monotonic()
+
+    if options['replay']:
+        summary = traffic_replay.replay(options['replay'], readers_by_name,
+                devices_by_name, options['dispatch'], options['replay speed'])
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        return
+
+    if options['record']:
+        traffic_trace.start_recording(options['record'])
+        atexit.register(traffic_trace.stop_recording)
     
     # At startup, make sure that all devices are in the 'disabled' state.
-    for device_name in devices_by_name:
-        devices_by_name[device_name].disable()
-    
+    # The pins of all the devices are set together
+    pin_plan.apply_all([device.disable_plan
+                for device in devices_by_name.values()])
+    devices_disabled = time.monotonic()
+
+    # A worker whose supervisor has gone disables its devices and exits
+    if options['worker']:
+        def supervisor_gone():
+            logging.error("Supervisor has gone - disabling devices and "
+                    "exiting")
+            pin_plan.apply_all([device.disable_plan
+                        for device in list(devices_by_name.values())])
+            rpac_logging.stop_logging()
+            os._exit(1)
+        supervisor.watch_supervisor(supervisor_gone)
+
+    # The i2c buses are opened in the background, rather than on the first
+    # card read
+    i2c_buses = set(reader.i2c_bus for reader in readers_by_name.values())
+    threading.Thread(name="i2c-open", daemon=True,
+            target=lambda: [bus.open() for bus in i2c_buses]).start()
+
+    # Latency reports are written on SIGUSR1, and periodically if asked for
+    reporter = latency_trace.LatencyReporter(readers_by_name,
+            options['latency report'],
+            options['latency report interval'] or None, devices_by_name,
+            config.reload_lock)
+    reporter.start()
+    signal.signal(signal.SIGUSR1,
+            lambda signum, frame: reporter.request_report())
+
+    # Metrics are served from a thread of their own, if asked for. Not
+    # being able to serve them isn't a reason to stop controlling access
+    if options['metrics port']:
+        try:
+            metrics.MetricsServer(options['metrics port']).start()
+        except OSError as e:
+            logging.error("Can't serve metrics on port %d (%s)",
+                    options['metrics port'], e)
+
+    # Profiling, on request
+    if options['control socket']:
+        try:
+            profiling.ProfilingControl(options['control socket'],
+                    options['profile dir']).start()
+        except OSError as e:
+            logging.error("Can't listen on control socket %s (%s)",
+                    options['control socket'], e)
+
+    # ACL changes are fetched every so often, and on SIGUSR2
+    if options['sync']:
+        syncer = acl_sync.AclSync(options['sync'],
+                lambda: config.card_databases_in_use(devices_by_name),
+                options['sync interval'] or None)
+        syncer.start()
+        signal.signal(signal.SIGUSR2,
+                lambda signum, frame: syncer.request_sync())
+
+    event_dispatcher = \
+            dispatcher.dispatchers_by_mode[options['dispatch']](devices_by_name)
+
+    def report_ready():
+        now = time.monotonic()
+        logging.info("Ready %.3fs after starting (config %.3fs, disabling "
+                "devices %.3fs, watching pins %.3fs)",
+                now - process_started, config_read - process_started,
+                devices_disabled - config_read, now - devices_disabled)
+        logging.info("Waiting for card to be presented")
+        if options['worker']:
+            supervisor.report_ready()
+
+    # The config file is re-read on SIGHUP
+    def reload_config():
+        config.reload_config_options(options['config'], readers_by_name,
+                devices_by_name, options['worker'],
+                options['dispatch'] == 'threaded')
+
     # Loop forever waiting for state changes
-    logging.info("Waiting for card to be presented")
-    wait_for_pin_state_changes(readers_by_name, devices_by_name)
+    event_loop.wait_for_pin_state_changes(readers_by_name,
+            devices_by_name, event_dispatcher, ready_callback=report_ready,
+            reload_config=reload_config)
     # NOT REACHED
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# System-Wide packages
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+# Local Packages
+import event_store
+
+###############################################################################
+# Logging
+###############################################################################
+
+# Writing log messages to the SD card is slow, and we don't want a card
+# presentation to wait for it. So log records are put on a queue, and a
+# background thread formats them and writes them to disk.
+#
+# Alongside the normal (free text) log, we write a compact 'audit' log,
+# containing one tab-separated line per access decision:
+#
+#   timestamp    device    card ID    decision
+#
+# Both logs are rotated when they reach a maximum size, or after a set
+# amount of time, whichever comes first.
+#
+# The access decisions can also be written to an event store (see
+# event_store.py), where they can be looked up by card, device and time.
+
+audit_logger = logging.getLogger('rpac.audit')
+
+_listener = None
+_event_store = None
+
+
+# Set up the logging pipeline. Should be called once, at startup
+def configure_logging(log_filename, audit_filename, level=logging.DEBUG,
+            max_bytes=10 * 1024 * 1024, rotate_seconds=24 * 60 * 60,
+            backup_count=7, event_store_filename=None,
+            event_retention_days=None):
+    global _listener, _event_store
+
+    log_handler = SizeAndTimeRotatingFileHandler(log_filename,
+            max_bytes, rotate_seconds, backup_count)
+    log_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(threadName)s %(message)s'))
+    log_handler.addFilter(lambda record: record.name != audit_logger.name)
+
+    audit_handler = SizeAndTimeRotatingFileHandler(audit_filename,
+            max_bytes, rotate_seconds, backup_count)
+    audit_handler.setFormatter(AuditFormatter())
+    audit_handler.addFilter(lambda record: record.name == audit_logger.name)
+
+    # Everything goes through the one queue, and is written by the one
+    # background thread
+    log_queue = queue.SimpleQueue()
+    queue_handler = _UnformattedQueueHandler(log_queue)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    # Audit records are always written, whatever the log level
+    audit_logger.addHandler(queue_handler)
+    audit_logger.setLevel(logging.INFO)
+    audit_logger.propagate = False
+
+    handlers = [log_handler, audit_handler]
+    if event_store_filename:
+        _event_store = event_store.EventStore(event_store_filename,
+                event_retention_days)
+        _event_store.start()
+        event_store_handler = event_store.EventStoreHandler(_event_store)
+        event_store_handler.addFilter(
+                lambda record: record.name == audit_logger.name)
+        handlers.append(event_store_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+# Flush anything still queued to disk, and stop the background thread
+def stop_logging():
+    global _listener, _event_store
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _event_store is not None:
+        _event_store.stop()
+        _event_store = None
+
+
+# Record an access decision in the audit log. The card is the raw card ID
+# (bytes) or None if it couldn't be read
+def audit(device_name, card, decision):
+    audit_logger.info(decision, extra={
+        'device': device_name,
+        'card': card,
+    })
+
+
+# Wraps a card ID (bytes) so that it is only formatted as hex if the log
+# message it's part of is actually written, e.g.
+#
+#   logging.debug("Card presented: %s", HexCardId(card))
+class HexCardId:
+    __slots__ = ('card',)
+
+    def __init__(self, card):
+        self.card = card
+
+    def __str__(self):
+        if self.card is None:
+            return '-'
+        return self.card.hex().upper()
+
+
+class AuditFormatter(logging.Formatter):
+
+    def format(self, record):
+        return "%s.%03dZ\t%s\t%s\t%s" % (
+                time.strftime('%Y-%m-%dT%H:%M:%S',
+                        time.gmtime(record.created)),
+                record.msecs, record.device, HexCardId(record.card),
+                record.msg)
+
+
+# The standard QueueHandler formats each message before putting it on the
+# queue - i.e. in the thread doing the logging. We leave that to the
+# background thread instead. Everything we log is immutable (or not changed
+# after being logged), so it's safe to format it later
+class _UnformattedQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+
+# Rotates the log file when it grows past max_bytes, or every rotate_seconds,
+# whichever happens first. Old files are kept as <filename>.1, .2 etc.
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+
+    def __init__(self, filename, max_bytes, rotate_seconds, backup_count):
+        logging.handlers.RotatingFileHandler.__init__(self, filename,
+                maxBytes=max_bytes, backupCount=backup_count)
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and time.time() >= self.rollover_at:
+            return True
+        return logging.handlers.RotatingFileHandler.shouldRollover(
+                self, record)
+
+    def doRollover(self):
+        logging.handlers.RotatingFileHandler.doRollover(self)
+        self.rollover_at = time.time() + self.rotate_seconds
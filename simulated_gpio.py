@@ -0,0 +1,157 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Simulated GPIO
+###############################################################################
+
+# A stand-in for quick2wire.gpio, used when the 'simulated' hardware backend
+# is selected (see hardware.py). It provides the parts of the quick2wire API
+# that rpac uses (pins.pin(), Pin.open(), direction, interrupt, value and
+# fileno()), plus some extras for driving the simulation:
+#
+#   - set_input() changes the level on an input pin, as a card reader would
+#
+#   - add_listener() calls a function whenever an output pin is set, so that
+#     a test can see when a relay has been switched
+#
+# It also has write_pins(), which sets several output pins at once (as a
+# GPIO backend with access to the whole GPIO register could), and is used
+# for device pin-write plans (see pin_plan.py).
+#
+# Each pin is backed by a pipe. When the level on an input pin changes in a
+# way that matches its 'interrupt' setting, a byte is written to the pipe,
+# which makes the pin's file descriptor readable for epoll. Reading the
+# pin's value empties the pipe again.
+
+# System-Wide packages
+import os
+import threading
+import time
+
+In = 'in'
+Out = 'out'
+
+Rising = 'rising'
+Falling = 'falling'
+Both = 'both'
+
+
+class SimulatedPin:
+
+    def __init__(self, pin_number):
+        """Simulated Pin Constructor"""
+        self.pin_number = pin_number
+        self.direction = In
+        self.interrupt = None
+        self._value = 1         # Inputs are pulled up when idle
+        self._read_fd = None
+        self._write_fd = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+        # Number of times the pin has been set, and when it was last set
+        self.write_count = 0
+        self.last_write_time = None
+
+    def open(self):
+        if self._read_fd is None:
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            os.set_blocking(self._write_fd, False)
+
+    def close(self):
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+            self._read_fd = self._write_fd = None
+
+    def fileno(self):
+        return self._read_fd
+
+    @property
+    def value(self):
+        if self._read_fd is not None:
+            try:
+                os.read(self._read_fd, 4096)
+            except BlockingIOError:
+                pass
+        return self._value
+
+    @value.setter
+    def value(self, new_value):
+        self._set_output(new_value, time.monotonic())
+        self._notify_listeners()
+
+    def _set_output(self, new_value, now):
+        self._value = new_value
+        self.write_count += 1
+        self.last_write_time = now
+
+    def _notify_listeners(self):
+        for listener in list(self._listeners):
+            listener(self.pin_number, self._value)
+
+    # SIMULATION: set the level being applied to an input pin
+    def set_input(self, new_value):
+        with self._lock:
+            old_value = self._value
+            self._value = new_value
+            if old_value == new_value or self._write_fd is None:
+                return
+            if self.interrupt == Both \
+                    or (self.interrupt == Rising and new_value) \
+                    or (self.interrupt == Falling and not new_value):
+                try:
+                    os.write(self._write_fd, b'!')
+                except BlockingIOError:
+                    pass
+
+    # SIMULATION: call listener(pin_number, value) when the pin is set
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+
+# There is only one of each physical pin, so every request for a pin
+# number returns the same object
+class SimulatedPinBank:
+
+    def __init__(self):
+        """Simulated Pin Bank Constructor"""
+        self._pins_by_number = {}
+        self._lock = threading.Lock()
+
+    def pin(self, pin_number):
+        with self._lock:
+            if pin_number not in self._pins_by_number:
+                self._pins_by_number[pin_number] = SimulatedPin(pin_number)
+            return self._pins_by_number[pin_number]
+
+
+pins = SimulatedPinBank()
+
+
+# Set a list of (pin, value) pairs all at the same moment, and only then
+# tell the listeners
+def write_pins(pin_values):
+    now = time.monotonic()
+    for pin, value in pin_values:
+        pin._set_output(value, now)
+    for pin, value in pin_values:
+        pin._notify_listeners()
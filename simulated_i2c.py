@@ -0,0 +1,235 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Simulated i2c
+###############################################################################
+
+# A stand-in for quick2wire.i2c, used when the 'simulated' hardware backend
+# is selected (see hardware.py). It provides I2CMaster, writing_bytes() and
+# reading(), which pass the transactions on to simulated devices attached
+# to the bus with attach_device().
+#
+# SimulatedSl030 behaves like a Stronglink SL030 card reader: it doesn't
+# acknowledge reads until it has had time to answer a command, and can be
+# told to fail a proportion of transactions, or to give set answers (e.g.
+# those recorded in a traffic trace) to the next commands of each kind.
+
+# System-Wide packages
+import collections
+import errno
+import random
+import threading
+import time
+
+# Local Packages
+import simulated_gpio
+
+# Each transaction takes roughly this long per byte on a 100kHz bus
+default_byte_time = 0.00009
+
+# Simulated devices, by (bus number, i2c address)
+_devices = {}
+_devices_lock = threading.Lock()
+
+# quick2wire picks a bus number based on the revision of Pi. We always use 1
+default_bus_number = 1
+
+
+def attach_device(device, address, bus_number=default_bus_number):
+    with _devices_lock:
+        _devices[(bus_number, address)] = device
+
+
+def detach_all_devices():
+    with _devices_lock:
+        _devices.clear()
+
+
+def writing_bytes(address, *data):
+    return ('write', address, bytes(data))
+
+
+def writing(address, data):
+    return ('write', address, bytes(data))
+
+
+def reading(address, n_bytes):
+    return ('read', address, n_bytes)
+
+
+class I2CMaster:
+
+    def __init__(self, n=None, extra_open_flags=0):
+        """Simulated I2C Master Constructor"""
+        self.bus_number = default_bus_number if n is None else n
+        self.closed = False
+        self.byte_time = default_byte_time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    def transaction(self, *messages):
+        if self.closed:
+            raise OSError(errno.EBADF, "I2C bus is closed")
+
+        results = []
+        for kind, address, data in messages:
+            with _devices_lock:
+                device = _devices.get((self.bus_number, address))
+            if device is None:
+                raise OSError(errno.EREMOTEIO,
+                        "No device at address 0x%02X" % address)
+            if kind == 'write':
+                time.sleep(self.byte_time * (len(data) + 1))
+                device.write(data)
+            else:
+                time.sleep(self.byte_time * (data + 1))
+                results.append(device.read(data))
+        return results
+
+
+###############################################################################
+# Class - SimulatedSl030
+###############################################################################
+
+class SimulatedSl030:
+
+    # Status codes returned by the SL030
+    status_ok = 0x0
+    status_no_tag = 0x1
+
+    # Type byte returned after the card ID - Mifare 1K
+    card_type = 0x1
+
+    def __init__(self, response_time=0.02, response_jitter=0.005,
+                error_rate=0.0, out_pin=None, seed=None, early_ack=False):
+        """Simulated SL030 Constructor"""
+        # How long the SL030 takes to answer a command. Reads before then
+        # are not acknowledged, unless early_ack is set, in which case they
+        # get the last answer again
+        self.response_time = response_time
+        self.response_jitter = response_jitter
+        self.early_ack = early_ack
+
+        # Proportion of transactions that fail with a bus error
+        self.error_rate = error_rate
+
+        # If set, the simulated GPIO pin wired to the SL030's OUT pin, which
+        # it pulls low while a card is present
+        self.out_pin = out_pin
+
+        self.card = None
+        self._answer_at = None
+        self._answer = None
+        self._last_answer = None
+
+        # SIMULATION: if set, called to find out what each 'select card'
+        # command is for ('read', 'poll' or 'probe' - see
+        # StrongLinkSl030Reader.select_kind). Otherwise they are all 'read'
+        self.select_kind = None
+
+        # Answers queued with queue_answer() and queue_write_error(), by
+        # the kind of select they are for, used instead of the card
+        self._queued_answers = collections.defaultdict(collections.deque)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # Counters, for checking what the code under test did
+        self.commands = 0
+        self.reads = 0
+        self.naks = 0
+        self.errors = 0
+
+    # SIMULATION: put a card (bytes) on the reader
+    def present_card(self, card):
+        self.card = card
+        if self.out_pin is not None:
+            simulated_gpio.pins.pin(self.out_pin).set_input(0)
+
+    # SIMULATION: answer the next 'select card' command of this kind with
+    # this frame (bytes), after response_time seconds. If the frame is None,
+    # the command is never answered
+    def queue_answer(self, frame, response_time, kind='read'):
+        self._queued_answers[kind].append((frame, response_time, False))
+
+    # SIMULATION: fail sending the next 'select card' command of this kind
+    def queue_write_error(self, kind='read'):
+        self._queued_answers[kind].append((None, 0.0, True))
+
+    # SIMULATION: take the card away again
+    def remove_card(self):
+        self.card = None
+        if self.out_pin is not None:
+            simulated_gpio.pins.pin(self.out_pin).set_input(1)
+
+    def write(self, data):
+        with self._lock:
+            self._maybe_fail()
+            self.commands += 1
+            # 1 (length), 1 (select card)
+            queued = None
+            if data[:2] == b'\x01\x01':
+                kind = 'read' if self.select_kind is None \
+                        else self.select_kind()
+                queued = self._queued_answers.get(kind)
+            if queued:
+                frame, delay, write_error = queued.popleft()
+                if write_error:
+                    self.errors += 1
+                    raise OSError(errno.EIO, "Simulated write error")
+                self._last_answer = self._answer
+                self._answer = frame
+                self._answer_at = time.monotonic() + delay
+            elif data[:2] == b'\x01\x01':
+                self._last_answer = self._answer
+                self._answer = self._select_card_answer()
+                delay = self.response_time + \
+                        self._random.uniform(0, self.response_jitter)
+                self._answer_at = time.monotonic() + delay
+            else:
+                self._answer = None
+
+    def read(self, n_bytes):
+        with self._lock:
+            self._maybe_fail()
+            self.reads += 1
+            if self._answer is not None and self.early_ack \
+                    and self._last_answer is not None \
+                    and time.monotonic() < self._answer_at:
+                return (self._last_answer + bytes(n_bytes))[:n_bytes]
+            if self._answer is None or time.monotonic() < self._answer_at:
+                self.naks += 1
+                raise OSError(errno.EREMOTEIO, "SL030 did not acknowledge")
+            return (self._answer + bytes(n_bytes))[:n_bytes]
+
+    # Length, command, status, card ID, card type
+    def _select_card_answer(self):
+        if self.card is None:
+            return bytes((2, 0x1, self.status_no_tag))
+        return bytes((len(self.card) + 3, 0x1, self.status_ok)) + \
+                self.card + bytes((self.card_type,))
+
+    def _maybe_fail(self):
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            raise OSError(errno.EIO, "Simulated i2c bus error")
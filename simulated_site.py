@@ -0,0 +1,184 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Simulated site
+###############################################################################
+
+# Runs the real rpac code (config.parse_config_options, the readers and
+# devices, and the event loop in event_loop.py) against simulated hardware,
+# and provides a way to present cards to the simulated readers and see how
+# long it takes for the devices to respond. Used by benchmark.py and by
+# rpac.py's replay mode.
+#
+# The 'simulated' hardware backend must be selected (hardware.use_backend)
+# before the site's config is parsed.
+
+# System-Wide packages
+import threading
+import time
+
+# Local Packages
+import dispatcher
+import event_loop
+import simulated_gpio
+import simulated_i2c
+
+
+# Write a config file for a site with reader_count readers, each controlling
+# its own device. Reader n's trigger pin is 100 + n, and device n's relay is
+# pin 200 + n. Up to eight readers share each i2c bus. Every device uses
+# the same ACL file
+def write_site_config(filename, acl_path, acl_filename, reader_count):
+    with open(filename, 'w') as f:
+        f.write("[Paths]\naccess control files = %s\n" % acl_path)
+        for n in range(reader_count):
+            f.write("\n[Device device_%d]\n" % n)
+            f.write("enable set pins high = %d\n" % (200 + n))
+            f.write("disable set pins low = %d\n" % (200 + n))
+            f.write("acl filename = %s\n" % acl_filename)
+            f.write("\n[Reader reader_%d]\n" % n)
+            f.write("associated device = device_%d\n" % n)
+            f.write("trigger pin = %d\n" % (100 + n))
+            f.write("reader type = StrongLinkSl030Reader\n")
+            f.write("i2c bus = %d\n" % (1 + n // 8))
+            f.write("i2c address = 0x%02X\n" % (0x50 + n % 8))
+
+
+###############################################################################
+# Class - SimulatedSite
+###############################################################################
+
+class SimulatedSite:
+
+    def __init__(self, readers_by_name, devices_by_name, sl030_options=None):
+        """Simulated Site Constructor"""
+        self.readers_by_name = readers_by_name
+        self.devices_by_name = devices_by_name
+
+        # Attach a simulated SL030 for each reader, wired to its trigger pin
+        simulated_i2c.detach_all_devices()
+        self.sl030s_by_reader_name = {}
+        for name, reader in readers_by_name.items():
+            sl030 = simulated_i2c.SimulatedSl030(
+                    out_pin=reader.trigger_pin, **(sl030_options or {}))
+            bus_number = reader.i2c_bus_number
+            if bus_number is None:
+                bus_number = simulated_i2c.default_bus_number
+            simulated_i2c.attach_device(sl030, reader.i2c_address, bus_number)
+            if reader.trigger_pin is not None:
+                simulated_gpio.pins.pin(reader.trigger_pin).set_input(1)
+            self.sl030s_by_reader_name[name] = sl030
+
+        # Watch each device's pins, to see when it is enabled or disabled
+        self._device_states = {}
+        self._condition = threading.Condition()
+        self._listeners = []
+        for name, device in devices_by_name.items():
+            self._device_states[name] = (None, None)
+            self._watch_device(name, device)
+
+        self._stop_event = None
+        self._loop_thread = None
+        self.dispatcher = None
+
+    # A device is enabled when the first of its 'enable' pins is set to its
+    # enabled value, and disabled when that pin is set to anything else
+    def _watch_device(self, name, device):
+        if device.enable_set_pins_high:
+            pin_number, enabled_value = device.enable_set_pins_high[0], 1
+        else:
+            pin_number, enabled_value = device.enable_set_pins_low[0], 0
+
+        def listener(pin, value):
+            with self._condition:
+                self._device_states[name] = \
+                        (value == enabled_value, time.monotonic())
+                self._condition.notify_all()
+
+        simulated_gpio.pins.pin(pin_number).add_listener(listener)
+        self._listeners.append((pin_number, listener))
+
+    # Run the rpac event loop in a background thread
+    def start(self, dispatch_mode='serial'):
+        self.dispatcher = dispatcher.dispatchers_by_mode[dispatch_mode](
+                self.devices_by_name)
+        self._stop_event = threading.Event()
+        self._loop_thread = threading.Thread(name="event-loop",
+                target=event_loop.wait_for_pin_state_changes,
+                args=(self.readers_by_name, self.devices_by_name,
+                        self.dispatcher, self._stop_event),
+                daemon=True)
+        self._loop_thread.start()
+
+        # Wait until the loop has opened the trigger pins
+        while not all(simulated_gpio.pins.pin(r.trigger_pin).fileno()
+                    for r in self.readers_by_name.values()
+                    if r.trigger_pin is not None):
+            time.sleep(0.001)
+
+    def stop(self):
+        if self._loop_thread is not None:
+            self._stop_event.set()
+            self._loop_thread.join()
+            self.dispatcher.stop()
+            self._loop_thread = None
+        for pin_number, listener in self._listeners:
+            simulated_gpio.pins.pin(pin_number).remove_listener(listener)
+        self._listeners = []
+
+    def present_card(self, reader_name, card):
+        self.sl030s_by_reader_name[reader_name].present_card(card)
+
+    def remove_card(self, reader_name):
+        self.sl030s_by_reader_name[reader_name].remove_card()
+
+    # Wait for the device to be set (enabled or disabled) after 'since' (a
+    # time.monotonic() time). Returns (enabled, time it was set), or
+    # (None, None) on timeout
+    def wait_for_device(self, device_name, since, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                enabled, set_at = self._device_states[device_name]
+                if set_at is not None and set_at >= since:
+                    return enabled, set_at
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, None
+                self._condition.wait(remaining)
+
+    # Present a card to a reader, wait for its device to respond, then
+    # remove the card and wait for the device to be disabled again.
+    #
+    # Returns (enabled, seconds until the device responded to the card,
+    # seconds until it was disabled after the card was removed). The times
+    # are None if the device didn't respond
+    def swipe(self, reader_name, card, timeout=5.0):
+        device_name = self.readers_by_name[reader_name].associated_device
+
+        presented_at = time.monotonic()
+        self.present_card(reader_name, card)
+        enabled, set_at = self.wait_for_device(device_name, presented_at,
+                timeout)
+        unlock_time = None if set_at is None else set_at - presented_at
+
+        removed_at = time.monotonic()
+        self.remove_card(reader_name)
+        _, set_at = self.wait_for_device(device_name, removed_at, timeout)
+        lock_time = None if set_at is None else set_at - removed_at
+
+        return enabled, unlock_time, lock_time
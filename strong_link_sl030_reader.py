@@ -16,11 +16,17 @@
 
 # System-Wide packages
 import logging
+import random
 import re
 import time
 
-# Associated Packages
-import quick2wire.i2c as i2c
+# Local Packages
+import hardware
+import metrics
+import traffic_trace
+from circuit_breaker import CircuitBreaker
+from latency_trace import LatencyStats, SwipeTrace
+from rpac_logging import HexCardId, audit
 
 ###############################################################################
 # Strong Link SL 030 i2c Card Reader
@@ -36,11 +42,88 @@ class StrongLinkSl030Reader:
     # This pin indicates that a card is near the reader
     trigger_pin = None
 
+    # Readers without a spare pin for the trigger can instead be polled for
+    # cards (see poll_scheduler.py). A polled reader is asked for a card
+    # every 'active card poll interval' seconds after a card has been seen,
+    # slowing down by 'card poll backoff' each time it finds nothing, to
+    # every 'idle card poll interval' seconds
+    poll_for_cards = False
+    active_card_poll_interval = 0.05
+    idle_card_poll_interval = 0.5
+    card_poll_backoff = 1.5
+
+    # The state of polling: whether a poll is under way, when the next one
+    # is due (time.monotonic()), the interval to the one after that, and
+    # the card seen by the last poll
+    polling = False
+    next_poll_time = 0.0
+    card_poll_interval = None
+    polled_card = None
+
+    # After the trigger pin changes, further changes are ignored for this
+    # many seconds (see edge_debouncer.py)
+    debounce_time = 0.0
+
     # Used for enabling/disabling
     associated_device = None
 
-    # How to communicate with the card reader
+    # Which worker process to run this reader in, when rpac is run with
+    # --supervise (see supervisor.py). Defaults to one per i2c bus
+    worker = None
+
+    # How to communicate with the card reader. The I2CBus is shared with
+    # any other readers on the same bus, and is set up by
+    # config.parse_config_options based on 'i2c bus'
     i2c_address = None
+    i2c_bus_number = None
+    i2c_bus = None
+
+    # After asking the SL030 to select a card, we poll for its answer.
+    # The first poll is after 'poll interval' seconds, with the wait between
+    # polls growing by 'poll backoff' each time (up to 'max poll interval'),
+    # and giving up after 'response timeout' seconds
+    poll_interval = 0.005
+    poll_backoff = 1.5
+    max_poll_interval = 0.02
+    response_timeout = 0.25
+
+    # The SL030 has no sequence numbers, so an answer left over from the
+    # last 'select card' looks just like a fresh one. Card IDs that arrive
+    # within 'min response time' seconds of the command and match the last
+    # answer byte for byte are taken to be left over, and polled past
+    min_response_time = 0.05
+    last_answer = None
+
+    # Sending the 'select card' command is tried again up to 'read retries'
+    # times if the bus reports an error, waiting a random time of up to
+    # 'retry delay' seconds (doubling with each retry) in between
+    read_retries = 2
+    retry_delay = 0.005
+
+    # Once 'failure threshold' reads in a row have failed, the reader is
+    # taken out of service, and probed every 'probe interval' seconds until
+    # it answers again (see circuit_breaker.py)
+    failure_threshold = 5
+    probe_interval = 5.0
+    circuit_breaker = None
+
+    # How long the SL030 took to answer, so that the poll interval can be
+    # tuned for each site
+    last_response_time = None
+    response_count = 0
+    response_time_total = 0.0
+    response_time_max = 0.0
+
+    # What the 'select card' under way is for: 'read' (the trigger pin
+    # dropped), 'poll' or 'probe' (see circuit_breaker.py). Recorded in
+    # traffic traces, so that a replay only uses the answers recorded for
+    # one kind of select for that kind (see traffic_replay.py)
+    select_kind = None
+
+    # Timings of each step of handling a card being presented or removed
+    # (see latency_trace.py)
+    swipe_latency = None
+    removal_latency = None
 
 
     # This device is instantiated and configured based on a config file. The
@@ -48,6 +131,9 @@ class StrongLinkSl030Reader:
     # appropriate parameters
     def  __init__(self, config):
         """Reader Constructor"""
+        self.swipe_latency = LatencyStats()
+        self.removal_latency = LatencyStats()
+
         # Read config parameters dictionary. Note that if someone supplies
         # an unsupported parameter, we raise error
         for o, a in config:
@@ -57,8 +143,40 @@ class StrongLinkSl030Reader:
                 if not re.match(r'^0x', a):
                     assert False, "i2c address must be in hex format"
                 self.i2c_address = int(a, 16)
+            elif o == 'i2c bus':
+                self.i2c_bus_number = int(a)
             elif o == 'associated device':
                 self.associated_device = a
+            elif o == 'debounce time':
+                self.debounce_time = float(a)
+            elif o == 'poll interval':
+                self.poll_interval = float(a)
+            elif o == 'poll backoff':
+                self.poll_backoff = float(a)
+            elif o == 'max poll interval':
+                self.max_poll_interval = float(a)
+            elif o == 'response timeout':
+                self.response_timeout = float(a)
+            elif o == 'min response time':
+                self.min_response_time = float(a)
+            elif o == 'poll for cards':
+                if a.lower() not in ('yes', 'no'):
+                    assert False, "'poll for cards' must be 'yes' or 'no'"
+                self.poll_for_cards = a.lower() == 'yes'
+            elif o == 'active card poll interval':
+                self.active_card_poll_interval = float(a)
+            elif o == 'idle card poll interval':
+                self.idle_card_poll_interval = float(a)
+            elif o == 'read retries':
+                self.read_retries = int(a)
+            elif o == 'retry delay':
+                self.retry_delay = float(a)
+            elif o == 'failure threshold':
+                self.failure_threshold = int(a)
+            elif o == 'probe interval':
+                self.probe_interval = float(a)
+            elif o == 'worker':
+                self.worker = a
             else:
                 if o != 'reader type':
                     assert False, "Unsupported parameter '%s'" % o
@@ -66,60 +184,300 @@ class StrongLinkSl030Reader:
         # Check that everything makes sense in the supplied config
         # file, so that if someone leaves out a critical parameter or
         # similar, we raise an appropriate error
-        if self.trigger_pin is None:
-            assert False, "%s - trigger_pin not set" % self.name
+        if self.trigger_pin is None and not self.poll_for_cards:
+            assert False, "%s - neither trigger_pin nor poll for cards set" \
+                    % self.name
+        if self.trigger_pin is not None and self.poll_for_cards:
+            assert False, "%s - a reader with a trigger_pin can't also " \
+                    "poll for cards" % self.name
+        if self.active_card_poll_interval <= 0 \
+                or self.idle_card_poll_interval < \
+                    self.active_card_poll_interval:
+            assert False, "%s - card poll intervals must be positive, with " \
+                    "the idle one no shorter than the active one" % self.name
+        self.card_poll_interval = self.active_card_poll_interval
         if not self.associated_device:
             assert False, "%s - associated_device not set" % self.name
         if not self.i2c_address:
             assert False, "%s - i2c address not set" % self.name
+        if self.debounce_time < 0:
+            assert False, "%s - debounce time can't be negative" % self.name
+        if self.poll_interval <= 0 or self.max_poll_interval <= 0:
+            assert False, "%s - poll intervals must be positive" % self.name
+        if self.poll_backoff < 1:
+            assert False, "%s - poll backoff must be at least 1" % self.name
+        if self.response_timeout < self.poll_interval:
+            assert False, "%s - response timeout is shorter than " \
+                "the poll interval" % self.name
+        if self.min_response_time < 0 \
+                or self.min_response_time >= self.response_timeout:
+            assert False, "%s - min response time must be at least 0, and " \
+                "shorter than the response timeout" % self.name
+        if self.read_retries < 0 or self.retry_delay < 0:
+            assert False, "%s - read retries and retry delay can't be " \
+                    "negative" % self.name
+        if self.failure_threshold < 1 or self.probe_interval <= 0:
+            assert False, "%s - failure threshold must be at least 1, and " \
+                    "probe interval positive" % self.name
+
+        self.circuit_breaker = CircuitBreaker(self.probe,
+                self.failure_threshold, self.probe_interval)
 
     # Callback - called when the state of the 'trigger pin'
     # goes either high or low. Then either disables or enables
-    # the associated devices
-    def trigger_pin_state_change(self, new_state, devices_by_name):
-        logging.debug("State change - %s" % new_state)
+    # the associated devices.
+    #
+    # The trace is started by the event loop when it sees the pin change,
+    # and is marked as each step of handling the change completes
+    def trigger_pin_state_change(self, new_state, devices_by_name,
+                trace=None):
+        if trace is None:
+            trace = SwipeTrace()
+        logging.debug("State change - %s", new_state)
         device = devices_by_name[self.associated_device]
-        logging.debug("Device - %s" % self.associated_device)
+        logging.debug("Device - %s", self.associated_device)
         # If the pin state drops to false, then it means a card has been
-        # presented - try and read the card
+        # presented - try and read the card.
+        #
+        # If no card could be read (the reader didn't answer, or the card
+        # had already gone), there's nothing to decide: the device was
+        # disabled when the last card was removed, and stays that way
         if new_state == False:
-            logging.debug("Reading card on reader %s" % self.name)
-            card = self.read_card()
-            device.check_for_card_in_db(card)
+            if self.circuit_breaker.degraded:
+                logging.info("Reader %s is out of service - ignoring card",
+                        self.name)
+                return
+            logging.debug("Reading card on reader %s", self.name)
+            with self.i2c_bus.reading_card():
+                card = self.read_card(trace)
+            if card is None:
+                logging.info("No card read on reader %s - leaving device "
+                        "%s alone", self.name, self.associated_device)
+                return
+            self.card_presented(card, device, trace)
+        else:
+            self.card_removed(device, trace)
+
+    def card_presented(self, card, device, trace):
+        device.check_for_card_in_db(card, trace)
+        self.swipe_latency.record(trace)
+
+    # The card has been removed - we need to ensure that the associated
+    # device is turned off (straight away, or once it has been enabled for
+    # its 'min unlock time')
+    def card_removed(self, device, trace):
+        logging.debug("Disabling device %s", self.associated_device)
+        device.card_removed(trace)
+        self.removal_latency.record(trace)
+        audit(self.associated_device, None, 'removed')
+        metrics.access_decisions.inc(self.associated_device, 'removed')
+        traffic_trace.record_decision(self.associated_device, None,
+                'removed')
+        logging.debug("Device %s disabled", self.associated_device)
+
+    # Called (through the dispatcher) when the PollScheduler decides it's
+    # time to poll this reader. A new card appearing is handled as if the
+    # trigger pin had dropped, and the card going (or changing) as if it
+    # had risen. If the reader doesn't answer, nothing is assumed, unless
+    # that has taken it out of service
+    def poll(self, devices_by_name, trace=None):
+        if trace is None:
+            trace = SwipeTrace()
+        try:
+            if self.circuit_breaker.degraded:
+                self._schedule_next_poll(False)
+                return
+            with self.i2c_bus.polling():
+                answered, card = self._select_card(trace, logging.DEBUG,
+                        'poll')
+            device = devices_by_name[self.associated_device]
+            if not answered:
+                # A reader going out of service with a card on it can't
+                # tell us when the card goes, so treat it as gone now
+                if self.circuit_breaker.degraded \
+                        and self.polled_card is not None:
+                    self.card_removed(device, trace)
+                    self.polled_card = None
+                self._schedule_next_poll(False)
+                return
+
+            if card != self.polled_card:
+                if self.polled_card is not None:
+                    self.card_removed(device, trace)
+                if card is not None:
+                    self.card_presented(card, device, trace)
+                self.polled_card = card
+
+            # While a card is there, keep polling quickly so that we notice
+            # it going
+            self._schedule_next_poll(card is not None)
+        finally:
+            self.polling = False
+
+    def _schedule_next_poll(self, active):
+        if active:
+            self.card_poll_interval = self.active_card_poll_interval
         else:
-            logging.debug("Disabling device %s" % self.associated_device)
-            # The card has been removed - we need to ensure that the
-            # associated device is turned off
-            devices_by_name[self.associated_device].disable()
-            logging.debug("Device %s disabled" % self.associated_device)
+            self.card_poll_interval = min(self.idle_card_poll_interval,
+                    self.card_poll_interval * self.card_poll_backoff)
+        self.next_poll_time = time.monotonic() + self.card_poll_interval
+
+    # Called when the reader is removed from the config, or replaced
+    def close(self):
+        self.circuit_breaker.stop()
 
     # Read the card via the i2c protocol. See the user manual at
     # http://www.stronglink-rfid.com/en/rfid-modules/sl030.html
-    def read_card(self):
-        logging.info("Fetching card id from %0X" % self.i2c_address)
-        # Fetch the card ID by sending 1/1 to the SL030 card reader
-        with i2c.I2CMaster() as bus:
-            bus.transaction(
-                i2c.writing_bytes(0x50, 0x1, 0x1))
-            time.sleep(0.1)      # SL030 requires this time to respond reliably
-            read_results = bus.transaction(
-                i2c.reading(0x50, 10))
+    def read_card(self, trace=None):
+        answered, card = self._select_card(trace, logging.INFO, 'read')
+        return(card)
 
-        returned_len = read_results[0][0]
-        status = read_results[0][2]
+    # Called by the circuit breaker, from its own thread, while the reader
+    # is out of service. The probe is made as a poll, so that it gives way
+    # to the other readers on the bus
+    def probe(self):
+        if self.i2c_bus.card_reads_in_progress:
+            return False
+        with self.i2c_bus.polling():
+            answered, card = self._select_card(None, logging.DEBUG, 'probe')
+        return answered
+
+    # Returns (whether the reader answered, the card ID or None). Routine
+    # messages are logged at log_level, so that polling isn't too chatty.
+    # 'kind' is what the select is for (see select_kind)
+    def _select_card(self, trace, log_level, kind):
+        self.select_kind = kind
+        answered, card = self._send_select_card(trace, log_level, kind)
+        if answered:
+            if self.circuit_breaker.record_success():
+                logging.warning("Reader %s is answering again - back in "
+                        "service", self.name)
+                metrics.reader_degraded.set(0, self.name)
+        elif self.circuit_breaker.record_failure():
+            logging.error("Reader %s has failed %d reads in a row - out of "
+                    "service until it answers again", self.name,
+                    self.circuit_breaker.consecutive_failures)
+            metrics.reader_degraded.set(1, self.name)
+        return(answered, card)
+
+    def _send_select_card(self, trace, log_level, kind):
+        logging.log(log_level, "Fetching card id from %0X", self.i2c_address)
+        # Fetch the card ID by sending 1/1 to the SL030 card reader. Bus
+        # errors are often a one-off, so the command is tried again a few
+        # times
+        attempt = 0
+        while True:
+            try:
+                self.i2c_bus.transaction(
+                    hardware.i2c.writing_bytes(self.i2c_address, 0x1, 0x1))
+                break
+            except IOError as e:
+                traffic_trace.record_write_error(self.name, kind)
+                if attempt >= self.read_retries:
+                    logging.info("Error sending command to card reader (%s)",
+                            e)
+                    metrics.card_reads.inc(self.name, 'write_error')
+                    return(False, None)
+                time.sleep(random.uniform(0, self.retry_delay * 2 ** attempt))
+                attempt += 1
+        if trace is not None:
+            trace.mark('i2c write')
+
+        read_results = self._poll_for_response()
+        if trace is not None and read_results is not None:
+            trace.mark('i2c read')
 
-        if returned_len == 0:
+        if read_results is None:
             logging.info("Error fetching from card reader")
-            return(None)
+            metrics.card_reads.inc(self.name, 'timeout')
+            traffic_trace.record_frame(self.name, self.response_timeout, None,
+                    kind)
+            return(False, None)
+        traffic_trace.record_frame(self.name, self.last_response_time,
+                read_results[0], kind)
+
+        returned_len = read_results[0][0]
+        status = read_results[0][2]
 
         if status == 0x1:       # No Tag
-            logging.info("No tag detected")
-            return(None)
+            logging.log(log_level, "No tag detected")
+            metrics.card_reads.inc(self.name, 'no_tag')
+            return(True, None)
         else:
-            # Format the read card ID as a hex string
-            card_as_hex = []
-            for x in range(3, returned_len):
-                card_as_hex.append('{1:02x}'.format(x,
-                        read_results[0][x]).upper())
-            logging.debug("Card presented: " % card_as_hex)
-            return(''.join(card_as_hex))
+            # Hand back the raw card ID bytes - the card databases store
+            # card IDs as bytes, so there's no need to format them as hex
+            card = bytes(read_results[0][3:returned_len])
+            logging.debug("Card presented: %s", HexCardId(card))
+            metrics.card_reads.inc(self.name, 'card')
+            return(True, card)
+
+    # The SL030 needs some time to answer the 'select card' command. Rather
+    # than always waiting for the worst case, poll it until it hands back a
+    # valid frame, or until the response timeout expires.
+    #
+    # Until it is ready, the SL030 should not acknowledge the read (which
+    # quick2wire raises as an IOError). In case it acknowledges early, with
+    # its last answer still in its buffer, a card ID matching the last
+    # answer is only accepted once 'min response time' has passed -
+    # otherwise a card could be let in on the previous card's ID. (A stale
+    # 'no tag' can only keep a card out, so isn't held back.) Frames that
+    # aren't well-formed 'select card' answers (e.g. a read that caught the
+    # bus mid-change) are skipped.
+    def _poll_for_response(self):
+        started = time.monotonic()
+        deadline = started + self.response_timeout
+        interval = self.poll_interval
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                logging.info("No response from card reader %s after %.3fs",
+                        self.name, now - started)
+                return(None)
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * self.poll_backoff,
+                    self.max_poll_interval)
+
+            try:
+                read_results = self.i2c_bus.transaction(
+                    hardware.i2c.reading(self.i2c_address, 10))
+            except IOError:
+                continue
+
+            frame = read_results[0]
+            if not self._is_valid_response(frame):
+                continue
+            answer = bytes(frame[:frame[0] + 1])
+            response_time = time.monotonic() - started
+            if answer == self.last_answer and frame[2] == 0x0 \
+                    and response_time < self.min_response_time:
+                logging.debug("Reader %s repeated its last answer after "
+                        "%.1fms - polling again", self.name,
+                        response_time * 1000)
+                continue
+            self.last_answer = answer
+            self._record_response_time(response_time)
+            return(read_results)
+
+    # A well-formed answer to 'select card' echoes the command (0x1) back,
+    # and is either 'no tag' (length 2), or 'OK' with a 4 or 7 byte card ID
+    # and the card type (length 7 or 10). Note that with a 7 byte card ID,
+    # the card type byte at the end doesn't fit in the bytes we read, but
+    # we don't use it
+    def _is_valid_response(self, frame):
+        if len(frame) < 3 or frame[1] != 0x1:
+            return False
+        if frame[2] == 0x1:
+            return frame[0] == 2
+        return frame[2] == 0x0 and frame[0] in (7, 10)
+
+    def _record_response_time(self, response_time):
+        self.last_response_time = response_time
+        self.response_count += 1
+        self.response_time_total += response_time
+        self.response_time_max = max(self.response_time_max, response_time)
+        metrics.card_reader_response.observe(response_time, self.name)
+        logging.debug("Reader %s responded in %.1fms (average %.1fms, "
+                "max %.1fms over %d reads)", self.name,
+                response_time * 1000,
+                self.response_time_total / self.response_count * 1000,
+                self.response_time_max * 1000, self.response_count)
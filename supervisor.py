@@ -0,0 +1,422 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Supervisor: running the readers in several processes
+###############################################################################
+
+# Normally, every reader and device is run by a single rpac process, which
+# only ever uses one of the Pi's cores, and in which a slow log write or a
+# garbage collection pause holds up every door.
+#
+# With --supervise, rpac.py instead runs a Supervisor, which starts a worker
+# process (rpac.py --worker=NAME) for each group of readers: one per i2c bus,
+# or as set by the readers' 'worker' parameters (see
+# config.assign_workers). Each worker runs the event loop for its own
+# readers and their devices, exactly as rpac normally would.
+#
+# The ACL files are shared between the workers: the supervisor loads each
+# text ACL file once, and writes a compiled copy of it (see
+# card_database.CompiledCardDatabase) to the shared ACL directory, which the
+# workers memory-map rather than each loading the file themselves. The
+# supervisor also builds the AccessIndex for all of the devices that use
+# access groups, and writes it to the same directory (see
+# access_index.CompiledAccessIndex), so the workers don't each build their
+# own. By default, the directory is on /dev/shm, so the copies are only ever
+# held in memory, once. The supervisor rewrites the copies whenever the ACL
+# files change (including through --sync, which is done by the supervisor
+# alone), and the workers pick them up on the next card lookup.
+#
+# If a worker exits, it is restarted, waiting longer between restarts (up to
+# max_restart_delay) while it keeps failing soon after starting. The other
+# workers, and their doors, carry on as they are.
+#
+# Signals sent to the supervisor are passed on to the workers: SIGHUP
+# (reload the config file - the supervisor also starts and stops workers to
+# match it), and SIGUSR1 (latency reports). SIGUSR2 (sync the ACLs) is
+# handled by the supervisor. On SIGTERM or SIGINT, the workers are stopped.
+#
+# Each worker has a pipe from the supervisor as its standard input, and
+# exits if the supervisor goes away. Its standard output is a pipe back to
+# the supervisor, on which it says when it is ready. Until then, it hasn't
+# set up its signal handlers, so it isn't sent any signals: a reload asked
+# for before then is passed on once it is ready.
+
+# System-Wide packages
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Local Packages
+import access_index
+import card_database
+import config
+
+
+###############################################################################
+# Class - SharedAclIndexes
+###############################################################################
+
+# Keeps a compiled copy of each text ACL file, and of the AccessIndex, in
+# the shared ACL directory
+class SharedAclIndexes:
+
+    def __init__(self, shared_dir):
+        """Shared ACL Indexes Constructor"""
+        self.shared_dir = shared_dir
+        self.card_databases = []
+        self._listeners_by_database = {}
+        self._shared_filenames_by_database = {}
+        self.access_index = None
+        self._access_index_databases = []
+        self._changed = set()
+        self._access_index_changed = False
+        self._lock = threading.Lock()
+        os.makedirs(shared_dir, exist_ok=True)
+
+    # Share these ACL files (from now on, if not already), and stop keeping
+    # the copies of any others up to date. Their copies are left in place,
+    # as workers still using them map them until they reload their config.
+    #
+    # The filenames are relative to acl_path. card_databases is replaced
+    # rather than changed, so that other threads (e.g. the AclSync) can use
+    # it while this is going on
+    def set_files(self, acl_path, filenames):
+        card_databases = []
+        for filename in filenames:
+            db = card_database.open_card_database(acl_path, filename)
+            if db in card_databases \
+                    or isinstance(db, card_database.CompiledCardDatabase):
+                continue
+            card_databases.append(db)
+            if db not in self.card_databases:
+                listener = lambda cards, db=db: self._mark_changed(db)
+                self._listeners_by_database[db] = listener
+                self._shared_filenames_by_database[db] = \
+                        card_database.shared_index_filename(acl_path,
+                            filename, self.shared_dir)
+                db.listeners.append(listener)
+                self._write(db)
+        for db in self.card_databases:
+            if db not in card_databases:
+                db.listeners.remove(self._listeners_by_database.pop(db))
+                del self._shared_filenames_by_database[db]
+        self.card_databases = card_databases
+
+    def _mark_changed(self, db):
+        with self._lock:
+            self._changed.add(db)
+
+    # Share this AccessIndex (from config.build_access_index, or None if no
+    # devices use groups) in place of the last one
+    def set_access_index(self, index):
+        if self.access_index is not None:
+            self.access_index.close()
+        for db in self._access_index_databases:
+            db.listeners.remove(self._mark_access_index_changed)
+        self.access_index = index
+        self._access_index_databases = []
+
+        filename = access_index.shared_access_index_filename(self.shared_dir)
+        if index is None:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return
+        for group in index.groups_by_name.values():
+            for db in group.card_databases:
+                if db not in self._access_index_databases:
+                    db.listeners.append(self._mark_access_index_changed)
+                    self._access_index_databases.append(db)
+        self._write_access_index()
+
+    def _mark_access_index_changed(self, cards):
+        with self._lock:
+            self._access_index_changed = True
+
+    # Rewrite the copies of the files that have changed, and of the
+    # AccessIndex if any of its groups' files have
+    def refresh(self):
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            access_index_changed = self._access_index_changed
+            self._access_index_changed = False
+        for db in self.card_databases:
+            if db.reload_if_changed() or db in changed:
+                self._write(db)
+        if self.access_index is not None and \
+                (self.access_index.reload_if_changed() or access_index_changed):
+            self._write_access_index()
+
+    def _write(self, db):
+        filename = self._shared_filenames_by_database[db]
+        try:
+            count = card_database.write_compiled_card_database(list(db),
+                    filename)
+        except (OSError, ValueError) as e:
+            logging.error("Can't write shared copy of ACL file %s (%s)",
+                    db.filename, e)
+            return
+        logging.info("Shared %d cards from ACL file %s as %s", count,
+                db.filename, filename)
+
+    def _write_access_index(self):
+        filename = access_index.shared_access_index_filename(self.shared_dir)
+        try:
+            count = self.access_index.write_compiled(filename)
+        except (OSError, ValueError) as e:
+            logging.error("Can't write shared access index %s (%s)",
+                    filename, e)
+            return
+        logging.info("Shared access index of %d cards as %s", count,
+                filename)
+
+
+# The text ACL files used by the devices and groups in the config file,
+# relative to the access control files path
+def acl_files(sections):
+    filenames = []
+    for section, items in sections:
+        items = dict(items)
+        if section.startswith('Device ') and 'acl filename' in items:
+            filenames.append(items['acl filename'])
+        elif section.startswith('Group ') and 'card files' in items:
+            filenames.extend(items['card files'].split())
+    return [filename for filename in filenames
+            if not filename.endswith(card_database.compiled_card_db_suffix)]
+
+
+###############################################################################
+# Class - WorkerProcess
+###############################################################################
+
+class WorkerProcess:
+
+    min_restart_delay = 1.0
+    max_restart_delay = 60.0
+
+    # A worker that has run for this long is considered to have started
+    # successfully, so if it exits, the wait before restarting it starts
+    # again from min_restart_delay
+    stable_time = 30.0
+
+    def __init__(self, name, argv):
+        """Worker Process Constructor"""
+        self.name = name
+        self.argv = argv
+        self.process = None
+        self.started_at = None
+        self.restart_at = None
+        self.restart_delay = self.min_restart_delay
+        self.restarts = 0
+
+        # Whether the worker has said it is ready (see report_ready), and
+        # whether it is to be told to reload once it is
+        self.ready = False
+        self.reload_pending = False
+
+    def start(self):
+        self.process = subprocess.Popen(self.argv, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        os.set_blocking(self.process.stdout.fileno(), False)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        self.ready = False
+        self.reload_pending = False
+        logging.info("Started worker %s (pid %d)", self.name,
+                self.process.pid)
+
+    # Check on the worker, restarting it if it has exited and it's time to
+    def check(self, now):
+        if self.process is not None:
+            self._check_ready()
+            status = self.process.poll()
+            if status is None:
+                return
+            self._close_pipes()
+            self.process = None
+            if now - self.started_at >= self.stable_time:
+                self.restart_delay = self.min_restart_delay
+            self.restart_at = now + self.restart_delay
+            logging.error("Worker %s exited with status %d - restarting in "
+                    "%.0fs", self.name, status, self.restart_delay)
+            self.restart_delay = min(self.restart_delay * 2,
+                    self.max_restart_delay)
+        if self.restart_at is not None and now >= self.restart_at:
+            self.restarts += 1
+            self.start()
+
+    def _check_ready(self):
+        try:
+            output = self.process.stdout.read()
+        except BlockingIOError:
+            return
+        if self.ready or not output or b'ready\n' not in output:
+            return
+        self.ready = True
+        logging.info("Worker %s is ready", self.name)
+        if self.reload_pending:
+            self.reload_pending = False
+            self.process.send_signal(signal.SIGHUP)
+
+    # Signals sent before the worker is ready would kill it. A reload is
+    # sent once it is ready instead (in case it read the config file before
+    # it changed), and anything else is dropped
+    def send_signal(self, signum):
+        if self.process is None:
+            return
+        if not self.ready:
+            if signum == signal.SIGHUP:
+                self.reload_pending = True
+            return
+        self.process.send_signal(signum)
+
+    def _close_pipes(self):
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+    def stop(self, timeout=5.0):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logging.error("Worker %s didn't stop - killing it", self.name)
+            self.process.kill()
+            self.process.wait()
+        self._close_pipes()
+        self.process = None
+        logging.info("Stopped worker %s", self.name)
+
+
+###############################################################################
+# Class - Supervisor
+###############################################################################
+
+# 'worker_argv' is called with the name and number of each worker, and
+# returns the command line to start it with
+class Supervisor:
+
+    # How often to check on the workers and the ACL files, in seconds
+    check_interval = 0.5
+
+    def __init__(self, config_filename, shared_acl_dir, worker_argv):
+        """Supervisor Constructor"""
+        self.config_filename = config_filename
+        self.worker_argv = worker_argv
+        self.shared_acls = SharedAclIndexes(shared_acl_dir)
+        self.workers_by_name = {}
+        self.acl_path = None
+        self._wakeup = threading.Event()
+        self._signals = []
+
+    # Read the config file, share its ACL files, and work out which workers
+    # are needed
+    def read_config(self):
+        sections = config.read_config_sections(self.config_filename)
+        paths = dict(dict(sections).get('Paths', []))
+        if 'access control files' not in paths:
+            assert False, "'access control files' not set in [Paths]"
+        self.acl_path = paths['access control files']
+        worker_names = sorted(config.assign_workers(sections))
+        self.shared_acls.set_files(self.acl_path,
+                acl_files(sections))
+        self.shared_acls.set_access_index(
+                config.build_access_index(sections, self.acl_path))
+        return worker_names
+
+    # Start, stop and signal workers to match the config file
+    def update_workers(self, worker_names, reload_signal=None):
+        for name in list(self.workers_by_name):
+            if name not in worker_names:
+                self.workers_by_name.pop(name).stop()
+        for number, name in enumerate(worker_names):
+            if name in self.workers_by_name:
+                if reload_signal is not None:
+                    self.workers_by_name[name].send_signal(reload_signal)
+            else:
+                worker = WorkerProcess(name, self.worker_argv(name, number))
+                self.workers_by_name[name] = worker
+                worker.start()
+        logging.info("Running %d workers: %s", len(worker_names),
+                " ".join(worker_names))
+
+    def _signalled(self, signum, frame):
+        self._signals.append(signum)
+        self._wakeup.set()
+
+    # Run the workers (as returned by read_config) until SIGTERM or SIGINT
+    def run(self, worker_names):
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM,
+                    signal.SIGINT):
+            signal.signal(signum, self._signalled)
+        self.update_workers(worker_names)
+
+        while True:
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    logging.info("Stopping workers")
+                    for worker in self.workers_by_name.values():
+                        worker.stop()
+                    return
+                elif signum == signal.SIGHUP:
+                    self.reload_config()
+                else:
+                    for worker in self.workers_by_name.values():
+                        worker.send_signal(signum)
+
+            self.shared_acls.refresh()
+            now = time.monotonic()
+            for worker in self.workers_by_name.values():
+                worker.check(now)
+
+    # The ACL files are shared before the workers are told to reload, so
+    # that any new ones are there for them
+    def reload_config(self):
+        logging.info("Reloading config")
+        try:
+            worker_names = self.read_config()
+        except Exception as e:
+            logging.exception("Can't reload config (%s) - carrying on "
+                    "with the current one", e)
+            return
+        self.update_workers(worker_names, signal.SIGHUP)
+
+
+# In a worker, wait for the supervisor's end of the standard input pipe to
+# close (which it does when the supervisor exits, however that happens),
+# and then call on_supervisor_gone
+def watch_supervisor(on_supervisor_gone):
+    def watch():
+        while sys.stdin.buffer.read(4096):
+            pass
+        on_supervisor_gone()
+    threading.Thread(name="supervisor-watch", target=watch,
+            daemon=True).start()
+
+
+# In a worker, tell the supervisor that the worker is ready, and can be
+# sent signals
+def report_ready():
+    sys.stdout.buffer.write(b'ready\n')
+    sys.stdout.buffer.flush()
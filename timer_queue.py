@@ -0,0 +1,151 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Class - TimerQueue
+###############################################################################
+
+# Things that need doing at a set time (e.g. relocking a door that has been
+# unlocked for too long - see ControlledDevice) are put in a TimerQueue,
+# and run by the event loop in event_loop.py, rather than each having a
+# thread of its own.
+#
+# The timers are kept in a heap, ordered by when they are due, so adding a
+# timer and running the next one are O(log n). Cancelling a timer only
+# marks it as cancelled (O(1)); cancelled timers are dropped as they reach
+# the top of the heap, or all at once if they come to outnumber the live
+# ones.
+#
+# Timers can be added from any thread. The event loop watches fileno(), a
+# pipe that is written to when a timer is added that is due before any
+# other, so that it doesn't sleep past it.
+#
+# The callbacks are run in the event loop, so should be quick.
+
+# System-Wide packages
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        """Timer Constructor"""
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerQueue:
+
+    def __init__(self):
+        """Timer Queue Constructor"""
+        # (when, sequence number, Timer). The sequence number keeps timers
+        # due at the same time in the order they were added
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled_count = 0
+        self._lock = threading.Lock()
+        self._wakeup_read_fd = None
+        self._wakeup_write_fd = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled_count
+
+    # Run callback(*args) at 'when' (a time.monotonic() time). Returns the
+    # Timer, for cancelling it
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._sequence), timer))
+            earliest = self._heap[0][2] is timer
+        if earliest and self._wakeup_write_fd is not None:
+            try:
+                os.write(self._wakeup_write_fd, b'\0')
+            except BlockingIOError:
+                pass
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def cancel(self, timer):
+        with self._lock:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            self._cancelled_count += 1
+            if self._cancelled_count > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap
+                        if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled_count = 0
+
+    # When the next timer is due, or None if there are none
+    def next_deadline(self):
+        with self._lock:
+            self._drop_cancelled()
+            if not self._heap:
+                return None
+            return self._heap[0][0]
+
+    # Run the timers that are due at 'now'. Returns how many were run
+    def run_due(self, now):
+        due = []
+        with self._lock:
+            self._drop_cancelled()
+            while self._heap and self._heap[0][0] <= now:
+                timer = heapq.heappop(self._heap)[2]
+                timer.cancelled = True
+                due.append(timer)
+                self._drop_cancelled()
+
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception("Error running timer %r", timer.callback)
+        return len(due)
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled_count -= 1
+
+    # The file descriptor for the event loop to watch, which becomes
+    # readable when a new earliest timer has been added
+    def fileno(self):
+        if self._wakeup_read_fd is None:
+            self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+            os.set_blocking(self._wakeup_read_fd, False)
+            os.set_blocking(self._wakeup_write_fd, False)
+        return self._wakeup_read_fd
+
+    def clear_wakeup(self):
+        try:
+            os.read(self._wakeup_read_fd, 4096)
+        except BlockingIOError:
+            pass
+
+
+# The TimerQueue run by the event loop in event_loop.py
+shared_timers = TimerQueue()
@@ -0,0 +1,128 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Replaying traffic traces
+###############################################################################
+
+# Replays a trace written by traffic_trace.TraceRecorder against simulated
+# hardware (see rpac.py's --replay option).
+
+# System-Wide packages
+import collections
+import threading
+import time
+
+# Local Packages
+import simulated_gpio
+import simulated_site
+import traffic_trace
+
+# Replay a trace against simulated hardware, using the readers and devices
+# from the site's config (which must have been parsed with the simulated
+# hardware backend selected). Time in the trace is sped up by 'speed'.
+#
+# Card readers answer with the frames recorded in the trace, taking as long
+# as they did originally (this isn't sped up, as it's a property of the
+# hardware), and fail to take the commands that couldn't be sent. The
+# answers recorded for triggered reads, polls and probes are kept apart, so
+# that each triggered read gets the answer recorded for it, however the
+# polls and probes fall in the replay.
+#
+# Returns a summary of the replay, including the latency stats from each
+# reader
+def replay(filename, readers_by_name, devices_by_name, dispatch_mode='serial',
+            speed=1.0):
+    records = traffic_trace.read_trace(filename)
+    site = simulated_site.SimulatedSite(readers_by_name, devices_by_name)
+
+    for name, reader in readers_by_name.items():
+        site.sl030s_by_reader_name[name].select_kind = \
+                lambda reader=reader: reader.select_kind
+
+    # Load each reader's recorded answers, in order
+    for offset, record_type, fields in records:
+        if record_type == 'F' and fields[0] in site.sl030s_by_reader_name:
+            sl030 = site.sl030s_by_reader_name[fields[0]]
+            kind = fields[3] if len(fields) > 3 else 'read'
+            if fields[2] == '!':
+                sl030.queue_write_error(kind)
+                continue
+            frame = None if fields[2] == '-' else bytes.fromhex(fields[2])
+            sl030.queue_answer(frame, float(fields[1]), kind)
+
+    expected_decisions = collections.Counter(
+            (fields[0], fields[2]) for offset, record_type, fields in records
+            if record_type == 'D')
+
+    # Record the decisions made during the replay, to compare them with
+    # the original ones
+    collector = _DecisionCollector()
+    traffic_trace.recorder = collector
+    site.start(dispatch_mode)
+
+    started = time.monotonic()
+    edges = 0
+    try:
+        for offset, record_type, fields in records:
+            if record_type != 'E':
+                continue
+            delay = started + offset / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            simulated_gpio.pins.pin(int(fields[0])).set_input(int(fields[1]))
+            edges += 1
+        elapsed = time.monotonic() - started
+
+        # Give the last events time to be handled
+        slowest_reader = max([r.response_timeout
+                for r in readers_by_name.values()] + [0])
+        time.sleep(slowest_reader + 0.5)
+    finally:
+        site.stop()
+        traffic_trace.recorder = None
+
+    return {
+        'trace': filename,
+        'speed': speed,
+        'dispatch': dispatch_mode,
+        'edges': edges,
+        'seconds': elapsed,
+        'edges per second': edges / elapsed if elapsed else None,
+        'decisions recorded': sum(expected_decisions.values()),
+        'decisions replayed': sum(collector.decisions.values()),
+        'decisions differing':
+                sum(((expected_decisions - collector.decisions)
+                    + (collector.decisions - expected_decisions)).values()),
+        'latency': dict((name, {
+                    'card presented': reader.swipe_latency.summary(),
+                    'card removed': reader.removal_latency.summary()})
+                for name, reader in readers_by_name.items()),
+    }
+
+
+# Stands in for the TraceRecorder during a replay, counting the decisions
+# made for each device
+class _DecisionCollector:
+
+    def __init__(self):
+        self.decisions = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, when, record_type, *fields):
+        if record_type == 'D':
+            with self._lock:
+                self.decisions[(fields[0], fields[2])] += 1
@@ -0,0 +1,159 @@
+# Raspberry Pi-based RFID Access Control System
+# Copyright (C) 2012 Oskar Pearson
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+# Traffic traces: recording and replaying real door traffic
+###############################################################################
+
+# When rpac.py is run with --record, everything that happens at the hardware
+# level is written to a trace file, so that it can be replayed later (with
+# --replay) against simulated hardware - for example, to check that a Pi can
+# cope with a busy morning's traffic before more readers are added to it.
+#
+# The trace file is text, with one tab-separated record per line. Each
+# record starts with the number of seconds since recording started, and a
+# record type:
+#
+#   <time>  E  <pin number>  <value>
+#       A trigger pin changed state
+#
+#   <time>  F  <reader name>  <response seconds>  <frame>  <kind>
+#       A card reader answered a 'select card' command with this frame (as
+#       hex), or '-' if it didn't answer at all, or '!' if the command
+#       couldn't be sent (one record for each attempt, including those
+#       that were retried). The kind is what the select was for: 'read'
+#       (a trigger pin dropped), 'poll' or 'probe'. Older traces don't
+#       have it, and only recorded reads
+#
+#   <time>  D  <device name>  <card as hex, or ->  <decision>
+#       A device was enabled or disabled
+#
+# Lines starting with '#' are comments. Trace files ending in '.gz' are
+# compressed.
+
+# System-Wide packages
+import gzip
+import logging
+import queue
+import threading
+import time
+
+# Local Packages
+from rpac_logging import HexCardId
+
+# The active TraceRecorder, if recording
+recorder = None
+
+
+def _open_trace(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+###############################################################################
+# Recording
+###############################################################################
+
+# Records are queued, and written to the trace file by a background thread,
+# so that recording doesn't slow down handling the events being recorded
+class TraceRecorder(threading.Thread):
+
+    def __init__(self, filename):
+        """Trace Recorder Constructor"""
+        threading.Thread.__init__(self, name="trace-recorder", daemon=True)
+        self.filename = filename
+        self.started = time.monotonic()
+        self._queue = queue.SimpleQueue()
+        self._file = _open_trace(filename, 'w')
+        self._file.write("# rpac trace, started %s\n" %
+                time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def add(self, when, record_type, *fields):
+        self._queue.put((when - self.started, record_type, fields))
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            offset, record_type, fields = record
+            self._file.write("%.6f\t%s\t%s\n" % (offset, record_type,
+                    "\t".join(str(field) for field in fields)))
+            # Don't leave records sitting in the buffer once things go quiet
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+
+def start_recording(filename):
+    global recorder
+    recorder = TraceRecorder(filename)
+    recorder.start()
+    logging.info("Recording traffic to %s", filename)
+
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        recorder.stop()
+        recorder = None
+
+
+# These are called by the event loop, readers and devices. They do nothing
+# unless we're recording
+
+def record_edge(when, pin_number, value):
+    if recorder is not None:
+        recorder.add(when, 'E', pin_number, int(value))
+
+
+def record_frame(reader_name, response_time, frame, kind='read'):
+    if recorder is not None:
+        recorder.add(time.monotonic(), 'F', reader_name,
+                "%.6f" % (response_time or 0.0),
+                '-' if frame is None else bytes(frame).hex().upper(), kind)
+
+
+def record_write_error(reader_name, kind='read'):
+    if recorder is not None:
+        recorder.add(time.monotonic(), 'F', reader_name, "%.6f" % 0.0, '!',
+                kind)
+
+
+def record_decision(device_name, card, decision):
+    if recorder is not None:
+        recorder.add(time.monotonic(), 'D', device_name, HexCardId(card),
+                decision)
+
+
+# Read a trace file, returning (time, record type, fields) for each record
+def read_trace(filename):
+    records = []
+    with _open_trace(filename, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3 or fields[1] not in ('E', 'F', 'D'):
+                raise ValueError("%s line %d: not a trace record" %
+                        (filename, line_number))
+            records.append((float(fields[0]), fields[1], fields[2:]))
+    return records